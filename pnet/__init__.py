@@ -28,8 +28,46 @@ from . import rescalc
 from . import plot
 from . import covars
 
-try:
-    import mpi4py
-    from . import parallel
-except ImportError:
-    from . import parallel_fallback as parallel
+
+
+def use_parallel_backend(name=None):
+    """
+    Selects the implementation behind `pnet.parallel`:
+
+    * ``'mpi'``: distributes tasks over MPI processes (requires `mpi4py`).
+    * ``'local'``: a pool of processes on this machine, passing large arrays
+      through shared memory (see `pnet.parallel_local`).
+    * ``'serial'``: runs everything in this process.
+
+    If `name` is None, the environment variable ``PNET_PARALLEL`` is used,
+    and if that is not set either, ``'mpi'`` if `mpi4py` is available and
+    otherwise ``'serial'``.
+
+    Since scripts call ``pnet.parallel.main(__name__)`` once at startup, this
+    should be called before that.
+    """
+    import os
+    import importlib
+    global parallel
+    if name is None:
+        name = os.environ.get('PNET_PARALLEL')
+    if name is None:
+        try:
+            import mpi4py
+            name = 'mpi'
+        except ImportError:
+            name = 'serial'
+
+    modules = dict(mpi='pnet.parallel',
+                   local='pnet.parallel_local',
+                   serial='pnet.parallel_fallback')
+    if name not in modules:
+        raise ValueError("Unknown parallel backend: {}".format(name))
+
+    # Importing a submodule binds it to this package, so `parallel` is
+    # assigned afterwards
+    backend = importlib.import_module(modules[name])
+    parallel = backend
+    return backend
+
+use_parallel_backend()
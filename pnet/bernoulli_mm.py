@@ -4,7 +4,10 @@ from sklearn.utils import check_random_state
 from sklearn.base import BaseEstimator
 import numpy as np
 import random, collections
+import time
 import scipy.sparse
+from pnet.profiler import record_em_iteration
+from pnet.restarts import derive_seeds, fit_restarts, best_restart
 
 
 # Author: Gustav Larsson
@@ -91,6 +94,19 @@ class BernoulliMM(BaseEstimator):
     float_type : numpy type, optional
         What float type to use for the parameter arrays.
 
+    parallel_restarts : bool, optional
+        Run the `n_init` initializations concurrently on the workers of
+        `pnet.parallel`, each seeded from `random_state`. The result does
+        not depend on the backend.
+
+    learning_decay : float, optional
+        Exponent of the decay of the step size of `partial_fit`, in (0.5, 1].
+        Smaller values forget older batches faster.
+
+    learning_offset : float, optional
+        Delays the decay of the step size of `partial_fit`, so that the
+        first batches do not weigh too much.
+
     Attributes
     ----------
     `weights_` : array, shape (`n_components`,)
@@ -102,6 +118,9 @@ class BernoulliMM(BaseEstimator):
     `converged_` : bool
         True when convergence was reached in fit(), False otherwise.
 
+    `n_steps_` : int
+        Number of batches seen by `partial_fit`.
+
     Examples
     --------
     Create a mixture model with 2 mixture componenents.
@@ -136,7 +155,8 @@ class BernoulliMM(BaseEstimator):
                  random_state=None, thresh=1e-6, min_prob=1e-2, min_num=30,
                  n_iter=100,tol=1e-6, n_init=1, params='wm', init_params='wm',blocksize=0,
                  float_type=np.float64,
-                 binary_type=np.uint8, verbose=False):
+                 binary_type=np.uint8, verbose=False, parallel_restarts=False,
+                 learning_decay=0.7, learning_offset=10.0):
         self.n_components = n_components
         self.thresh = thresh
         self.random_state = random_state
@@ -149,6 +169,9 @@ class BernoulliMM(BaseEstimator):
         self.min_prob = min_prob
         self.min_num = 30
         self.verbose=verbose
+        self.parallel_restarts = parallel_restarts
+        self.learning_decay = learning_decay
+        self.learning_offset = learning_offset
         # blocksize controls whether we do the likelihood computation in blocks to prevent memory blowup
         self.blocksize = blocksize
         if self.n_init < 1:
@@ -156,6 +179,8 @@ class BernoulliMM(BaseEstimator):
 
         self.weights_ = np.ones(self.n_components,dtype=self.float_type)/ self.n_components
         self.converged_ = False
+        self.n_steps_ = 0
+        self._running_stats = None
 
     def score_samples(self, X):
         """Evaluate the model on data
@@ -335,103 +360,152 @@ class BernoulliMM(BaseEstimator):
                 'BernoulliMM estimation with %s components, but got only %s samples' %
                 (self.n_components, X.shape[0]))
 
-        inv_X = 1 - X
-        max_log_prob = -np.infty
-
-        # if debug_plot:
-        #     plw = ag.plot.PlottingWindow(subplots=(1, self.num_mix), figsize=(self.num_mix*3, 3))
+        seeds = derive_seeds(random_state, self.n_init)
+        results = fit_restarts(self, X, seeds,
+                               parallel=self.parallel_restarts)
 
-        for cur_init in range(self.n_init):
+        if self.n_iter:
+            max_log_prob, best_params = best_restart(results)
             if self.verbose:
-                print("Current parameter initialization: {0}".format(cur_init))
-
-
-            if 'm' in self.init_params or not hasattr(self,'means_'):
-                if self.verbose:
-                    print("Initializing means")
-
-                if 0:
-                    indices = np.arange(X.shape[0])
-                    random_state.shuffle(indices)
-                    self.means_ = np.array(tuple(
-                        np.clip(X[indices[i::self.n_components]].mean(0),
-                                self.min_prob,
-                                1-self.min_prob)
-                        for i in range(self.n_components)))
-
-                repr_samples = X[random_state.choice(X.shape[0], self.n_components, replace=False)]
-                #self.means_ = repr_samples.clip(self.min_prob, 1 - self.min_prob)
-                self.means_ = repr_samples.clip(0.2, 0.8)
-
-            self.log_odds_, self.log_inv_mean_sums_ = _compute_log_odds_inv_means_sums(self.means_)
-
-            if 'w' in self.init_params or not hasattr(self,'weights_'):
-                if self.verbose:
-                    print("Initializing weights")
-
-                self.weights_ = np.tile(1.0 / self.n_components,
-                                        self.n_components)
-
-
+                print("Best log likelihood {0}".format(max_log_prob))
+        else:
+            max_log_prob = -np.infty
+            best_params = results[-1][1]
 
+        # check the existence of an init param that was not subject to
+        # likelihood computation issue.
+        if np.isneginf(max_log_prob) and self.n_iter:
+            raise RuntimeError(
+                "EM algorithm was never able to compute a valid likelihood " +
+                "given initial parameters. Try different init parameters " +
+                "(or increasing n_init) or check for degenerate data.")
 
+        if len(data_shape) > 1:
+            X = X.reshape(*( (X.shape[0],) + data_shape))
 
-            log_likelihood = []
-            self.iterations = 0
-            self.converged_ = False
-            for i in range(self.n_iter):
-                # Expectation Step
-                curr_log_likelihood, responsibilities = self.score_samples(X)
-                log_likelihood.append(curr_log_likelihood.sum())
-                if self.verbose:
-                    print("Iteration {0}: loglikelihood {1}".format(i, log_likelihood[-1]))
+        self.means_ = best_params['means']
+        self.log_odds_, self.log_inv_mean_sums_ = _compute_log_odds_inv_means_sums(self.means_)
+        self.weights_ = best_params['weights']
+        self.converged_ = best_params['converged']
+        self.n_steps_ = 0
+        self._running_stats = None
 
-                # check for convergence
-                if i > 0 and abs(log_likelihood[-1] - log_likelihood[-2])/abs(log_likelihood[-2]) < \
-                   self.thresh:
-                    self.converged_ = True
-                    break
+        return self
 
-                # ag.info("Iteration {0}: loglikelihood {1}".format(self.iterations, loglikelihood))
-                # maximization step
-                self._do_mstep(X,
-                               responsibilities,
-                               self.params,
-                               self.min_prob)
+    def _fit_restart(self, X, cur_init, seed):
+        """
+        Runs EM from the random initialization given by `seed`. Returns the
+        final log-likelihood (-inf if `n_iter` is 0) and the parameters.
+        """
+        random_state = np.random.RandomState(seed)
+        if self.verbose:
+            print("Current parameter initialization: {0}".format(cur_init))
 
+        if 'm' in self.init_params or not hasattr(self,'means_'):
+            if self.verbose:
+                print("Initializing means")
 
+            self._init_means(X, random_state)
 
-            if self.n_iter:
-                if log_likelihood[-1] > max_log_prob:
-                    if self.verbose:
-                        print("updated best params for {0}".format(self.score(X).sum()))
-                    max_log_prob = log_likelihood[-1]
-                    best_params = {'weights': self.weights_,
-                                   'means' : self.means_}
+        self.log_odds_, self.log_inv_mean_sums_ = _compute_log_odds_inv_means_sums(self.means_)
 
+        if 'w' in self.init_params or not hasattr(self,'weights_'):
+            if self.verbose:
+                print("Initializing weights")
 
+            self.weights_ = np.tile(1.0 / self.n_components,
+                                    self.n_components)
 
-        # check the existence of an init param that was not subject to
-        # likelihood computation issue.
-        if np.isneginf(max_log_prob) and self.n_iter:
-            raise RuntimeError(
-                "EM algorithm was never able to compute a valid likelihood " +
-                "given initial parameters. Try different init parameters " +
-                "(or increasing n_init) or check for degenerate data.")
+        log_likelihood = []
+        self.iterations = 0
+        self.converged_ = False
+        for i in range(self.n_iter):
+            start = time.time()
+            # Expectation Step
+            curr_log_likelihood, responsibilities = self.score_samples(X)
+            log_likelihood.append(curr_log_likelihood.sum())
+            if self.verbose:
+                print("Iteration {0}: loglikelihood {1}".format(i, log_likelihood[-1]))
+
+            # check for convergence
+            if i > 0 and abs(log_likelihood[-1] - log_likelihood[-2])/abs(log_likelihood[-2]) < \
+               self.thresh:
+                self.converged_ = True
+                break
+
+            # maximization step
+            self._do_mstep(X,
+                           responsibilities,
+                           self.params,
+                           self.min_prob)
+            record_em_iteration('BernoulliMM', cur_init, i,
+                                time.time() - start, log_likelihood[-1])
+
+        loglikelihood = log_likelihood[-1] if log_likelihood else -np.infty
+        return loglikelihood, {'weights': self.weights_,
+                               'means': self.means_,
+                               'converged': self.converged_}
+
+
+    def _init_means(self, X, random_state):
+        repr_samples = X[random_state.choice(X.shape[0], self.n_components, replace=False)]
+        #self.means_ = repr_samples.clip(self.min_prob, 1 - self.min_prob)
+        self.means_ = repr_samples.clip(0.2, 0.8)
+
+    def partial_fit(self, X):
+        """
+        One step of stepwise (online) EM on the batch `X`.
+
+        The first call initializes the means from `X` (at least
+        `n_components` samples), unless they are already set, for instance
+        by `fit`, in which case the running statistics start from the ones
+        that the parameters imply. Each call then does an E-step on `X` and
+        blends its sufficient statistics, averaged over the batch, into the
+        running ones with the step size ``(n_steps_ + learning_offset) **
+        -learning_decay`` (1 for the first batch of a new model), followed
+        by an M-step on these. Only the running statistics are kept, so that
+        the model can be learned from any number of batches, streamed from
+        disk or from a patch sampler, in constant memory.
 
-        if len(data_shape) > 1:
-            X = X.reshape(*( (X.shape[0],) + data_shape))
+        Parameters
+        ----------
+        X : array_like, shape (n,) + d
+            Batch of data points, with `np.prod(X.shape[1:])==n_features`
+        """
+        X = np.asarray(X, dtype=self.binary_type)
+        if X.ndim == 1:
+            X = X[:, np.newaxis]
+        X = X.reshape((X.shape[0], -1))
 
-        if self.n_iter:
-            self.means_ = best_params['means']
+        start = time.time()
+        if not hasattr(self, 'means_'):
+            self._init_means(X, check_random_state(self.random_state))
             self.log_odds_, self.log_inv_mean_sums_ = _compute_log_odds_inv_means_sums(self.means_)
-            self.weights_ = best_params['weights']
+        elif self._running_stats is None:
+            self._running_stats = self._model_statistics()
 
+        logprob, responsibilities = self.score_samples(X)
+        stats = self._sufficient_statistics(X, responsibilities)
+        stats = [v / X.shape[0] for v in stats]
+        if self._running_stats is None:
+            self._running_stats = stats
+        else:
+            step = (self.n_steps_ + self.learning_offset) ** -self.learning_decay
+            self._running_stats = [(1 - step) * v + step * new
+                                   for v, new in zip(self._running_stats, stats)]
+        self._mstep_from_statistics(self._running_stats, self.params,
+                                    self.min_prob)
+
+        record_em_iteration('BernoulliMM', 0, self.n_steps_,
+                            time.time() - start, logprob.sum())
+        if self.verbose:
+            print("Step {0}: loglikelihood per sample {1}".format(self.n_steps_, logprob.mean()))
+        self.n_steps_ += 1
         return self
 
-
-    def _do_mstep(self, X, responsibilities, params, min_prob=1e-7):
-        """ Perform the Mstep of the EM algorithm and return the class weights
+    def _sufficient_statistics(self, X, responsibilities):
+        """ The responsibilities summed over samples, and the samples
+        summed with them as weights
         """
         weights = responsibilities.sum(axis=0)
 
@@ -445,6 +519,16 @@ class BernoulliMM(BaseEstimator):
 
         else:
             weighted_X_sum = np.dot(responsibilities.T, X)
+        return weights, weighted_X_sum
+
+    def _model_statistics(self):
+        """ The sufficient statistics per sample that the M-step maps to
+        the current parameters (up to their clipping)
+        """
+        return [self.weights_.copy(), self.means_ * self.weights_[:, np.newaxis]]
+
+    def _mstep_from_statistics(self, stats, params, min_prob):
+        weights, weighted_X_sum = stats
         inverse_weights = 1.0 / (weights[:, np.newaxis] + 10 * EPS)
         if 'w' in params:
             self.weights_ = (weights / (weights.sum() + 10 * EPS) + EPS)
@@ -453,8 +537,12 @@ class BernoulliMM(BaseEstimator):
             self.means_ = np.clip(weighted_X_sum * inverse_weights,min_prob,1-min_prob)
             self.log_odds_, self.log_inv_mean_sums_ = _compute_log_odds_inv_means_sums(self.means_)
 
-
-        return weights
+    def _do_mstep(self, X, responsibilities, params, min_prob=1e-7):
+        """ Perform the Mstep of the EM algorithm and return the class weights
+        """
+        stats = self._sufficient_statistics(X, responsibilities)
+        self._mstep_from_statistics(stats, params, min_prob)
+        return stats[0]
 
 
 
@@ -0,0 +1,81 @@
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+
+
+class PackedBits(object):
+    """
+    Binary feature map with the last (channel) axis packed into bits, eight
+    channels per byte: channel ``c`` is bit ``c % 8`` of byte ``c // 8``.
+
+    This takes an eighth of the memory of a ``uint8`` or ``bool`` map.
+    Layers that accept packed input set `Layer.accepts_packed`; for all
+    others, `PartsNet` unpacks the maps before passing them on.
+
+    Only the sample axis can be indexed. Use `unpack` for anything else.
+
+    Parameters
+    ----------
+    bits : ndarray
+        Packed ``uint8`` array of shape ``(N, ..., ceil(n_channels / 8))``.
+    n_channels : int
+        Number of channels before packing.
+    dtype : dtype
+        Dtype of the unpacked map.
+    """
+    def __init__(self, bits, n_channels, dtype=np.uint8):
+        self.bits = bits
+        self.n_channels = n_channels
+        self.dtype = np.dtype(dtype)
+
+    @classmethod
+    def pack(cls, X):
+        bits = np.packbits(np.asarray(X, dtype=bool), axis=-1,
+                           bitorder='little')
+        return cls(bits, X.shape[-1], dtype=X.dtype)
+
+    def unpack(self):
+        X = np.unpackbits(self.bits, axis=-1, count=self.n_channels,
+                          bitorder='little')
+        return X.astype(self.dtype, copy=False)
+
+    @classmethod
+    def concatenate(cls, maps):
+        n_channels = maps[0].n_channels
+        assert all(m.n_channels == n_channels for m in maps)
+        return cls(np.concatenate([m.bits for m in maps]), n_channels,
+                   dtype=maps[0].dtype)
+
+    @property
+    def shape(self):
+        """Shape of the unpacked map"""
+        return self.bits.shape[:-1] + (self.n_channels,)
+
+    @property
+    def ndim(self):
+        return self.bits.ndim
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def __len__(self):
+        return len(self.bits)
+
+    def __getitem__(self, index):
+        bits = self.bits[index]
+        if isinstance(index, tuple) or bits.ndim != self.bits.ndim:
+            raise IndexError('Only the sample axis of PackedBits can be '
+                             'indexed. Unpack it first.')
+        return PackedBits(bits, self.n_channels, dtype=self.dtype)
+
+    def __repr__(self):
+        return 'PackedBits(shape={}, dtype={})'.format(self.shape, self.dtype)
+
+
+def unpack(X):
+    """Returns `X` unpacked if it is `PackedBits`, otherwise `X` itself"""
+    if isinstance(X, PackedBits):
+        return X.unpack()
+    else:
+        return X
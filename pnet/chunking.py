@@ -0,0 +1,113 @@
+from __future__ import division, print_function, absolute_import
+
+import time
+import numpy as np
+
+
+class Chunker(object):
+    """
+    Splits ``n`` samples into consecutive chunks for a pool of workers, with
+    chunk sizes adapted to the measured time per sample.
+
+    Each chunk aims to take `target_seconds` on the worker it is handed to,
+    so that tiny tasks are merged and slow workers get smaller pieces. Chunks
+    are also never larger than an even share of what is left, so that the
+    last chunks are small and no worker is left with a long tail.
+
+    Parameters
+    ----------
+    n : int
+        Number of samples.
+    n_workers : int
+        Number of workers sharing the chunks.
+    target_seconds : float
+        Desired time per chunk.
+    max_size : int or None
+        Upper limit of the chunk size, for instance from a memory budget.
+    initial_size : int or None
+        Size of the chunks handed out before any timing is known. Defaults to
+        a quarter of an even share per worker.
+    """
+    def __init__(self, n, n_workers, target_seconds=0.5, max_size=None,
+                 initial_size=None):
+        self.n = n
+        self.n_workers = max(1, n_workers)
+        self.target_seconds = target_seconds
+        self.max_size = max_size
+        if initial_size is None:
+            initial_size = int(np.ceil(n / (4 * self.n_workers)))
+        self.initial_size = initial_size
+        self.offset = 0
+        # Seconds per sample, overall and by worker (exponential averages)
+        self._rate = None
+        self._rates = {}
+
+    def next(self, worker=None):
+        """
+        Returns the slice of the next chunk for `worker`, or None when all
+        samples have been handed out.
+        """
+        remaining = self.n - self.offset
+        if remaining <= 0:
+            return None
+
+        rate = self._rates.get(worker, self._rate)
+        if rate is None:
+            size = self.initial_size
+        else:
+            size = int(self.target_seconds / max(rate, 1e-9))
+
+        size = min(size, int(np.ceil(remaining / self.n_workers)))
+        if self.max_size is not None:
+            size = min(size, self.max_size)
+        size = max(1, min(size, remaining))
+
+        sl = slice(self.offset, self.offset + size)
+        self.offset += size
+        return sl
+
+    def record(self, worker, size, seconds):
+        """Records that a chunk of `size` samples took `seconds`"""
+        rate = seconds / max(size, 1)
+        self._rate = _average(self._rate, rate)
+        self._rates[worker] = _average(self._rates.get(worker), rate)
+
+
+def _average(old, new, weight=0.5):
+    if old is None:
+        return new
+    else:
+        return (1 - weight) * old + weight * new
+
+
+def as_arrays(arrays):
+    """Returns `arrays` as a tuple, wrapping a single array"""
+    if isinstance(arrays, np.ndarray):
+        return (arrays,)
+    else:
+        return tuple(arrays)
+
+
+def chunk(arrays, sl):
+    """Takes the same slice along axis 0 of each array"""
+    return tuple(X[sl] for X in arrays)
+
+
+def timed_call(f, *args):
+    """Returns the time taken by ``f(*args)`` and its result"""
+    t0 = time.time()
+    res = f(*args)
+    return time.time() - t0, res
+
+
+def serial_chunks(f, arrays, args=(), max_size=None):
+    """
+    Calls `f` on chunks of at most `max_size` samples in this process. Used
+    when there are no workers.
+    """
+    arrays = as_arrays(arrays)
+    n = len(arrays[0])
+    size = n if max_size is None else max(1, max_size)
+    for offset in range(0, n, max(size, 1)):
+        sl = slice(offset, offset + size)
+        yield f(*(chunk(arrays, sl) + tuple(args)))
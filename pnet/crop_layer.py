@@ -1,5 +1,5 @@
 from __future__ import division, print_function, absolute_import
-from pnet.layer import Layer
+from pnet.layer import Layer, FeatureSpec
 import pnet
 
 
@@ -19,6 +19,11 @@ class CropLayer(Layer):
         else:
             return remove_frame(X)
 
+    def output_spec(self, input_spec):
+        sh = input_spec.shape
+        shape = (sh[0] - 2 * self._frame, sh[1] - 2 * self._frame) + sh[2:]
+        return FeatureSpec(shape, input_spec.dtype, input_spec.n_features)
+
     @property
     def pos_matrix(self):
         T = pnet.matrix.translation(-self._frame, -self._frame)
@@ -0,0 +1,140 @@
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+
+# Below this many permutations, the gathered matrix products are faster than
+# the FFTs
+MIN_FFT_PERMUTATIONS = 8
+
+
+def cyclic_shape(permutations):
+    """
+    Returns the shape of a grid of blocks if `permutations` are its cyclic
+    shifts, and None otherwise.
+
+    The blocks are taken as the cells of the grid in C order. The
+    permutations are its cyclic shifts if ``permutations[s, p]`` is the cell
+    of ``p`` shifted by the cell of ``s``, adding their coordinates modulo
+    the shape. The integer permutations of `pnet.PermutationMM` are the
+    shifts of a grid of shape ``(P,)``, and those of the oriented parts
+    layers the shifts of a grid of polarities by orientations.
+    """
+    permutations = np.asarray(permutations)
+    P = len(permutations)
+    if P <= 1 or permutations.shape != (P, P):
+        return None
+
+    for shape in _factorizations(P):
+        if np.array_equal(permutations, cyclic_permutations(shape)):
+            return shape
+    return None
+
+
+def fft_shape(permutations, use_fft='auto'):
+    """
+    Returns the grid that a mixture model with `permutations` scores them
+    over with FFTs, or None if it gathers them instead.
+
+    With `use_fft` 'auto', the FFTs are used if the permutations are cyclic
+    and there are at least `MIN_FFT_PERMUTATIONS` of them. True requires
+    cyclic permutations and False never uses them.
+    """
+    if use_fft is False:
+        return None
+    shape = cyclic_shape(permutations)
+    if use_fft == 'auto':
+        if len(permutations) < MIN_FFT_PERMUTATIONS:
+            return None
+    elif shape is None:
+        raise ValueError('use_fft=True needs cyclic permutations')
+    return shape
+
+
+def cyclic_permutations(shape):
+    """
+    Returns the cyclic shifts of a grid of blocks of `shape` (see
+    `cyclic_shape`), as an array of shape ``(P, P)``.
+    """
+    shape = tuple(shape)
+    cells = np.indices(shape).reshape((len(shape), -1))
+    shifted = cells[:, :, np.newaxis] + cells[:, np.newaxis, :]
+    shifted %= np.asarray(shape)[:, np.newaxis, np.newaxis]
+    return np.ravel_multi_index(tuple(shifted), shape)
+
+
+def _factorizations(n):
+    # Ordered factorizations of n into factors above 1
+    if n == 1:
+        yield ()
+        return
+    for f in range(n, 1, -1):
+        if n % f == 0:
+            for rest in _factorizations(n // f):
+                yield (f,) + rest
+
+
+def spectrum(A, shape):
+    """
+    Returns the discrete Fourier transform of the blocks of `A`, of shape
+    ``(M, P, D)``, over the grid of blocks of `shape`. The result has shape
+    ``(M, F, D)``, where `F` is the number of frequencies of a real FFT.
+    """
+    M, P, D = A.shape
+    axes = tuple(range(1, len(shape) + 1))
+    Af = np.fft.rfftn(A.reshape((M,) + tuple(shape) + (D,)), axes=axes)
+    return Af.reshape((M, -1, D))
+
+
+def inverse_spectrum(Af, shape):
+    """
+    Inverse of `spectrum`: returns the real blocks, of shape ``(M, P, D)``,
+    with the discrete Fourier transform `Af`.
+    """
+    M, F, D = Af.shape
+    shape = tuple(shape)
+    fshape = shape[:-1] + (shape[-1] // 2 + 1,)
+    axes = tuple(range(1, len(shape) + 1))
+    A = np.fft.irfftn(Af.reshape((M,) + fshape + (D,)), s=shape, axes=axes)
+    return A.reshape((M, -1, D))
+
+
+def correlate(X, W_spectrum, shape):
+    """
+    Scores every cyclic shift of the blocks of `X` against the blocks of
+    each row of `W`, given by its spectrum (see `spectrum`). Returns
+
+    ``C[n, k, p] = sum_s dot(X[n, permutations[s, p]], W[k, s])``
+
+    of shape ``(N, K, P)``, for the cyclic shifts of a grid of `shape`.
+
+    This is a circular cross-correlation over the grid. Its transform is the
+    product of the transforms of `X` and `W`, summed over the dimensions of
+    the blocks, which is one matrix product per frequency. This costs
+    ``O(P log P D)`` per sample, instead of ``O(P^2 D)`` for the sums.
+    """
+    N = X.shape[0]
+    K = W_spectrum.shape[0]
+    Xf = spectrum(X, shape)
+    # Cf[f, n, k] = sum_d Xf[n, f, d] conj(Wf[k, f, d])
+    Cf = np.matmul(Xf.transpose((1, 0, 2)),
+                   W_spectrum.conj().transpose((1, 2, 0)))
+    Cf = Cf.transpose((1, 2, 0)).reshape((N * K, -1, 1))
+    return inverse_spectrum(Cf, shape).reshape((N, K, -1))
+
+
+def weighted_spectrum(R, X, shape):
+    """
+    Returns the spectrum (see `spectrum`) of the sums
+
+    ``S[k, p] = sum_n sum_s R[n, k, s] X[n, permutations[s, p]]``
+
+    of shape ``(K, F, D)``, for the cyclic shifts of a grid of `shape`. The
+    spectra of disjoint sets of samples can be summed before taking the
+    inverse with `inverse_spectrum`.
+    """
+    N, K, P = R.shape
+    Xf = spectrum(X, shape)
+    Rf = spectrum(R.reshape((N * K, P, 1)), shape).reshape((N, K, -1))
+    # Sf[f, k, d] = sum_n conj(Rf[n, k, f]) Xf[n, f, d]
+    Sf = np.matmul(Rf.conj().transpose((2, 1, 0)), Xf.transpose((1, 0, 2)))
+    return Sf.transpose((1, 0, 2))
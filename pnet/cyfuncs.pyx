@@ -11,20 +11,84 @@ cimport cython
 from libc.math cimport exp, abs, fabs, fmax, fmin, log, pow, sqrt, sin, cos, floor
 from libc.stdlib cimport rand, srand
 from cpython cimport bool
+from cython.parallel cimport prange, threadid
 
 cdef inline int int_max(int a, int b) nogil: return a if a >= b else b
 cdef inline int int_min(int a, int b) nogil: return a if a <= b else b
+cdef inline int int_floordiv(int a, int b) nogil: return a // b if a >= 0 else -((b - 1 - a) // b)
+
+# Index maps can be int16, int32 or int64 (see `pnet.layer.index_map_dtype`)
+ctypedef fused index_t:
+    np.int16_t
+    np.int32_t
+    np.int64_t
+
+# Number of set bits and index of the lowest set bit of each byte, for
+# pnet.bitpack.PackedBits
+cdef np.uint8_t[256] _popcount8
+cdef np.uint8_t[256] _lowest_bit8
+for _v in range(256):
+    _popcount8[_v] = bin(_v).count('1')
+    _lowest_bit8[_v] = (_v & -_v).bit_length() - 1 if _v else 8
+
+# Number of threads of the loops over samples (see `set_num_threads`)
+cdef int _num_threads = 1
+
+def set_num_threads(n):
+    """
+    Sets the number of threads that the coding and pooling kernels use, or
+    one per CPU if `n` is None or 0. Defaults to the
+    environment variable ``PNET_NUM_THREADS``, or 1.
+
+    Threads are only used if the module was built with OpenMP (see
+    ``setup.py``). With a process-parallel backend, the threads of each
+    worker add up, so this should be at most the number of CPUs per worker.
+    """
+    global _num_threads
+    if not n:
+        import multiprocessing
+        n = multiprocessing.cpu_count()
+    _num_threads = max(1, int(n))
+
+def get_num_threads():
+    """Returns the number of threads set with `set_num_threads`"""
+    return _num_threads
+
+import os as _os
+set_num_threads(int(_os.environ.get('PNET_NUM_THREADS', 1)))
 
 def subsample_offset_shape(shape, size):
     return [int(shape[i]%size[i]/2 + size[i]/2) for i in range(2)]
 
-def code_index_map(np.ndarray[ndim=4, dtype=np.uint8_t] X,
-                   np.ndarray[ndim=4, dtype=np.float64_t] part_logits,
-                   np.ndarray[ndim=1, dtype=np.float64_t] constant_terms,
-                   int threshold, outer_frame=0,
-                   #float min_llh=-np.inf,
-                   np.ndarray[ndim=1, dtype=np.float64_t] min_llh=np.tile(-np.inf, 0),
-                   return_llhs=False):
+def _new_index_map(X, part_shape, num_parts, extra_shape, index_dtype):
+    from pnet.layer import index_map_dtype
+    shape = (X.shape[0],
+             X.shape[1] - part_shape[0] + 1,
+             X.shape[2] - part_shape[1] + 1) + tuple(extra_shape)
+    return -np.ones(shape, dtype=index_map_dtype(num_parts, index_dtype))
+
+def code_index_map(X, part_logits, constant_terms, int threshold,
+                   outer_frame=0, min_llh=np.tile(-np.inf, 0),
+                   return_llhs=False, index_dtype=None):
+    """
+    Codes the most likely Bernoulli part at each position. The index map
+    has dtype `index_dtype`, by default the most compact one for the number
+    of parts (see `pnet.layer.index_map_dtype`).
+    """
+    out_map = _new_index_map(X, part_logits.shape[:2], part_logits.shape[3],
+                             (), index_dtype)
+    return _code_index_map(X, out_map, part_logits, constant_terms, threshold,
+                           outer_frame=outer_frame, min_llh=min_llh,
+                           return_llhs=return_llhs)
+
+def _code_index_map(np.ndarray[ndim=4, dtype=np.uint8_t] X,
+                    np.ndarray[ndim=3, dtype=index_t] out_map,
+                    np.ndarray[ndim=4, dtype=np.float64_t] part_logits,
+                    np.ndarray[ndim=1, dtype=np.float64_t] constant_terms,
+                    int threshold, outer_frame=0,
+                    #float min_llh=-np.inf,
+                    np.ndarray[ndim=1, dtype=np.float64_t] min_llh=np.tile(-np.inf, 0),
+                    return_llhs=False):
     cdef unsigned int part_x_dim = part_logits.shape[0]
     cdef unsigned int part_y_dim = part_logits.shape[1]
     cdef unsigned int part_z_dim = part_logits.shape[2]
@@ -39,6 +103,10 @@ def code_index_map(np.ndarray[ndim=4, dtype=np.uint8_t] X,
     cdef int count
     cdef unsigned int i_frame = <unsigned int>outer_frame
     cdef np.float64_t NINF = np.float64(-np.inf)
+    cdef int n_threads = _num_threads
+    cdef Py_ssize_t n
+    cdef int tid
+    cdef bint do_llhs = return_llhs
     # we have num_parts + 1 because we are also including some regions as being
     # thresholded due to there not being enough edges
 
@@ -50,12 +118,8 @@ def code_index_map(np.ndarray[ndim=4, dtype=np.uint8_t] X,
 
     cdef np.float64_t[:, :, :, :] llhs_mv = llhs
 
-
-    cdef np.ndarray[dtype=np.int64_t, ndim=3] out_map = -np.ones((n_samples,
-                                                                  new_x_dim,
-                                                                  new_y_dim), dtype=np.int64)
-    cdef np.ndarray[dtype=np.float64_t, ndim=1] vs = np.ones(num_parts, dtype=np.float64)
-    cdef np.float64_t[:] vs_mv = vs
+    # Scratch space of each thread
+    cdef np.float64_t[:, :] vs_mv = np.ones((n_threads, num_parts), dtype=np.float64)
 
     cdef np.uint8_t[:, :, :, :] X_mv = X
 
@@ -66,70 +130,76 @@ def code_index_map(np.ndarray[ndim=4, dtype=np.uint8_t] X,
     cdef np.float64_t[:, :, :, :] part_logits_mv = part_logits
     cdef np.float64_t[:] constant_terms_mv = constant_terms
 
-    cdef np.int64_t[:, :, :] out_map_mv = out_map
+    cdef index_t[:, :, :] out_map_mv = out_map
 
-    cdef np.ndarray[dtype=np.int64_t, ndim=2] _integral_counts = np.zeros((X_x_dim+1, X_y_dim+1), dtype=np.int64)
-    cdef np.int64_t[:, :] integral_counts = _integral_counts
+    cdef np.int64_t[:, :, :] integral_counts = np.zeros((n_threads, X_x_dim+1, X_y_dim+1), dtype=np.int64)
 
     cdef np.float64_t v
     cdef int max_index
 
     # TODO: Remove
     cdef np.float64_t[:] min_llh_mv = min_llh
+    cdef bint has_min_llh = min_llh.shape[0] > 0
 
     # The first cell along the num_parts+1 axis contains a value that is either 0
     # if the area is deemed to have too few edges or min_val if there are sufficiently many
     # edges, min_val is just meant to be less than the value of the other cells
     # so when we pick the most likely part it won't be chosen
 
-    # Build integral image of edge counts
-    # First, fill it with edge counts and accmulate across
-    # one axis.
-    for n in range(n_samples):
-        for i in range(X_x_dim):
-            for j in range(X_y_dim):
-                count = 0
-                for z in range(X_z_dim):
-                    count += X_mv[n, i, j, z]
-                integral_counts[1+i, 1+j] = integral_counts[1+i, j] + count
-        # Now accumulate the other axis
-        for j in range(X_y_dim):
+    with nogil:
+        for n in prange(n_samples, schedule='dynamic', num_threads=n_threads):
+            tid = threadid()
+            # Build integral image of edge counts
+            # First, fill it with edge counts and accmulate across
+            # one axis. (`count = count + ...`, since an in-place operator
+            # would make `count` a reduction of the prange.)
             for i in range(X_x_dim):
-                integral_counts[1+i, 1+j] += integral_counts[i, 1+j]
+                for j in range(X_y_dim):
+                    count = 0
+                    for z in range(X_z_dim):
+                        count = count + X_mv[n, i, j, z]
+                    integral_counts[tid, 1+i, 1+j] = integral_counts[tid, 1+i, j] + count
+            # Now accumulate the other axis
+            for j in range(X_y_dim):
+                for i in range(X_x_dim):
+                    integral_counts[tid, 1+i, 1+j] += integral_counts[tid, i, 1+j]
 
-        # Code parts
-        for i_start in range(X_x_dim-part_x_dim+1):
-            i_end = i_start + part_x_dim
-            for j_start in range(X_y_dim-part_y_dim+1):
-                j_end = j_start + part_y_dim
+            # Code parts
+            for i_start in range(X_x_dim-part_x_dim+1):
+                i_end = i_start + part_x_dim
+                for j_start in range(X_y_dim-part_y_dim+1):
+                    j_end = j_start + part_y_dim
 
-                # Note, integral_counts is 1-based, to allow for a zero row/column at the zero:th index.
-                cx0 = i_start+i_frame
-                cx1 = i_end-i_frame
-                cy0 = j_start+i_frame
-                cy1 = j_end-i_frame
-                count = integral_counts[cx1, cy1] - \
-                        integral_counts[cx0, cy1] - \
-                        integral_counts[cx1, cy0] + \
-                        integral_counts[cx0, cy0]
+                    # Note, integral_counts is 1-based, to allow for a zero row/column at the zero:th index.
+                    cx0 = i_start+i_frame
+                    cx1 = i_end-i_frame
+                    cy0 = j_start+i_frame
+                    cy1 = j_end-i_frame
+                    count = integral_counts[tid, cx1, cy1] - \
+                            integral_counts[tid, cx0, cy1] - \
+                            integral_counts[tid, cx1, cy0] + \
+                            integral_counts[tid, cx0, cy0]
 
-                if threshold <= count:
-                    vs[:] = constant_terms
-                    #vs_alt[:] = constant_terms_alt
-                    with nogil:
+                    if threshold <= count:
+                        for k in range(num_parts):
+                            vs_mv[tid, k] = constant_terms_mv[k]
                         for i in range(part_x_dim):
                             for j in range(part_y_dim):
                                 for z in range(X_z_dim):
                                     if X_mv[n, i_start+i, j_start+j, z]:
                                         for k in range(num_parts):
-                                            vs_mv[k] += part_logits_mv[i, j, z, k]
+                                            vs_mv[tid, k] += part_logits_mv[i, j, z, k]
 
-                    max_index = vs.argmax()
-                    if vs_mv[max_index] >= min_llh_mv[max_index]:
-                        out_map_mv[n, i_start, j_start] = max_index
+                        max_index = 0
+                        for k in range(1, num_parts):
+                            if vs_mv[tid, k] > vs_mv[tid, max_index]:
+                                max_index = k
+                        if not has_min_llh or vs_mv[tid, max_index] >= min_llh_mv[max_index]:
+                            out_map_mv[n, i_start, j_start] = max_index
 
-                    if return_llhs:
-                        llhs[n, i_start, j_start] = vs
+                        if do_llhs:
+                            for k in range(num_parts):
+                                llhs_mv[n, i_start, j_start, k] = vs_mv[tid, k]
 
 
     if return_llhs:
@@ -364,7 +434,7 @@ def code_index_map_with_same_keypoints(np.ndarray[ndim=4, dtype=np.uint8_t] X,
 
     return out_map
 
-def index_map_pooling(np.ndarray[ndim=3, dtype=np.int64_t] part_index_map,
+def index_map_pooling(np.ndarray[ndim=3, dtype=index_t] part_index_map,
             int num_parts,
             pooling_shape,
             strides):
@@ -392,7 +462,7 @@ def index_map_pooling(np.ndarray[ndim=3, dtype=np.int64_t] part_index_map,
                                                               feat_dim1,
                                                               num_parts),
                                                               dtype=np.uint8)
-        np.int64_t[:, :, :] part_index_mv = part_index_map
+        index_t[:, :, :] part_index_mv = part_index_map
         np.uint8_t[:, :, :, :] feat_mv = feature_map
 
 
@@ -415,7 +485,7 @@ def index_map_pooling(np.ndarray[ndim=3, dtype=np.int64_t] part_index_map,
 
     return feature_map
 
-def convert_to_index_map(np.ndarray[ndim=3, dtype=np.int64_t] part_index_map,
+def convert_to_index_map(np.ndarray[ndim=3, dtype=index_t] part_index_map,
                          int num_parts,
                          pooling_shape,
                          strides):
@@ -443,7 +513,7 @@ def convert_to_index_map(np.ndarray[ndim=3, dtype=np.int64_t] part_index_map,
                                                               feat_dim1,
                                                               num_parts),
                                                               dtype=np.uint8)
-        np.int64_t[:, :, :] part_index_mv = part_index_map
+        index_t[:, :, :] part_index_mv = part_index_map
         np.uint8_t[:, :, :, :] feat_mv = feature_map
 
 
@@ -489,10 +559,23 @@ def resample_and_arrange_image(np.ndarray[dtype=np.uint8_t, ndim=2] image, targe
 
 # EXPERIMENTAL STUFF ##########################################################
 
-def code_index_map_multi(np.ndarray[ndim=4, dtype=np.uint8_t] X,
-                         np.ndarray[ndim=4, dtype=np.float64_t] part_logits,
-                         np.ndarray[ndim=1, dtype=np.float64_t] constant_terms,
-                         int threshold, outer_frame=0, int n_coded=1, float min_llh=-np.inf):
+def code_index_map_multi(X, part_logits, constant_terms, int threshold,
+                         outer_frame=0, int n_coded=1, float min_llh=-np.inf,
+                         index_dtype=None):
+    """
+    Like `code_index_map`, but codes the `n_coded` most likely parts.
+    """
+    out_map = _new_index_map(X, part_logits.shape[:2], part_logits.shape[3],
+                             (n_coded,), index_dtype)
+    return _code_index_map_multi(X, out_map, part_logits, constant_terms,
+                                 threshold, outer_frame=outer_frame,
+                                 n_coded=n_coded, min_llh=min_llh)
+
+def _code_index_map_multi(np.ndarray[ndim=4, dtype=np.uint8_t] X,
+                          np.ndarray[ndim=4, dtype=index_t] out_map,
+                          np.ndarray[ndim=4, dtype=np.float64_t] part_logits,
+                          np.ndarray[ndim=1, dtype=np.float64_t] constant_terms,
+                          int threshold, outer_frame=0, int n_coded=1, float min_llh=-np.inf):
     cdef unsigned int part_x_dim = part_logits.shape[0]
     cdef unsigned int part_y_dim = part_logits.shape[1]
     cdef unsigned int part_z_dim = part_logits.shape[2]
@@ -510,12 +593,12 @@ def code_index_map_multi(np.ndarray[ndim=4, dtype=np.uint8_t] X,
     # we have num_parts + 1 because we are also including some regions as being
     # thresholded due to there not being enough edges
 
-    cdef np.ndarray[dtype=np.int64_t, ndim=4] out_map = -np.ones((n_samples,
-                                                                  new_x_dim,
-                                                                  new_y_dim,
-                                                                  n_coded), dtype=np.int64)
-    cdef np.ndarray[dtype=np.float64_t, ndim=1] vs = np.ones(num_parts, dtype=np.float64)
-    cdef np.float64_t[:] vs_mv = vs
+    cdef int n_threads = _num_threads
+    cdef Py_ssize_t n
+    cdef int tid
+
+    # Scratch space of each thread
+    cdef np.float64_t[:, :] vs_mv = np.ones((n_threads, num_parts), dtype=np.float64)
 
     cdef np.uint8_t[:, :, :, :] X_mv = X
 
@@ -526,10 +609,9 @@ def code_index_map_multi(np.ndarray[ndim=4, dtype=np.uint8_t] X,
     cdef np.float64_t[:, :, :, :] part_logits_mv = part_logits
     cdef np.float64_t[:] constant_terms_mv = constant_terms
 
-    cdef np.int64_t[:, :, :, :] out_map_mv = out_map
+    cdef index_t[:, :, :, :] out_map_mv = out_map
 
-    cdef np.ndarray[dtype=np.int64_t, ndim=2] _integral_counts = np.zeros((X_x_dim+1, X_y_dim+1), dtype=np.int64)
-    cdef np.int64_t[:, :] integral_counts = _integral_counts
+    cdef np.int64_t[:, :, :] integral_counts = np.zeros((n_threads, X_x_dim+1, X_y_dim+1), dtype=np.int64)
 
     cdef np.float64_t v
     cdef int max_index
@@ -539,54 +621,168 @@ def code_index_map_multi(np.ndarray[ndim=4, dtype=np.uint8_t] X,
     # edges, min_val is just meant to be less than the value of the other cells
     # so when we pick the most likely part it won't be chosen
 
-    # Build integral image of edge counts
-    # First, fill it with edge counts and accmulate across
-    # one axis.
-    for n in range(n_samples):
-        for i in range(X_x_dim):
-            for j in range(X_y_dim):
-                count = 0
-                for z in range(X_z_dim):
-                    count += X_mv[n, i, j, z]
-                integral_counts[1+i, 1+j] = integral_counts[1+i, j] + count
-        # Now accumulate the other axis
-        for j in range(X_y_dim):
+    with nogil:
+        for n in prange(n_samples, schedule='dynamic', num_threads=n_threads):
+            tid = threadid()
+            # Build integral image of edge counts
+            # First, fill it with edge counts and accmulate across
+            # one axis. (`count = count + ...`, see `_code_index_map`.)
             for i in range(X_x_dim):
-                integral_counts[1+i, 1+j] += integral_counts[i, 1+j]
+                for j in range(X_y_dim):
+                    count = 0
+                    for z in range(X_z_dim):
+                        count = count + X_mv[n, i, j, z]
+                    integral_counts[tid, 1+i, 1+j] = integral_counts[tid, 1+i, j] + count
+            # Now accumulate the other axis
+            for j in range(X_y_dim):
+                for i in range(X_x_dim):
+                    integral_counts[tid, 1+i, 1+j] += integral_counts[tid, i, 1+j]
 
-        # Code parts
-        for i_start in range(X_x_dim-part_x_dim+1):
-            i_end = i_start + part_x_dim
-            for j_start in range(X_y_dim-part_y_dim+1):
-                j_end = j_start + part_y_dim
+            # Code parts
+            for i_start in range(X_x_dim-part_x_dim+1):
+                i_end = i_start + part_x_dim
+                for j_start in range(X_y_dim-part_y_dim+1):
+                    j_end = j_start + part_y_dim
 
-                # Note, integral_counts is 1-based, to allow for a zero row/column at the zero:th index.
-                cx0 = i_start+i_frame
-                cx1 = i_end-i_frame
-                cy0 = j_start+i_frame
-                cy1 = j_end-i_frame
-                count = integral_counts[cx1, cy1] - \
-                        integral_counts[cx0, cy1] - \
-                        integral_counts[cx1, cy0] + \
-                        integral_counts[cx0, cy0]
+                    # Note, integral_counts is 1-based, to allow for a zero row/column at the zero:th index.
+                    cx0 = i_start+i_frame
+                    cx1 = i_end-i_frame
+                    cy0 = j_start+i_frame
+                    cy1 = j_end-i_frame
+                    count = integral_counts[tid, cx1, cy1] - \
+                            integral_counts[tid, cx0, cy1] - \
+                            integral_counts[tid, cx1, cy0] + \
+                            integral_counts[tid, cx0, cy0]
 
-                if threshold <= count:
-                    vs[:] = constant_terms
-                    #vs_alt[:] = constant_terms_alt
-                    with nogil:
+                    if threshold <= count:
+                        for k in range(num_parts):
+                            vs_mv[tid, k] = constant_terms_mv[k]
                         for i in range(part_x_dim):
                             for j in range(part_y_dim):
                                 for z in range(X_z_dim):
                                     if X_mv[n, i_start+i, j_start+j, z]:
                                         for k in range(num_parts):
-                                            vs_mv[k] += part_logits_mv[i, j, z, k]
+                                            vs_mv[tid, k] += part_logits_mv[i, j, z, k]
 
+                        for m in range(n_coded):
+                            max_index = 0
+                            for k in range(1, num_parts):
+                                if vs_mv[tid, k] > vs_mv[tid, max_index]:
+                                    max_index = k
+                            if vs_mv[tid, max_index] >= min_llh:
+                                out_map_mv[n, i_start, j_start, m] = max_index
+                            vs_mv[tid, max_index] = NINF
+
+    return out_map
+
+def packed_code_index_map(bits, part_logits, constant_terms, double threshold,
+                          outer_frame=0, index_dtype=None):
+    """
+    Like `code_index_map`, but for edges bit-packed along the last axis (see
+    `pnet.bitpack.PackedBits`).
+    """
+    return packed_code_index_map_multi(bits, part_logits, constant_terms,
+                                       threshold, outer_frame=outer_frame,
+                                       index_dtype=index_dtype)[..., 0]
+
+def packed_code_index_map_multi(bits, part_logits, constant_terms,
+                                double threshold, outer_frame=0,
+                                int n_coded=1, double min_llh=-np.inf,
+                                index_dtype=None):
+    """
+    Like `code_index_map_multi`, but for edges bit-packed along the last axis
+    (see `pnet.bitpack.PackedBits`). Edge counts are popcounts of the packed
+    bytes, and the part scores only visit the set bits.
+    """
+    if bits.shape[3] != (part_logits.shape[2] + 7) // 8:
+        raise ValueError('Packed edges do not match the parts')
+    out_map = _new_index_map(bits, part_logits.shape[:2], part_logits.shape[3],
+                             (n_coded,), index_dtype)
+    return _packed_code_index_map_multi(bits, out_map, part_logits,
+                                        constant_terms, threshold,
+                                        outer_frame, n_coded, min_llh)
+
+def _packed_code_index_map_multi(np.ndarray[ndim=4, dtype=np.uint8_t] bits,
+                                 np.ndarray[ndim=4, dtype=index_t] out_map,
+                                 np.ndarray[ndim=4, dtype=np.float64_t] part_logits,
+                                 np.ndarray[ndim=1, dtype=np.float64_t] constant_terms,
+                                 double threshold, int outer_frame, int n_coded,
+                                 double min_llh):
+    cdef:
+        int part_x_dim = part_logits.shape[0]
+        int part_y_dim = part_logits.shape[1]
+        int num_parts = part_logits.shape[3]
+        int n_samples = bits.shape[0]
+        int X_x_dim = bits.shape[1]
+        int X_y_dim = bits.shape[2]
+        int n_bytes = bits.shape[3]
+        int index_dim0 = X_x_dim - part_x_dim + 1
+        int index_dim1 = X_y_dim - part_y_dim + 1
+
+        np.uint8_t[:, :, :, :] bits_mv = bits
+        index_t[:, :, :, :] out_map_mv = out_map
+        np.float64_t[:, :, :, :] part_logits_mv = part_logits
+        np.float64_t[:] constant_terms_mv = constant_terms
+        np.float64_t NINF = np.float64(-np.inf)
+        int n_threads = _num_threads
+        # Scratch space of each thread
+        np.float64_t[:, :] vs_mv = np.zeros((n_threads, num_parts), dtype=np.float64)
+        np.int64_t[:, :, :] integral_counts = np.zeros((n_threads, X_x_dim+1, X_y_dim+1),
+                                                       dtype=np.int64)
+
+        int n, i, j, b, z, k, m, i_start, j_start, cx0, cx1, cy0, cy1
+        int max_index, tid
+        np.uint8_t word
+        np.int64_t count
+
+    with nogil:
+        for n in prange(n_samples, schedule='dynamic', num_threads=n_threads):
+            tid = threadid()
+            # Integral image of edge counts (`count = count + ...`, see
+            # `_code_index_map`)
+            for i in range(X_x_dim):
+                for j in range(X_y_dim):
+                    count = 0
+                    for b in range(n_bytes):
+                        count = count + _popcount8[bits_mv[n, i, j, b]]
+                    integral_counts[tid, 1+i, 1+j] = integral_counts[tid, 1+i, j] + count
+            for j in range(X_y_dim):
+                for i in range(X_x_dim):
+                    integral_counts[tid, 1+i, 1+j] += integral_counts[tid, i, 1+j]
+
+            for i_start in range(index_dim0):
+                for j_start in range(index_dim1):
+                    cx0 = i_start + outer_frame
+                    cx1 = i_start + part_x_dim - outer_frame
+                    cy0 = j_start + outer_frame
+                    cy1 = j_start + part_y_dim - outer_frame
+                    count = integral_counts[tid, cx1, cy1] - \
+                            integral_counts[tid, cx0, cy1] - \
+                            integral_counts[tid, cx1, cy0] + \
+                            integral_counts[tid, cx0, cy0]
+                    if count < threshold:
+                        continue
+
+                    for k in range(num_parts):
+                        vs_mv[tid, k] = constant_terms_mv[k]
+                    for i in range(part_x_dim):
+                        for j in range(part_y_dim):
+                            for b in range(n_bytes):
+                                word = bits_mv[n, i_start+i, j_start+j, b]
+                                while word:
+                                    z = 8 * b + _lowest_bit8[word]
+                                    for k in range(num_parts):
+                                        vs_mv[tid, k] += part_logits_mv[i, j, z, k]
+                                    word = word & (word - 1)
 
                     for m in range(n_coded):
-                        max_index = vs.argmax()
-                        if vs[max_index] >= min_llh:
+                        max_index = 0
+                        for k in range(1, num_parts):
+                            if vs_mv[tid, k] > vs_mv[tid, max_index]:
+                                max_index = k
+                        if vs_mv[tid, max_index] >= min_llh:
                             out_map_mv[n, i_start, j_start, m] = max_index
-                        vs[max_index] = -np.inf
+                        vs_mv[tid, max_index] = NINF
 
     return out_map
 
@@ -626,10 +822,11 @@ def orientation_pooling(np.ndarray[ndim=5, dtype=np.uint8_t] X,
 
 
         int x, y, i, j, n, i0, j0, m, r, z, rs
+        int n_threads = _num_threads
 
 
     with nogil:
-         for n in range(sample_size):
+         for n in prange(sample_size, schedule='static', num_threads=n_threads):
             for i in range(feat_dim0):
                 for j in range(feat_dim1):
                     x = offset0 + i*stride0 - half_pooling0
@@ -642,13 +839,14 @@ def orientation_pooling(np.ndarray[ndim=5, dtype=np.uint8_t] X,
                                         feat_mv[n, i, j, z, r] = 1
                                         for rs in range(1, rotational_spreading+1):
                                             feat_mv[n, i, j, z, (r+rs)%num_orientations] = 1
-                                            feat_mv[n, i, j, z, (r-rs)%num_orientations] = 1
+                                            # C modulo, so kept non-negative
+                                            feat_mv[n, i, j, z, (r-rs%num_orientations+num_orientations)%num_orientations] = 1
 
 
 
     return feature_map
 
-def rotate_index_map_pooling(np.ndarray[ndim=3, dtype=np.int64_t] part_index_map,
+def rotate_index_map_pooling(np.ndarray[ndim=3, dtype=index_t] part_index_map,
                              np.float64_t angle,
                              int rotation_spreading_radius,
                              int num_orientations,
@@ -679,7 +877,7 @@ def rotate_index_map_pooling(np.ndarray[ndim=3, dtype=np.int64_t] part_index_map
                                                               feat_dim1,
                                                               num_parts),
                                                               dtype=np.uint8)
-        np.int64_t[:, :, :] part_index_mv = part_index_map
+        index_t[:, :, :] part_index_mv = part_index_map
         np.uint8_t[:, :, :, :] feat_mv = feature_map
 
 
@@ -726,7 +924,7 @@ def rotate_index_map_pooling(np.ndarray[ndim=3, dtype=np.int64_t] part_index_map
 
     return feature_map
 
-def index_map_pooling_multi(np.ndarray[ndim=4, dtype=np.int64_t] part_index_map,
+def index_map_pooling_multi(np.ndarray[ndim=4, dtype=index_t] part_index_map,
             int num_parts,
             pooling_shape,
             strides):
@@ -758,15 +956,16 @@ def index_map_pooling_multi(np.ndarray[ndim=4, dtype=np.int64_t] part_index_map,
                                                               feat_dim1,
                                                               num_parts),
                                                               dtype=np.uint8)
-        np.int64_t[:, :, :, :] part_index_mv = part_index_map
+        index_t[:, :, :, :] part_index_mv = part_index_map
         np.uint8_t[:, :, :, :] feat_mv = feature_map
 
 
         int p, x, y, i, j, n, i0, j0, m
+        int n_threads = _num_threads
 
 
     with nogil:
-         for n in range(sample_size):
+         for n in prange(sample_size, schedule='static', num_threads=n_threads):
             for i in range(feat_dim0):
                 for j in range(feat_dim1):
                     x = offset0 + i*stride0 - half_pooling0
@@ -782,7 +981,7 @@ def index_map_pooling_multi(np.ndarray[ndim=4, dtype=np.int64_t] part_index_map,
 
     return feature_map
 
-def index_map_sum_pooling_multi(np.ndarray[ndim=4, dtype=np.int64_t] part_index_map,
+def index_map_sum_pooling_multi(np.ndarray[ndim=4, dtype=index_t] part_index_map,
             int num_parts,
             pooling_shape,
             strides):
@@ -813,15 +1012,16 @@ def index_map_sum_pooling_multi(np.ndarray[ndim=4, dtype=np.int64_t] part_index_
                                                               feat_dim1,
                                                               num_parts),
                                                               dtype=np.int64)
-        np.int64_t[:, :, :, :] part_index_mv = part_index_map
+        index_t[:, :, :, :] part_index_mv = part_index_map
         np.int64_t[:, :, :, :] feat_mv = feature_map
 
 
         int p, x, y, i, j, n, i0, j0, m
+        int n_threads = _num_threads
 
 
     with nogil:
-         for n in range(sample_size):
+         for n in prange(sample_size, schedule='static', num_threads=n_threads):
             for i in range(feat_dim0):
                 for j in range(feat_dim1):
                     x = offset0 + i*stride0 - half_pooling0
@@ -838,7 +1038,271 @@ def index_map_sum_pooling_multi(np.ndarray[ndim=4, dtype=np.int64_t] part_index_
     return feature_map
 
 
-def index_map_pooling_multi_support(np.ndarray[ndim=4, dtype=np.int64_t] part_index_map,
+def code_index_map_pooling_multi(np.ndarray[ndim=4, dtype=np.uint8_t] X,
+                                 np.ndarray[ndim=4, dtype=np.float64_t] part_logits,
+                                 np.ndarray[ndim=1, dtype=np.float64_t] constant_terms,
+                                 double threshold,
+                                 pooling_shape,
+                                 strides,
+                                 operation='max'):
+    """
+    Codes Bernoulli parts (like `code_index_map`) and pools the codes (like
+    `index_map_pooling_multi`, or `index_map_sum_pooling_multi` if
+    `operation` is 'sum') in one pass, without materializing the index map.
+    A position is coded only if it has at least `threshold` edges in the part
+    window. Positions outside all pooling windows are not coded at all.
+    """
+    cdef:
+        int part_x_dim = part_logits.shape[0]
+        int part_y_dim = part_logits.shape[1]
+        int num_parts = part_logits.shape[3]
+        int n_samples = X.shape[0]
+        int X_x_dim = X.shape[1]
+        int X_y_dim = X.shape[2]
+        int X_z_dim = X.shape[3]
+        int index_dim0 = X_x_dim - part_x_dim + 1
+        int index_dim1 = X_y_dim - part_y_dim + 1
+        int pooling0 = pooling_shape[0]
+        int pooling1 = pooling_shape[1]
+        int half_pooling0 = pooling0 // 2
+        int half_pooling1 = pooling1 // 2
+        int stride0 = strides[0]
+        int stride1 = strides[1]
+        int feat_dim0 = index_dim0 // stride0
+        int feat_dim1 = index_dim1 // stride1
+        bint sum_pooling
+
+    if operation == 'max':
+        sum_pooling = False
+    elif operation == 'sum':
+        sum_pooling = True
+    else:
+        raise ValueError('Unknown pooling operation: {}'.format(operation))
+
+    offset = subsample_offset_shape((index_dim0, index_dim1), strides)
+    cdef:
+        int offset0 = offset[0]
+        int offset1 = offset[1]
+
+        np.ndarray[np.uint8_t, ndim=4] max_map = np.zeros(
+            (0 if sum_pooling else n_samples, feat_dim0, feat_dim1, num_parts),
+            dtype=np.uint8)
+        np.ndarray[np.int64_t, ndim=4] sum_map = np.zeros(
+            (n_samples if sum_pooling else 0, feat_dim0, feat_dim1, num_parts),
+            dtype=np.int64)
+        np.uint8_t[:, :, :, :] max_mv = max_map
+        np.int64_t[:, :, :, :] sum_mv = sum_map
+
+        np.uint8_t[:, :, :, :] X_mv = X
+        np.float64_t[:, :, :, :] part_logits_mv = part_logits
+        np.float64_t[:] constant_terms_mv = constant_terms
+        int n_threads = _num_threads
+        # Scratch space of each thread
+        np.float64_t[:, :] vs_mv = np.zeros((n_threads, num_parts), dtype=np.float64)
+        np.int64_t[:, :, :] integral_counts = np.zeros((n_threads, X_x_dim+1, X_y_dim+1),
+                                                       dtype=np.int64)
+
+        int n, i, j, z, k, i_start, j_start, i_lo, i_hi, j_lo, j_hi
+        int max_index, tid
+        np.int64_t count
+
+    with nogil:
+        for n in prange(n_samples, schedule='dynamic', num_threads=n_threads):
+            tid = threadid()
+            # Integral image of edge counts (`count = count + ...`, since an
+            # in-place operator would make `count` a reduction of the prange)
+            for i in range(X_x_dim):
+                for j in range(X_y_dim):
+                    count = 0
+                    for z in range(X_z_dim):
+                        count = count + X_mv[n, i, j, z]
+                    integral_counts[tid, 1+i, 1+j] = integral_counts[tid, 1+i, j] + count
+            for j in range(X_y_dim):
+                for i in range(X_x_dim):
+                    integral_counts[tid, 1+i, 1+j] += integral_counts[tid, i, 1+j]
+
+            for i_start in range(index_dim0):
+                # Range of pooling windows that cover this row
+                i_lo = int_max(-int_floordiv(pooling0 - 1 - i_start + offset0 - half_pooling0, stride0), 0)
+                i_hi = int_min(int_floordiv(i_start - offset0 + half_pooling0, stride0), feat_dim0 - 1)
+                if i_lo > i_hi:
+                    continue
+
+                for j_start in range(index_dim1):
+                    j_lo = int_max(-int_floordiv(pooling1 - 1 - j_start + offset1 - half_pooling1, stride1), 0)
+                    j_hi = int_min(int_floordiv(j_start - offset1 + half_pooling1, stride1), feat_dim1 - 1)
+                    if j_lo > j_hi:
+                        continue
+
+                    count = integral_counts[tid, i_start+part_x_dim, j_start+part_y_dim] - \
+                            integral_counts[tid, i_start, j_start+part_y_dim] - \
+                            integral_counts[tid, i_start+part_x_dim, j_start] + \
+                            integral_counts[tid, i_start, j_start]
+                    if count < threshold:
+                        continue
+
+                    for k in range(num_parts):
+                        vs_mv[tid, k] = constant_terms_mv[k]
+                    for i in range(part_x_dim):
+                        for j in range(part_y_dim):
+                            for z in range(X_z_dim):
+                                if X_mv[n, i_start+i, j_start+j, z]:
+                                    for k in range(num_parts):
+                                        vs_mv[tid, k] += part_logits_mv[i, j, z, k]
+
+                    max_index = 0
+                    for k in range(1, num_parts):
+                        if vs_mv[tid, k] > vs_mv[tid, max_index]:
+                            max_index = k
+
+                    for i in range(i_lo, i_hi + 1):
+                        for j in range(j_lo, j_hi + 1):
+                            if sum_pooling:
+                                sum_mv[n, i, j, max_index] += 1
+                            else:
+                                max_mv[n, i, j, max_index] = 1
+
+    if sum_pooling:
+        return sum_map
+    else:
+        return max_map
+
+def packed_code_index_map_pooling_multi(np.ndarray[ndim=4, dtype=np.uint8_t] bits,
+                                        np.ndarray[ndim=4, dtype=np.float64_t] part_logits,
+                                        np.ndarray[ndim=1, dtype=np.float64_t] constant_terms,
+                                        double threshold,
+                                        pooling_shape,
+                                        strides,
+                                        operation='max'):
+    """
+    Like `code_index_map_pooling_multi`, but for edges bit-packed along the
+    last axis (see `pnet.bitpack.PackedBits`). Edge counts are popcounts of
+    the packed bytes, and the part scores only visit the set bits.
+    """
+    cdef:
+        int part_x_dim = part_logits.shape[0]
+        int part_y_dim = part_logits.shape[1]
+        int n_channels = part_logits.shape[2]
+        int num_parts = part_logits.shape[3]
+        int n_samples = bits.shape[0]
+        int X_x_dim = bits.shape[1]
+        int X_y_dim = bits.shape[2]
+        int n_bytes = bits.shape[3]
+        int index_dim0 = X_x_dim - part_x_dim + 1
+        int index_dim1 = X_y_dim - part_y_dim + 1
+        int pooling0 = pooling_shape[0]
+        int pooling1 = pooling_shape[1]
+        int half_pooling0 = pooling0 // 2
+        int half_pooling1 = pooling1 // 2
+        int stride0 = strides[0]
+        int stride1 = strides[1]
+        int feat_dim0 = index_dim0 // stride0
+        int feat_dim1 = index_dim1 // stride1
+        bint sum_pooling
+
+    if n_bytes != (n_channels + 7) // 8:
+        raise ValueError('Packed edges do not match the parts')
+
+    if operation == 'max':
+        sum_pooling = False
+    elif operation == 'sum':
+        sum_pooling = True
+    else:
+        raise ValueError('Unknown pooling operation: {}'.format(operation))
+
+    offset = subsample_offset_shape((index_dim0, index_dim1), strides)
+    cdef:
+        int offset0 = offset[0]
+        int offset1 = offset[1]
+
+        np.ndarray[np.uint8_t, ndim=4] max_map = np.zeros(
+            (0 if sum_pooling else n_samples, feat_dim0, feat_dim1, num_parts),
+            dtype=np.uint8)
+        np.ndarray[np.int64_t, ndim=4] sum_map = np.zeros(
+            (n_samples if sum_pooling else 0, feat_dim0, feat_dim1, num_parts),
+            dtype=np.int64)
+        np.uint8_t[:, :, :, :] max_mv = max_map
+        np.int64_t[:, :, :, :] sum_mv = sum_map
+
+        np.uint8_t[:, :, :, :] bits_mv = bits
+        np.float64_t[:, :, :, :] part_logits_mv = part_logits
+        np.float64_t[:] constant_terms_mv = constant_terms
+        int n_threads = _num_threads
+        # Scratch space of each thread
+        np.float64_t[:, :] vs_mv = np.zeros((n_threads, num_parts), dtype=np.float64)
+        np.int64_t[:, :, :] integral_counts = np.zeros((n_threads, X_x_dim+1, X_y_dim+1),
+                                                       dtype=np.int64)
+
+        int n, i, j, b, z, k, i_start, j_start, i_lo, i_hi, j_lo, j_hi
+        int max_index, tid
+        np.uint8_t word
+        np.int64_t count
+
+    with nogil:
+        for n in prange(n_samples, schedule='dynamic', num_threads=n_threads):
+            tid = threadid()
+            # Integral image of edge counts (`count = count + ...`, since an
+            # in-place operator would make `count` a reduction of the prange)
+            for i in range(X_x_dim):
+                for j in range(X_y_dim):
+                    count = 0
+                    for b in range(n_bytes):
+                        count = count + _popcount8[bits_mv[n, i, j, b]]
+                    integral_counts[tid, 1+i, 1+j] = integral_counts[tid, 1+i, j] + count
+            for j in range(X_y_dim):
+                for i in range(X_x_dim):
+                    integral_counts[tid, 1+i, 1+j] += integral_counts[tid, i, 1+j]
+
+            for i_start in range(index_dim0):
+                # Range of pooling windows that cover this row
+                i_lo = int_max(-int_floordiv(pooling0 - 1 - i_start + offset0 - half_pooling0, stride0), 0)
+                i_hi = int_min(int_floordiv(i_start - offset0 + half_pooling0, stride0), feat_dim0 - 1)
+                if i_lo > i_hi:
+                    continue
+
+                for j_start in range(index_dim1):
+                    j_lo = int_max(-int_floordiv(pooling1 - 1 - j_start + offset1 - half_pooling1, stride1), 0)
+                    j_hi = int_min(int_floordiv(j_start - offset1 + half_pooling1, stride1), feat_dim1 - 1)
+                    if j_lo > j_hi:
+                        continue
+
+                    count = integral_counts[tid, i_start+part_x_dim, j_start+part_y_dim] - \
+                            integral_counts[tid, i_start, j_start+part_y_dim] - \
+                            integral_counts[tid, i_start+part_x_dim, j_start] + \
+                            integral_counts[tid, i_start, j_start]
+                    if count < threshold:
+                        continue
+
+                    for k in range(num_parts):
+                        vs_mv[tid, k] = constant_terms_mv[k]
+                    for i in range(part_x_dim):
+                        for j in range(part_y_dim):
+                            for b in range(n_bytes):
+                                word = bits_mv[n, i_start+i, j_start+j, b]
+                                while word:
+                                    z = 8 * b + _lowest_bit8[word]
+                                    for k in range(num_parts):
+                                        vs_mv[tid, k] += part_logits_mv[i, j, z, k]
+                                    word = word & (word - 1)
+
+                    max_index = 0
+                    for k in range(1, num_parts):
+                        if vs_mv[tid, k] > vs_mv[tid, max_index]:
+                            max_index = k
+
+                    for i in range(i_lo, i_hi + 1):
+                        for j in range(j_lo, j_hi + 1):
+                            if sum_pooling:
+                                sum_mv[n, i, j, max_index] += 1
+                            else:
+                                max_mv[n, i, j, max_index] = 1
+
+    if sum_pooling:
+        return sum_map
+    else:
+        return max_map
+
+def index_map_pooling_multi_support(np.ndarray[ndim=4, dtype=index_t] part_index_map,
                                     np.ndarray[ndim=2, dtype=np.uint8_t] support,
                                     int num_parts,
                                     pooling_shape,
@@ -869,7 +1333,7 @@ def index_map_pooling_multi_support(np.ndarray[ndim=4, dtype=np.int64_t] part_in
                                                               feat_dim1,
                                                               num_parts),
                                                               dtype=np.uint8)
-        np.int64_t[:, :, :, :] part_index_mv = part_index_map
+        index_t[:, :, :, :] part_index_mv = part_index_map
         np.uint8_t[:, :, :, :] feat_mv = feature_map
 
 
@@ -894,15 +1358,34 @@ def index_map_pooling_multi_support(np.ndarray[ndim=4, dtype=np.int64_t] part_in
 
     return feature_map
 
-def code_index_map_general(np.ndarray[ndim=4, dtype=np.uint8_t] X,
-                           np.ndarray[ndim=4, dtype=np.float64_t] parts,
-                           np.ndarray[ndim=2, dtype=np.uint8_t] support,
-                           int threshold,
-                           outer_frame=0,
-                           int n_coded=1,
-                           int standardize=0,
-                           int max_threshold=10000,
-                           min_percentile=None):
+def code_index_map_general(X, parts, support, int threshold, outer_frame=0,
+                           int n_coded=1, int standardize=0,
+                           int max_threshold=10000, min_percentile=None,
+                           index_dtype=None):
+    """
+    Codes the `n_coded` most likely parts at each position, with the part
+    likelihoods restricted to `support`. See `code_index_map` for
+    `index_dtype`.
+    """
+    out_map = _new_index_map(X, parts.shape[1:3], parts.shape[0], (n_coded,),
+                             index_dtype)
+    return _code_index_map_general(X, out_map, parts, support, threshold,
+                                   outer_frame=outer_frame,
+                                   n_coded=n_coded,
+                                   standardize=standardize,
+                                   max_threshold=max_threshold,
+                                   min_percentile=min_percentile)
+
+def _code_index_map_general(np.ndarray[ndim=4, dtype=np.uint8_t] X,
+                            np.ndarray[ndim=4, dtype=index_t] out_map,
+                            np.ndarray[ndim=4, dtype=np.float64_t] parts,
+                            np.ndarray[ndim=2, dtype=np.uint8_t] support,
+                            int threshold,
+                            outer_frame=0,
+                            int n_coded=1,
+                            int standardize=0,
+                            int max_threshold=10000,
+                            min_percentile=None):
     cdef unsigned int part_x_dim = parts.shape[1]
     cdef unsigned int part_y_dim = parts.shape[2]
     cdef unsigned int part_z_dim = parts.shape[3]
@@ -940,12 +1423,12 @@ def code_index_map_general(np.ndarray[ndim=4, dtype=np.uint8_t] X,
         from scipy.stats import norm
         min_standardized_llh = norm.ppf(min_percentile/100.0)
 
-    cdef np.ndarray[dtype=np.int64_t, ndim=4] out_map = -np.ones((n_samples,
-                                                                  new_x_dim,
-                                                                  new_y_dim,
-                                                                  n_coded), dtype=np.int64)
-    cdef np.ndarray[dtype=np.float64_t, ndim=1] vs = np.ones(num_parts, dtype=np.float64)
-    cdef np.float64_t[:] vs_mv = vs
+    cdef int n_threads = _num_threads
+    cdef Py_ssize_t n
+    cdef int tid
+
+    # Scratch space of each thread
+    cdef np.float64_t[:, :] vs_mv = np.ones((n_threads, num_parts), dtype=np.float64)
 
     cdef np.uint8_t[:, :, :, :] X_mv = X
 
@@ -981,10 +1464,9 @@ def code_index_map_general(np.ndarray[ndim=4, dtype=np.uint8_t] X,
 
     cdef np.float64_t[:, :, :, :] part_logits_mv = part_logits
 
-    cdef np.int64_t[:, :, :, :] out_map_mv = out_map
+    cdef index_t[:, :, :, :] out_map_mv = out_map
 
-    cdef np.ndarray[dtype=np.int64_t, ndim=2] _integral_counts = np.zeros((X_x_dim+1, X_y_dim+1), dtype=np.int64)
-    cdef np.int64_t[:, :] integral_counts = _integral_counts
+    cdef np.int64_t[:, :, :] integral_counts = np.zeros((n_threads, X_x_dim+1, X_y_dim+1), dtype=np.int64)
 
     cdef np.float64_t v
     cdef int max_index
@@ -994,57 +1476,63 @@ def code_index_map_general(np.ndarray[ndim=4, dtype=np.uint8_t] X,
     # edges, min_val is just meant to be less than the value of the other cells
     # so when we pick the most likely part it won't be chosen
 
-    # Build integral image of edge counts
-    # First, fill it with edge counts and accmulate across
-    # one axis.
-    for n in range(n_samples):
-        for i in range(X_x_dim):
-            for j in range(X_y_dim):
-                count = 0
-                for z in range(X_z_dim):
-                    count += X_mv[n, i, j, z]
-                integral_counts[1+i, 1+j] = integral_counts[1+i, j] + count
-        # Now accumulate the other axis
-        for j in range(X_y_dim):
+    with nogil:
+        for n in prange(n_samples, schedule='dynamic', num_threads=n_threads):
+            tid = threadid()
+            # Build integral image of edge counts
+            # First, fill it with edge counts and accmulate across
+            # one axis. (`count = count + ...`, see `_code_index_map`.)
             for i in range(X_x_dim):
-                integral_counts[1+i, 1+j] += integral_counts[i, 1+j]
+                for j in range(X_y_dim):
+                    count = 0
+                    for z in range(X_z_dim):
+                        count = count + X_mv[n, i, j, z]
+                    integral_counts[tid, 1+i, 1+j] = integral_counts[tid, 1+i, j] + count
+            # Now accumulate the other axis
+            for j in range(X_y_dim):
+                for i in range(X_x_dim):
+                    integral_counts[tid, 1+i, 1+j] += integral_counts[tid, i, 1+j]
 
-        # Code parts
-        for i_start in range(X_x_dim-part_x_dim+1):
-            i_end = i_start + part_x_dim
-            for j_start in range(X_y_dim-part_y_dim+1):
-                j_end = j_start + part_y_dim
+            # Code parts
+            for i_start in range(X_x_dim-part_x_dim+1):
+                i_end = i_start + part_x_dim
+                for j_start in range(X_y_dim-part_y_dim+1):
+                    j_end = j_start + part_y_dim
 
-                # Note, integral_counts is 1-based, to allow for a zero row/column at the zero:th index.
-                cx0 = i_start+i_frame
-                cx1 = i_end-i_frame
-                cy0 = j_start+i_frame
-                cy1 = j_end-i_frame
-                count = integral_counts[cx1, cy1] - \
-                        integral_counts[cx0, cy1] - \
-                        integral_counts[cx1, cy0] + \
-                        integral_counts[cx0, cy0]
+                    # Note, integral_counts is 1-based, to allow for a zero row/column at the zero:th index.
+                    cx0 = i_start+i_frame
+                    cx1 = i_end-i_frame
+                    cy0 = j_start+i_frame
+                    cy1 = j_end-i_frame
+                    count = integral_counts[tid, cx1, cy1] - \
+                            integral_counts[tid, cx0, cy1] - \
+                            integral_counts[tid, cx1, cy0] + \
+                            integral_counts[tid, cx0, cy0]
 
-                if threshold <= count <= max_threshold:
-                    vs[:] = constant_terms
-                    with nogil:
+                    if threshold <= count <= max_threshold:
+                        for k in range(num_parts):
+                            vs_mv[tid, k] = constant_terms_mv[k]
                         for i in range(part_x_dim):
                             for j in range(part_y_dim):
                                 if support_mv[i, j]:
                                     for z in range(X_z_dim):
                                         if X_mv[n, i_start+i, j_start+j, z]:
                                             for k in range(num_parts):
-                                                vs_mv[k] += part_logits_mv[k, i, j, z]
+                                                vs_mv[tid, k] += part_logits_mv[k, i, j, z]
 
-                    if do_premax_standardization:
-                        vs[:] = (vs - means) / sigmas
+                        if do_premax_standardization:
+                            for k in range(num_parts):
+                                vs_mv[tid, k] = (vs_mv[tid, k] - means_mv[k]) / sigmas_mv[k]
 
-                    for m in range(n_coded):
-                        max_index = vs.argmax()
-                        if (vs[max_index] - postmax_means_mv[max_index]) / postmax_sigmas_mv[max_index] >= min_standardized_llh:
-                            out_map_mv[n, i_start, j_start, m] = max_index
+                        for m in range(n_coded):
+                            max_index = 0
+                            for k in range(1, num_parts):
+                                if vs_mv[tid, k] > vs_mv[tid, max_index]:
+                                    max_index = k
+                            if (vs_mv[tid, max_index] - postmax_means_mv[max_index]) / postmax_sigmas_mv[max_index] >= min_standardized_llh:
+                                out_map_mv[n, i_start, j_start, m] = max_index
 
-                        vs[max_index] = -np.inf
+                            vs_mv[tid, max_index] = NINF
 
     return out_map
 
@@ -1544,251 +2032,3 @@ def code_index_map_binary_tree_keypoints(
                                 offset = ref + <int>(v > 0)
 
     return out_map
-
-
-def calc_new_covar(np.ndarray[ndim=3, dtype=np.float64_t] X,
-                   np.ndarray[ndim=3, dtype=np.float64_t] means,
-                   np.ndarray[ndim=3, dtype=np.float64_t] resp,
-                   np.ndarray[ndim=2, dtype=np.int64_t] permutations):
-    cdef:
-        int N = X.shape[0]
-        int D = X.shape[2]
-        int K = means.shape[0]
-        int P = permutations.shape[0]
-
-
-        np.ndarray[ndim=2, dtype=np.float64_t] covars = np.zeros((D, D))
-
-        np.float64_t[:, :] covars_mv = covars
-        np.int64_t[:, :] permutations_mv = permutations
-        np.float64_t[:, :, :] means_mv = means
-        np.float64_t[:, :, :] resp_mv = resp
-        np.float64_t[:, :, :] X_mv = X
-
-        int n, k, p, shift, d1, d2, p0
-        np.float64_t v
-
-    with nogil:
-        for n in range(N):
-            for k in range(K):
-                for p in range(P):
-                #p = 0
-                    for shift in range(P):
-                        p0 = permutations_mv[shift, p]
-                        #u = X[n, p0] - means[k, p0]
-                        v = resp[n, k, shift]
-                        for d1 in range(D):
-                            for d2 in range(D):
-                                covars_mv[d1, d2] += v * \
-                                    (X_mv[n, p0, d1] - means_mv[k, p, d1]) * \
-                                    (X_mv[n, p0, d2] - means_mv[k, p, d2])
-
-    covars /= N * P
-    return covars
-
-def calc_new_covar_full(np.ndarray[ndim=3, dtype=np.float64_t] X,
-                        np.ndarray[ndim=3, dtype=np.float64_t] means,
-                        np.ndarray[ndim=3, dtype=np.float64_t] resp,
-                        np.ndarray[ndim=2, dtype=np.int64_t] permutations):
-    cdef:
-        int N = X.shape[0]
-        int D = X.shape[2]
-        int K = means.shape[0]
-        int P = permutations.shape[0]
-
-
-        np.ndarray[ndim=3, dtype=np.float64_t] covars = np.zeros((K, D, D))
-        np.ndarray[ndim=1, dtype=np.float64_t] tot_resp = np.zeros(K)
-
-        np.float64_t[:, :, :] covars_mv = covars
-        np.float64_t[:] tot_resp_mv = tot_resp
-        np.int64_t[:, :] permutations_mv = permutations
-        np.float64_t[:, :, :] means_mv = means
-        np.float64_t[:, :, :] resp_mv = resp
-        np.float64_t[:, :, :] X_mv = X
-
-        int n, k, p, shift, d1, d2, p0
-        np.float64_t v
-
-    with nogil:
-        for n in range(N):
-            for k in range(K):
-                for p in range(P):
-                #p = 0
-                    for shift in range(P):
-                        p0 = permutations_mv[shift, p]
-                        #u = X[n, p0] - means[k, p0]
-                        v = resp[n, k, shift]
-                        tot_resp_mv[k] += v
-                        for d1 in range(D):
-                            for d2 in range(D):
-                                covars_mv[k, d1, d2] += v * \
-                                    (X_mv[n, p0, d1] - means_mv[k, p, d1]) * \
-                                    (X_mv[n, p0, d2] - means_mv[k, p, d2])
-
-    covars /= tot_resp[:, np.newaxis, np.newaxis]
-    return covars
-
-def calc_new_covar_fullfull(np.ndarray[ndim=3, dtype=np.float64_t] X,
-                            np.ndarray[ndim=3, dtype=np.float64_t] means,
-                            np.ndarray[ndim=3, dtype=np.float64_t] resp,
-                            np.ndarray[ndim=2, dtype=np.int64_t] permutations):
-    cdef:
-        int N = X.shape[0]
-        int D = X.shape[2]
-        int K = means.shape[0]
-        int P = permutations.shape[0]
-
-
-        np.ndarray[ndim=4, dtype=np.float64_t] covars = np.zeros((K, P, D, D))
-        np.ndarray[ndim=2, dtype=np.float64_t] tot_resp = np.zeros((K, P))
-
-        np.float64_t[:, :, :, :] covars_mv = covars
-        np.float64_t[:, :] tot_resp_mv = tot_resp
-        np.int64_t[:, :] permutations_mv = permutations
-        np.float64_t[:, :, :] means_mv = means
-        np.float64_t[:, :, :] resp_mv = resp
-        np.float64_t[:, :, :] X_mv = X
-
-        int n, k, p, shift, d1, d2, p0
-        np.float64_t v
-
-    with nogil:
-        for n in range(N):
-            for k in range(K):
-                for p in range(P):
-                #p = 0
-                    for shift in range(P):
-                        p0 = permutations_mv[shift, p]
-                        #u = X[n, p0] - means[k, p0]
-                        v = resp[n, k, shift]
-                        tot_resp_mv[k, p] += v
-                        for d1 in range(D):
-                            for d2 in range(D):
-                                covars_mv[k, p, d1, d2] += v * \
-                                    (X_mv[n, p0, d1] - means_mv[k, p, d1]) * \
-                                    (X_mv[n, p0, d2] - means_mv[k, p, d2])
-
-    covars /= tot_resp[..., np.newaxis, np.newaxis]
-    return covars
-
-def calc_new_covar_fullperm(np.ndarray[ndim=3, dtype=np.float64_t] X,
-                            np.ndarray[ndim=3, dtype=np.float64_t] means,
-                            np.ndarray[ndim=3, dtype=np.float64_t] resp,
-                            np.ndarray[ndim=2, dtype=np.int64_t] permutations):
-    cdef:
-        int N = X.shape[0]
-        int D = X.shape[2]
-        int K = means.shape[0]
-        int P = permutations.shape[0]
-
-
-        np.ndarray[ndim=3, dtype=np.float64_t] covars = np.zeros((P, D, D))
-        np.ndarray[ndim=1, dtype=np.float64_t] tot_resp = np.zeros((P))
-
-        np.float64_t[:, :, :] covars_mv = covars
-        np.float64_t[:] tot_resp_mv = tot_resp
-        np.int64_t[:, :] permutations_mv = permutations
-        np.float64_t[:, :, :] means_mv = means
-        np.float64_t[:, :, :] resp_mv = resp
-        np.float64_t[:, :, :] X_mv = X
-
-        int n, k, p, shift, d1, d2, p0
-        np.float64_t v
-
-    with nogil:
-        for n in range(N):
-            for k in range(K):
-                for p in range(P):
-                #p = 0
-                    for shift in range(P):
-                        p0 = permutations_mv[shift, p]
-                        #u = X[n, p0] - means[k, p0]
-                        v = resp[n, k, shift]
-                        tot_resp_mv[p] += v
-                        for d1 in range(D):
-                            for d2 in range(D):
-                                covars_mv[p, d1, d2] += v * \
-                                    (X_mv[n, p0, d1] - means_mv[k, p, d1]) * \
-                                    (X_mv[n, p0, d2] - means_mv[k, p, d2])
-
-    covars /= tot_resp[..., np.newaxis, np.newaxis]
-    return covars
-
-def calc_new_covar_diag(np.ndarray[ndim=3, dtype=np.float64_t] X,
-                            np.ndarray[ndim=3, dtype=np.float64_t] means,
-                            np.ndarray[ndim=3, dtype=np.float64_t] resp,
-                            np.ndarray[ndim=2, dtype=np.int64_t] permutations):
-    cdef:
-        int N = X.shape[0]
-        int D = X.shape[2]
-        int K = means.shape[0]
-        int P = permutations.shape[0]
-
-        np.ndarray[ndim=3, dtype=np.float64_t] covars = np.zeros((K, P, D))
-        np.ndarray[ndim=2, dtype=np.float64_t] tot_resp = np.zeros((K, P))
-
-        np.float64_t[:, :, :] covars_mv = covars
-        np.float64_t[:, :] tot_resp_mv = tot_resp
-        np.int64_t[:, :] permutations_mv = permutations
-        np.float64_t[:, :, :] means_mv = means
-        np.float64_t[:, :, :] resp_mv = resp
-        np.float64_t[:, :, :] X_mv = X
-
-        int n, k, p, shift, d1, d2, p0
-        np.float64_t v
-
-    with nogil:
-        for n in range(N):
-            for k in range(K):
-                for p in range(P):
-                    for shift in range(P):
-                        p0 = permutations_mv[shift, p]
-                        #u = X[n, p0] - means[k, p0]
-                        v = resp[n, k, shift]
-                        tot_resp_mv[k, p] += v
-                        for d in range(D):
-                            covars_mv[k, p, d] += v * \
-                                (X_mv[n, p0, d] - means_mv[k, p, d]) ** 2
-
-    covars /= tot_resp[..., np.newaxis]
-    return covars
-
-def calc_new_covar_diagperm(np.ndarray[ndim=3, dtype=np.float64_t] X,
-                            np.ndarray[ndim=3, dtype=np.float64_t] means,
-                            np.ndarray[ndim=3, dtype=np.float64_t] resp,
-                            np.ndarray[ndim=2, dtype=np.int64_t] permutations):
-    cdef:
-        int N = X.shape[0]
-        int D = X.shape[2]
-        int K = means.shape[0]
-        int P = permutations.shape[0]
-
-        np.ndarray[ndim=2, dtype=np.float64_t] covars = np.zeros((P, D))
-        np.ndarray[ndim=1, dtype=np.float64_t] tot_resp = np.zeros(P)
-
-        np.float64_t[:, :] covars_mv = covars
-        np.float64_t[:] tot_resp_mv = tot_resp
-        np.int64_t[:, :] permutations_mv = permutations
-        np.float64_t[:, :, :] means_mv = means
-        np.float64_t[:, :, :] resp_mv = resp
-        np.float64_t[:, :, :] X_mv = X
-
-        int n, k, p, shift, d1, d2, p0
-        np.float64_t v
-
-    with nogil:
-        for n in range(N):
-            for k in range(K):
-                for p in range(P):
-                    for shift in range(P):
-                        p0 = permutations_mv[shift, p]
-                        #u = X[n, p0] - means[k, p0]
-                        v = resp[n, k, shift]
-                        tot_resp_mv[p] += v
-                        for d in range(D):
-                            covars_mv[p, d] += v * \
-                                (X_mv[n, p0, d] - means_mv[k, p, d]) ** 2
-
-    covars /= tot_resp[..., np.newaxis]
-    return covars
@@ -1,12 +1,20 @@
 from __future__ import division, print_function, absolute_import 
 
+import numpy as np
 import amitgroup as ag
-from pnet.layer import Layer
+from pnet.layer import Layer, FeatureSpec
+from pnet.bitpack import PackedBits
 import pnet
 
 @Layer.register('edge-layer')
 class EdgeLayer(Layer):
-    def __init__(self, **kwargs):
+    """
+    Binary edges, using `amitgroup.features.bedges`. Keyword arguments are
+    passed on to it, except `packed`: if True, the edges are output as
+    `pnet.bitpack.PackedBits`, one bit per edge orientation.
+    """
+    def __init__(self, packed=False, **kwargs):
+        self._packed = packed
         self._edge_settings = kwargs 
 
     @property
@@ -20,17 +28,30 @@ class EdgeLayer(Layer):
         X = phi(data)
         if isinstance(X, list):
             return [ag.features.bedges(Xi, **self._edge_settings) for Xi in X]
+        elif self._packed:
+            return PackedBits.pack(ag.features.bedges(X, **self._edge_settings))
         else:
             return ag.features.bedges(X, **self._edge_settings)
 
+    def output_spec(self, input_spec):
+        shape = input_spec.shape[:2]
+        if not self._edge_settings.get('preserve_size', True):
+            shape = (shape[0] - 4, shape[1] - 4)
+        if self._edge_settings.get('contrast_insensitive', False):
+            n_edges = 4
+        else:
+            n_edges = 8
+        return FeatureSpec(shape + (n_edges,), np.uint8)
+
     def save_to_dict(self):
         d = {}
         d['edge_settings'] = self._edge_settings
+        d['packed'] = self._packed
         return d
 
     @classmethod
     def load_from_dict(cls, d):
-        obj = cls(**d['edge_settings'])       
+        obj = cls(packed=d.get('packed', False), **d['edge_settings'])
         return obj
 
     def __repr__(self):
@@ -0,0 +1,172 @@
+from __future__ import division, print_function, absolute_import
+
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from pnet.bitpack import PackedBits
+
+
+def _new_hash():
+    if hasattr(hashlib, 'blake2b'):
+        return hashlib.blake2b(digest_size=20)
+    else:
+        return hashlib.sha1()
+
+
+def _nbytes(x):
+    """Byte size of a layer output (arrays, or tuples/lists of them)."""
+    if isinstance(x, (np.ndarray, PackedBits)):
+        return x.nbytes
+    elif isinstance(x, (tuple, list)):
+        return sum(_nbytes(child) for child in x)
+    else:
+        return 0
+
+
+def digest(x):
+    """
+    Content digest of an array (or a tuple/list/dict of arrays and scalars).
+
+    The hash is computed directly on the array buffer, so contiguous arrays
+    are not copied. The shape and dtype are part of the digest, so arrays
+    with the same bytes but different layouts do not collide.
+    """
+    h = _new_hash()
+    _update(h, x)
+    return h.hexdigest()
+
+
+def fingerprint(x):
+    """
+    Digest of a configuration, such as the ``save_to_dict()`` of layers.
+
+    Unlike `digest`, this only accepts arrays, plain scalars, strings and
+    dtypes (and tuples/lists/dicts of them), which are hashed by value. Any
+    other object, such as a fitted estimator, raises a `TypeError`, since its
+    ``repr`` may leave out its state or hold a memory address.
+    """
+    h = _new_hash()
+    _update(h, x, strict=True)
+    return h.hexdigest()
+
+
+_PLAIN_TYPES = (type(None), bool, int, float, complex, str, bytes,
+                np.generic)
+
+
+def _update(h, x, strict=False):
+    if isinstance(x, np.ndarray):
+        if strict and x.dtype.hasobject:
+            raise TypeError('Cannot fingerprint object arrays')
+        h.update(repr((x.shape, x.dtype.str)).encode('ascii'))
+        if not x.flags.c_contiguous:
+            x = np.ascontiguousarray(x)
+        h.update(x.data)
+    elif isinstance(x, PackedBits):
+        h.update(b'PackedBits')
+        _update(h, (x.n_channels, x.dtype.str, x.bits), strict)
+    elif isinstance(x, (tuple, list)):
+        h.update(b'(')
+        for child in x:
+            _update(h, child, strict)
+        h.update(b')')
+    elif isinstance(x, dict):
+        h.update(b'{')
+        for k in sorted(x, key=repr):
+            _update(h, k, strict)
+            _update(h, x[k], strict)
+        h.update(b'}')
+    elif isinstance(x, np.dtype) or (isinstance(x, type) and
+                                     issubclass(x, np.generic)):
+        h.update(b'dtype')
+        h.update(np.dtype(x).str.encode('ascii'))
+    elif not strict or isinstance(x, _PLAIN_TYPES):
+        h.update(repr(x).encode('utf-8'))
+    else:
+        raise TypeError('Cannot fingerprint {} objects'.format(
+            type(x).__name__))
+
+
+class FeatureCache(object):
+    """
+    LRU cache of layer outputs shared by all the layers of a `PartsNet`.
+
+    Entries are keyed by ``(layer_index, digest(input))`` and evicted least
+    recently used first once the total size exceeds `max_bytes`. Cached
+    arrays are returned as is, so they should not be modified in place.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Upper limit on the total byte size of the cached outputs. An output
+        that is larger than this on its own is not cached.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, index, x, input_digest=None):
+        """
+        Key of the output of layer `index` for the input `x`. The digest of
+        `x` can be passed in as `input_digest` if it is already known.
+        """
+        if input_digest is None:
+            input_digest = digest(x)
+        return (index, input_digest)
+
+    def get(self, key):
+        """Returns the cached value, or None if it is not in the cache."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Mark as most recently used
+        del self._entries[key]
+        self._entries[key] = entry
+        return entry[0]
+
+    def put(self, key, value):
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._nbytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self._nbytes += size
+
+        while self._nbytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._nbytes -= evicted_size
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._nbytes = 0
+
+    def stats(self):
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    entries=len(self._entries),
+                    bytes=self.nbytes,
+                    max_bytes=self.max_bytes)
+
+    def __repr__(self):
+        return ('FeatureCache(entries={entries}, bytes={bytes}, '
+                'max_bytes={max_bytes}, hits={hits}, misses={misses})'
+                ).format(**self.stats())
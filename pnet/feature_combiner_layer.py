@@ -1,7 +1,7 @@
 from __future__ import division, print_function, absolute_import
 
 import numpy as np
-from pnet.layer import Layer
+from pnet.layer import Layer, FeatureSpec
 
 
 @Layer.register('feature-combiner-layer')
@@ -37,6 +37,14 @@ class FeatureCombinerLayer(Layer):
 
         return np.concatenate(features, axis=3)
 
+    def output_spec(self, input_spec):
+        specs = [layer.output_spec(input_spec) for layer in self._layers]
+        if any(spec is None or len(spec.shape) != 3 for spec in specs):
+            return None
+        shape = specs[0].shape[:2] + (sum(spec.shape[2] for spec in specs),)
+        dtype = np.result_type(*[spec.dtype for spec in specs])
+        return FeatureSpec(shape, dtype)
+
     def save_to_dict(self):
         d = {}
         d['layers'] = []
@@ -0,0 +1,110 @@
+from __future__ import division, print_function, absolute_import
+
+import os
+import json
+import numpy as np
+import amitgroup as ag
+from pnet.feature_cache import digest
+
+
+class FeatureStore(object):
+    """
+    On-disk store of layer outputs, read back as memory-mapped arrays.
+
+    Each entry is a ``.npy`` file keyed by a fingerprint of the layer
+    configuration (all layers up to and including the one that produced it)
+    and a digest of the input data. Outputs of batched extraction are stored
+    batch by batch, so a dataset ends up as a series of chunk files. Loading an
+    entry maps the file copy-on-write instead of reading it into memory.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store. It is created if it does not exist.
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, fingerprint, x, input_digest=None):
+        if input_digest is None:
+            input_digest = digest(x)
+        return digest((fingerprint, input_digest))
+
+    def _filename(self, key, ext):
+        return os.path.join(self.path, key + ext)
+
+    def __contains__(self, key):
+        return os.path.exists(self._filename(key, '.npy'))
+
+    def load(self, key):
+        """
+        Returns the stored output as a memory map (or a tuple with one, for
+        layers that output tuples), or None if it is not stored. The map is
+        copy-on-write, since the Cython kernels take writable buffers, so
+        writes to it never reach the file.
+        """
+        fn = self._filename(key, '.npy')
+        if not os.path.exists(fn):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        X = np.load(fn, mmap_mode='c')
+
+        meta_fn = self._filename(key, '.json')
+        if os.path.exists(meta_fn):
+            with open(meta_fn) as f:
+                rest = json.load(f)
+            return (X,) + tuple(rest)
+        else:
+            return X
+
+    def save(self, key, value):
+        """
+        Writes a layer output to the store. Tuple outputs are stored as the
+        array in the first element plus the remaining (scalar) elements.
+        Returns False if the output cannot be stored.
+        """
+        if isinstance(value, tuple):
+            X, rest = value[0], value[1:]
+            try:
+                rest = [r.item() if isinstance(r, np.generic) else r
+                        for r in rest]
+                meta = json.dumps(rest)
+            except (TypeError, ValueError):
+                return False
+        else:
+            X, meta = value, None
+
+        if not isinstance(X, np.ndarray):
+            return False
+
+        # Write to temporary files first, so that an interrupted write never
+        # leaves a truncated entry behind.
+        fn = self._filename(key, '.npy')
+        tmp_fn = self._filename(key, '.tmp.npy')
+        np.save(tmp_fn, X)
+        if meta is not None:
+            meta_fn = self._filename(key, '.json')
+            with open(meta_fn + '.tmp', 'w') as f:
+                f.write(meta)
+            os.rename(meta_fn + '.tmp', meta_fn)
+        os.rename(tmp_fn, fn)
+
+        ag.info('Stored features {} {}'.format(key[:12], X.shape))
+        return True
+
+    def clear(self):
+        for fn in os.listdir(self.path):
+            if fn.endswith('.npy') or fn.endswith('.json'):
+                os.remove(os.path.join(self.path, fn))
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses)
+
+    def __repr__(self):
+        return 'FeatureStore(path={!r})'.format(self.path)
@@ -22,6 +22,8 @@ class GMMClassificationLayer(SupervisedLayer):
                               max_covariance_samples=None,
                               uniform_weights=True,
                               standardize=False,
+                              distributed_em=False,
+                              parallel_restarts=False,
                              )
         for k, v in settings.items():
             if k not in self._settings:
@@ -129,7 +131,9 @@ class GMMClassificationLayer(SupervisedLayer):
                                 params='wmc',
                                 covariance_type=cov_type,
                                 covar_limit=covar_limit,
-                                target_entropy=te)
+                                target_entropy=te,
+                                distributed=self._settings['distributed_em'],
+                                parallel_restarts=self._settings['parallel_restarts'])
             print('Fitting')
             mm.fit(Xk)
             print('Done.')
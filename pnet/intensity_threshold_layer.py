@@ -2,7 +2,7 @@ from __future__ import division, print_function, absolute_import
 
 import amitgroup as ag
 import numpy as np
-from pnet.layer import Layer
+from pnet.layer import Layer, FeatureSpec
 
 @Layer.register('intensity-threshold-layer')
 class IntensityThresholdLayer(Layer):
@@ -13,6 +13,9 @@ class IntensityThresholdLayer(Layer):
         X = phi(data)
         return (X > 0.5).astype(np.uint8)[...,np.newaxis] 
 
+    def output_spec(self, input_spec):
+        return FeatureSpec(input_spec.shape + (1,), np.uint8)
+
     def save_to_dict(self):
         return dict(threshold=self._threshold) 
 
@@ -4,7 +4,7 @@ from scipy.special import logit
 import numpy as np
 import itertools as itr
 import amitgroup as ag
-from pnet.layer import Layer
+from pnet.layer import Layer, FeatureSpec, index_map_dtype
 import pnet
 
 
@@ -33,6 +33,7 @@ class KMeansPartsLayer(Layer):
                               standardize=True,
                               whiten=True,
                               coding='hard',
+                              index_dtype=None,
                               )
         self._extra = {}
 
@@ -58,6 +59,18 @@ class KMeansPartsLayer(Layer):
     def pos_matrix(self):
         return self.conv_pos_matrix(self._part_shape)
 
+    def output_spec(self, input_spec):
+        ps = self._part_shape
+        dim = (input_spec.shape[0]-ps[0]+1, input_spec.shape[1]-ps[1]+1)
+        n_features = self.num_parts + int(bool(self._settings['code_bkg']))
+
+        if self._settings['coding'] == 'hard':
+            dtype = index_map_dtype(n_features, self._settings['index_dtype'])
+            return FeatureSpec(dim + (1,), dtype, n_features)
+        else:
+            dtype = getattr(self, '_dtype', np.float64)
+            return FeatureSpec(dim + (n_features,), dtype)
+
     def _extract(self, phi, data):
         assert self.trained, "Must be trained before calling extract"
         X = phi(data)
@@ -75,7 +88,8 @@ class KMeansPartsLayer(Layer):
 
         coding = self._settings['coding']
         if coding == 'hard':
-            feature_map = np.empty((X.shape[0],) + dim, dtype=np.int64)
+            dtype = index_map_dtype(n_features, self._settings['index_dtype'])
+            feature_map = np.empty((X.shape[0],) + dim, dtype=dtype)
             feature_map[:] = bkg_part
 
             with ag.Timer('extracting'):
@@ -1,16 +1,72 @@
 from __future__ import division, print_function, absolute_import
 
+from collections import namedtuple
+import numpy as np
 from deepdish.util.saveable import SaveableRegistry
 import pnet
 
+
+class FeatureSpec(namedtuple('FeatureSpec', ['shape', 'dtype', 'n_features'])):
+    """
+    Shape (excluding the sample axis) and dtype of a layer output. Parts
+    layers output index maps as ``(index_map, n_features, ...)``, in which
+    case `n_features` is the number of features that the indices refer to.
+    Otherwise, it is None.
+    """
+    def __new__(cls, shape, dtype, n_features=None):
+        return super(FeatureSpec, cls).__new__(cls, tuple(shape),
+                                               np.dtype(dtype), n_features)
+
+    @property
+    def nbytes(self):
+        """Bytes per sample"""
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+
+def index_map_dtype(n_features, dtype=None):
+    """
+    Dtype of an index map referring to `n_features` features (with -1 for
+    positions that are not coded). Unless `dtype` is given, this is int16 if
+    the indices fit, otherwise int32.
+    """
+    if dtype is not None:
+        return np.dtype(dtype)
+    elif n_features < np.iinfo(np.int16).max:
+        return np.dtype(np.int16)
+    else:
+        return np.dtype(np.int32)
+
+
 @SaveableRegistry.root
 class Layer(SaveableRegistry):
+    # Whether `_extract` (and `_train`) can take `pnet.bitpack.PackedBits`
+    # from the layer below. If not, `PartsNet` unpacks them first.
+    accepts_packed = False
+
     def _train(self, phi, data, y=None):
         pass
 
     def _extract(self, phi, data):
         raise NotImplemented("Subclass and override to use")
 
+    def output_spec(self, input_spec):
+        """
+        Returns the `FeatureSpec` of the output of `_extract`, given the
+        `FeatureSpec` of its input, without running any data. Returns None if
+        the layer can not tell.
+        """
+        if self.classifier:
+            return FeatureSpec((), np.int64)
+        else:
+            return None
+
+    def working_nbytes(self, input_spec):
+        """
+        Bytes per sample of the temporaries that `_extract` needs on top of
+        its input and output.
+        """
+        return 0
+
     @property
     def trained(self):
         return True
@@ -4,8 +4,8 @@ import amitgroup as ag
 import pnet
 import itertools as itr
 
-def _test(Xs, ys, net, n_classes):
-    yhats = net.classify(Xs)
+def _test(Xs, ys, net_handle, n_classes):
+    yhats = net_handle.get().classify(Xs)
     return pnet.rescalc.confusion_matrix(ys, yhats, n_classes)
 
 def train_and_test(net, samples_per_class=None, seed=0, limit=None):
@@ -71,6 +71,9 @@ def train_and_test(net, samples_per_class=None, seed=0, limit=None):
 
     confusion_matrix = np.zeros((n_classes, n_classes))
 
+    # Sent to the workers once, instead of with every batch
+    net_handle = pnet.parallel.share(net)
+
     #from multiprocessing import Pool
     #p = Pool(4)
 
@@ -82,18 +85,11 @@ def train_and_test(net, samples_per_class=None, seed=0, limit=None):
 
         test_X = test_X.transpose(0, 2, 3, 1)
 
-        BATCHES = max(1, len(test_X) // 5000)
-
-        test_X_batches = np.array_split(test_X, BATCHES)
-        test_y_batches = np.array_split(test_y, BATCHES)
-
-        # Test
-        zipped = zip(test_X_batches, test_y_batches)
-        params = [tup+(net, n_classes) for tup in zipped]
-        #for i, conf in enumerate(p.starmap(_test, params)):
-        #for i, conf in enumerate(itr.starmap(_test, params)):
-        for i, conf in enumerate(pnet.parallel.starmap_unordered(_test,
-                                 params)):
+        # Test, in chunks sized by the scheduler
+        chunks = pnet.parallel.imap_chunks(_test, (test_X, test_y),
+                                           args=(net_handle, n_classes),
+                                           max_size=5000)
+        for i, conf in enumerate(chunks):
             corrects += np.trace(conf)
             total += np.sum(conf)
 
@@ -109,6 +105,8 @@ def train_and_test(net, samples_per_class=None, seed=0, limit=None):
         if limit is not None and total >= limit:
             break
 
+    pnet.parallel.unshare(net_handle)
+
     pr = corrects / total
     error_rate = 1.0 - pr
 
@@ -3,7 +3,7 @@ from __future__ import division, print_function, absolute_import
 import numpy as np
 import itertools as itr
 import amitgroup as ag
-from pnet.layer import Layer
+from pnet.layer import Layer, FeatureSpec, index_map_dtype
 import pnet
 import pnet.matrix
 from scipy import linalg
@@ -143,6 +143,9 @@ class OrientedGaussianPartsLayer(Layer):
                               whitening_epsilon=None,
                               min_count=5,
                               coding='hard',
+                              distributed_em=False,
+                              parallel_restarts=False,
+                              index_dtype=None,
                               )
         self._min_log_prob = np.log(0.0005)
         self._extra = {}
@@ -278,6 +281,23 @@ class OrientedGaussianPartsLayer(Layer):
         elif coding == 'raw':
             return logprob[:, np.newaxis] + log_resp
 
+    def output_spec(self, input_spec):
+        ps = self._part_shape
+        if self._settings['channel_mode'] == 'together':
+            C = 1
+        else:
+            C = input_spec.shape[-1]
+        dim = (input_spec.shape[0]-ps[0]+1, input_spec.shape[1]-ps[1]+1)
+
+        if self._settings['coding'] == 'hard':
+            n_features = self.num_parts * C
+            if self._settings['code_bkg']:
+                n_features += 1
+            dtype = index_map_dtype(n_features, self._settings['index_dtype'])
+            return FeatureSpec(dim + (C,), dtype, n_features)
+        else:
+            return FeatureSpec(dim + (self.num_parts * C,), np.float32)
+
     def _extract(self, phi, data):
         assert self.trained, "Must be trained before calling extract"
         X = phi(data)
@@ -303,7 +323,9 @@ class OrientedGaussianPartsLayer(Layer):
 
         coding = self._settings['coding']
         if coding == 'hard':
-            feature_map = -np.ones((X.shape[0],) + dim, dtype=np.int64)
+            n_features = self.num_parts * C + int(self._settings['code_bkg'])
+            dtype = index_map_dtype(n_features, self._settings['index_dtype'])
+            feature_map = -np.ones((X.shape[0],) + dim, dtype=dtype)
         elif coding == 'triangle':
             feature_map = np.zeros((X.shape[0],) + dim + (self.num_parts,), dtype=np.float32)
         elif coding in ('soft', 'raw'):
@@ -473,6 +495,8 @@ class OrientedGaussianPartsLayer(Layer):
                             covar_limit=covar_limit,
                             min_covar=self._settings['min_covariance'],
                             params='wmc',
+                            distributed=self._settings['distributed_em'],
+                            parallel_restarts=self._settings['parallel_restarts'],
                             )
 
         Xflat = raw_originals.reshape(raw_originals.shape[:2] + (-1,))
@@ -3,7 +3,8 @@ from __future__ import division, print_function, absolute_import
 import numpy as np
 import itertools as itr
 import amitgroup as ag
-from pnet.layer import Layer
+from pnet.layer import Layer, FeatureSpec, index_map_dtype
+from pnet.bitpack import PackedBits, unpack
 import pnet
 import pnet.matrix
 from amitgroup.plot import ImageGrid
@@ -23,12 +24,16 @@ def _extract_batch(im, settings, num_parts, num_orientations, part_shape,
               cum_im[:, :-ps[0], :-ps[1]])
 
     th = settings['threshold']
+    res = res.astype(index_map_dtype(num_parts, settings['index_dtype']))
     res[counts < th] = -1
     return res[..., np.newaxis]
 
 
 @Layer.register('oriented-parts-layer')
 class OrientedPartsLayer(Layer):
+    # Packed edges are scored directly (see `pnet.bitpack.PackedBits`)
+    accepts_packed = True
+
     def __init__(self, n_parts=1, n_orientations=1, part_shape=(6, 6),
                  settings={}):
         self._num_true_parts = n_parts
@@ -45,10 +50,16 @@ class OrientedPartsLayer(Layer):
                               min_count=20,
                               std_thresh=0.05,  # TODO: Temp
                               circular=False,
-                              mem_gb=4,
+                              index_dtype=None,
+                              distributed_em=False,
+                              parallel_restarts=False,
                               )
 
         for k, v in settings.items():
+            if k == 'mem_gb':
+                # Now a net-wide setting (see PartsNet), but older saved
+                # models still carry it.
+                continue
             if k not in self._settings:
                 raise ValueError("Unknown settings: {}".format(k))
             else:
@@ -80,29 +91,94 @@ class OrientedPartsLayer(Layer):
     def parts(self):
         return self._parts
 
-    def _extract(self, phi, data):
-        with ag.Timer('extract inside parts'):
-            im = phi(data)
-
-        # Guess an appropriate batch size.
-        output_shape = (im.shape[1] - self._part_shape[0] + 1,
-                        im.shape[2] - self._part_shape[1] + 1)
-
-        # The empirical factor adjusts the projected size with an empirically
-        # measured size.
-        empirical_factor = 2.0
-        bytesize = (self.num_parts * np.prod(output_shape) *
-                    np.dtype(self._dtype).itemsize * empirical_factor)
+    def _output_size(self, input_shape):
+        return (input_shape[0] - self._part_shape[0] + 1,
+                input_shape[1] - self._part_shape[1] + 1)
 
-        memory = self._settings['mem_gb'] * 1024**3
+    def output_spec(self, input_spec):
+        shape = self._output_size(input_spec.shape) + (1,)
+        dtype = index_map_dtype(self.num_parts, self._settings['index_dtype'])
+        return FeatureSpec(shape, dtype, self.num_parts)
 
-        print('data shape', data.shape)
-        print('output shape', output_shape)
-        print('num parts', self.num_parts)
+    def working_nbytes(self, input_spec):
+        # The convolution produces a score for every part at every position
+        # before taking the argmax.
+        dtype = getattr(self, '_dtype', np.float64)
+        return (self.num_parts * np.prod(self._output_size(input_spec.shape)) *
+                np.dtype(dtype).itemsize)
 
-        n_batches = int(bytesize * data.shape[0] / memory)
+    def _extract(self, phi, data):
+        with ag.Timer('extract inside parts'):
+            im = phi(data)
+        if isinstance(im, PackedBits):
+            return self._code_packed(im)
+        return self._code(phi, im)
+
+    def _bernoulli_terms(self):
+        """
+        The log odds of the parts, of shape ``part_shape + (E, num_parts)``,
+        and their constant terms, as taken by the coders of `pnet.cyfuncs`.
+        """
+        parts = self._parts.astype(np.float64)
+        logits = np.log(parts / (1 - parts)).transpose((1, 2, 3, 0)).copy()
+        rest = np.log(1 - parts).sum(1).sum(1).sum(1)
+        return logits, rest
+
+    def _code_packed(self, im):
+        """
+        Codes `PackedBits` edges with
+        `pnet.cyfuncs.packed_code_index_map_multi`, which reads the packed
+        bytes, instead of unpacking them for the convolution of `_code`.
+        """
+        from pnet.cyfuncs import packed_code_index_map_multi
+        logits, rest = self._bernoulli_terms()
+        feat = packed_code_index_map_multi(
+            np.ascontiguousarray(im.bits), logits, rest,
+            self._settings['threshold'],
+            index_dtype=self._settings['index_dtype'])
+        return (feat, self.num_parts, self._num_orientations)
 
-        print('n_batches', n_batches)
+    def _extract_pooled(self, phi, data, pooling):
+        """
+        Extracts features and pools them with `pooling` (a `PoolingLayer`),
+        without materializing the index map, using
+        `pnet.cyfuncs.code_index_map_pooling_multi` (or its packed version
+        for `PackedBits` edges). Falls back to coding and then pooling if the
+        input is not binary.
+        """
+        from pnet.cyfuncs import (code_index_map_pooling_multi,
+                                  packed_code_index_map_pooling_multi)
+        im = phi(data)
+        if isinstance(im, PackedBits):
+            code = packed_code_index_map_pooling_multi
+            im = im.bits
+        elif im.dtype == np.bool_:
+            code = code_index_map_pooling_multi
+            im = im.view(np.uint8)
+        elif im.dtype == np.uint8:
+            code = code_index_map_pooling_multi
+        else:
+            return pooling._pool_index_map(self._code(phi, im))
+
+        logits, rest = self._bernoulli_terms()
+        return code(np.ascontiguousarray(im),
+                    logits,
+                    rest,
+                    self._settings['threshold'],
+                    pooling.calc_shape(None),
+                    pooling.calc_strides(None),
+                    pooling._operation)
+
+    def _code(self, phi, im):
+        # Pick a batch size. The memory budget and the empirical factor
+        # (which adjusts the projected size with an empirically measured size)
+        # are net-wide settings.
+        memory, empirical_factor = pnet.parts_net.memory_budget(phi)
+        spec = FeatureSpec(im.shape[1:], im.dtype)
+        bytesize = self.working_nbytes(spec) * empirical_factor
+
+        # Largest chunk that fits in the memory budget
+        max_size = max(1, int(memory / max(bytesize, 1)))
 
         with ag.Timer('extract more'):
             sett = (self._settings,
@@ -113,15 +189,12 @@ class OrientedPartsLayer(Layer):
                     self._extract_func,
                     self._dtype)
 
-            if n_batches == 0:
+            if im.shape[0] <= max_size:
                 feat = _extract_batch(im, *sett)
             else:
-                im_batches = np.array_split(im, n_batches)
-
-                args = ((im_b,) + sett for im_b in im_batches)
-
-                res = pnet.parallel.starmap_unordered(_extract_batch, args)
-                feat = np.concatenate([batch for batch in res])
+                res = pnet.parallel.imap_chunks(_extract_batch, im, args=sett,
+                                                max_size=max_size)
+                feat = np.concatenate(list(res))
 
         return (feat, self.num_parts, self._num_orientations)
 
@@ -174,7 +247,9 @@ class OrientedPartsLayer(Layer):
                            n_iter=n_iter,
                            n_init=n_init,
                            random_state=seed,
-                           min_probability=min_prob)
+                           min_probability=min_prob,
+                           distributed=self._settings['distributed_em'],
+                           parallel_restarts=self._settings['parallel_restarts'])
 
         Xflat = raw_patches.reshape(raw_patches.shape[:2] + (-1,))
         mm.fit(Xflat)
@@ -272,7 +347,7 @@ class OrientedPartsLayer(Layer):
             sh_samples = all_data.shape[:2]
             sh_image = all_data.shape[2:]
 
-            all_X = phi(all_data.reshape((-1,) + sh_image))
+            all_X = unpack(phi(all_data.reshape((-1,) + sh_image)))
             all_X = all_X.reshape(sh_samples + all_X.shape[1:])
 
             X_shape = all_X.shape[2:4]
@@ -315,7 +390,7 @@ class OrientedPartsLayer(Layer):
         # Add matrices for the polarity flips too, if applicable
         matrices *= POL
 
-        E = phi(data[:1]).shape[-1]
+        E = unpack(phi(data[:1])).shape[-1]
 
         c = 0
 
@@ -364,7 +439,7 @@ class OrientedPartsLayer(Layer):
             sh_samples = all_data.shape[:2]
             sh_image = all_data.shape[2:]
 
-            all_X = phi(all_data.reshape((-1,) + sh_image))
+            all_X = unpack(phi(all_data.reshape((-1,) + sh_image)))
             all_X = all_X.reshape(sh_samples + all_X.shape[1:])
 
             X_shape = all_X.shape[2:4]
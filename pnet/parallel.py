@@ -1,10 +1,132 @@
 import sys
+import time
 import itertools as itr
 import numpy as np
+from pnet import shared_objects
+from pnet import chunking
+from pnet import telemetry
+from pnet.telemetry import last_stats, set_trace
 
-# Global set of workers - initialized when first called a map function
-_g_available_workers = None 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# Number of tasks sent to each worker that have not returned yet -
+# initialized when first called a map function
+_g_in_flight = None
 _g_initialized = False
+# Number of tasks each worker can have queued (see `configure`)
+_g_prefetch = 2
+# Marks the end of the workloads
+_END = object()
+
+# Arrays smaller than this are pickled with the rest of the message
+_MIN_BUFFER_BYTES = 4096
+# Tags of the buffers following a task (10) and a result (2)
+_TAG_TASK_BUFFER = 11
+_TAG_RESULT_BUFFER = 3
+
+class _ArrayRef(object):
+    """Placeholder for an array sent as a separate buffer"""
+    def __init__(self, index, shape, dtype):
+        self.index = index
+        self.shape = shape
+        self.dtype = dtype
+
+def _extract_arrays(x, arrays):
+    """
+    Replaces large arrays in `x` (and in the dicts, tuples and lists in it)
+    with `_ArrayRef` placeholders and adds the arrays to `arrays`. Subclasses
+    of the containers, such as named tuples, are pickled as they are.
+    """
+    if (isinstance(x, np.ndarray) and not x.dtype.hasobject and
+            x.nbytes >= _MIN_BUFFER_BYTES):
+        arrays.append(np.ascontiguousarray(x))
+        return _ArrayRef(len(arrays) - 1, x.shape, x.dtype.str)
+    elif type(x) is dict:
+        return {k: _extract_arrays(v, arrays) for k, v in x.items()}
+    elif type(x) is tuple:
+        return tuple(_extract_arrays(v, arrays) for v in x)
+    elif type(x) is list:
+        return [_extract_arrays(v, arrays) for v in x]
+    else:
+        return x
+
+def _insert_arrays(x, arrays):
+    if isinstance(x, _ArrayRef):
+        return arrays[x.index]
+    elif type(x) is dict:
+        return {k: _insert_arrays(v, arrays) for k, v in x.items()}
+    elif type(x) is tuple:
+        return tuple(_insert_arrays(v, arrays) for v in x)
+    elif type(x) is list:
+        return [_insert_arrays(v, arrays) for v in x]
+    else:
+        return x
+
+def _send(obj, dest, tag, buffer_tag, block=True):
+    """
+    Sends `obj` with the large arrays in it taken out and sent as raw
+    buffers (uppercase `Send`), so that they are not pickled.
+
+    Returns the number of bytes sent. With ``block=False``, the sends are
+    non-blocking and the requests and the arrays they send (which must be
+    kept alive until the requests complete) are returned as well.
+    """
+    from mpi4py import MPI
+    arrays = []
+    header = pickle.dumps(_extract_arrays(obj, arrays),
+                          protocol=pickle.HIGHEST_PROTOCOL)
+    msg = dict(header=header, n_arrays=len(arrays))
+    nbytes = len(header) + sum(X.nbytes for X in arrays)
+    if block:
+        MPI.COMM_WORLD.send(msg, dest=dest, tag=tag)
+        for X in arrays:
+            MPI.COMM_WORLD.Send([X, MPI.BYTE], dest=dest, tag=buffer_tag)
+        return nbytes
+    else:
+        requests = [MPI.COMM_WORLD.isend(msg, dest=dest, tag=tag)]
+        for X in arrays:
+            requests.append(MPI.COMM_WORLD.Isend([X, MPI.BYTE], dest=dest,
+                                                 tag=buffer_tag))
+        return requests, arrays, nbytes
+
+def _array_refs(x):
+    if isinstance(x, _ArrayRef):
+        yield x
+    elif type(x) is dict:
+        for v in x.values():
+            for ref in _array_refs(v):
+                yield ref
+    elif type(x) in (tuple, list):
+        for v in x:
+            for ref in _array_refs(v):
+                yield ref
+
+def _recv(source, tag, buffer_tag, status):
+    """
+    Receives a message sent with `_send`. Returns the object and the number
+    of bytes received. Messages sent with the lowercase `send` (such as the
+    kill code) are returned as they are, with None as the size.
+    """
+    from mpi4py import MPI
+    msg = MPI.COMM_WORLD.recv(source=source, tag=tag, status=status)
+    if not isinstance(msg, dict) or 'n_arrays' not in msg:
+        return msg, None
+
+    header = pickle.loads(msg['header'])
+    nbytes = len(msg['header'])
+
+    # Buffers from one sender arrive in the order they were sent
+    arrays = [None] * msg['n_arrays']
+    for ref in sorted(_array_refs(header), key=lambda ref: ref.index):
+        X = np.empty(ref.shape, dtype=ref.dtype)
+        MPI.COMM_WORLD.Recv([X, MPI.BYTE], source=status.source,
+                            tag=buffer_tag)
+        arrays[ref.index] = X
+        nbytes += X.nbytes
+    return _insert_arrays(header, arrays), nbytes
 
 def kill_workers():
     from mpi4py import MPI
@@ -13,85 +135,304 @@ def kill_workers():
         MPI.COMM_WORLD.send(None, dest=worker, tag=666)
 
 def _init():
-    global _g_available_workers, _g_initialized
+    global _g_in_flight, _g_initialized
     from mpi4py import MPI
     import atexit
-    _g_available_workers = set(range(1, MPI.COMM_WORLD.Get_size()))
+    _g_in_flight = dict.fromkeys(range(1, MPI.COMM_WORLD.Get_size()), 0)
     _g_initialized = True
     atexit.register(kill_workers)
 
-def imap_unordered(f, workloads, star=False):
-    global _g_available_workers, _g_initialized
+def configure(prefetch=None):
+    """
+    Changes the settings of the scheduler:
+
+    prefetch : int
+        Number of tasks each worker can have queued, including the one it is
+        working on. With more than one, a worker can start on its next task
+        as soon as it is done, instead of waiting for the master to receive
+        the result and send a new task.
+    """
+    global _g_prefetch
+    if prefetch is not None:
+        _g_prefetch = max(1, prefetch)
+
+def share(obj):
+    """
+    Sends `obj` to every worker once and keeps it there. Returns a handle
+    that can be passed to tasks in place of `obj`; the task gets the object
+    back with ``handle.get()``.
+
+    The object is pickled once and sent as a raw buffer. Call this between
+    maps, not while one is running.
+    """
+    key = shared_objects.new_key()
+    shared_objects.register(key, obj)
+    if _g_initialized:
+        from mpi4py import MPI
+        data = np.frombuffer(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL),
+                             dtype=np.uint8)
+        for worker in range(1, MPI.COMM_WORLD.Get_size()):
+            _send(dict(key=key, data=data), worker, 20, _TAG_TASK_BUFFER)
+    return shared_objects.Handle(key)
+
+def unshare(handle):
+    """Frees an object shared with `share` on all processes"""
+    shared_objects.release(handle.key)
+    if _g_initialized:
+        from mpi4py import MPI
+        for worker in range(1, MPI.COMM_WORLD.Get_size()):
+            MPI.COMM_WORLD.send(handle.key, dest=worker, tag=21)
+
+def scatter(X):
+    """
+    Splits `X` along axis 0 into one shard per worker and sends each shard
+    to its worker only, where it is kept. Returns a list of handles, one per
+    shard, to be used with `map_shards` and freed with `unshare`.
+    """
+    N = _n_workers()
+    if N == 0:
+        return [share(X)]
+
+    handles = []
+    for rank, shard in zip(range(1, N + 1), np.array_split(X, N)):
+        key = shared_objects.new_key()
+        data = np.frombuffer(pickle.dumps(shard,
+                                          protocol=pickle.HIGHEST_PROTOCOL),
+                             dtype=np.uint8)
+        _send(dict(key=key, data=data), rank, 20, _TAG_TASK_BUFFER)
+        handles.append(shared_objects.Handle(key, worker=rank))
+    return handles
+
+def map_shards(f, handles, args=()):
+    """
+    Calls ``f(handle, *args)`` for each handle from `scatter` on the worker
+    that holds its shard, and returns the results in the same order. `args`
+    is sent to every worker, so it should be small compared to the shards.
+    """
+    from mpi4py import MPI
+    if _n_workers() == 0:
+        return [f(handle, *args) for handle in handles]
+
+    stats = telemetry.MapStats('mpi', len(_g_in_flight))
+    sends = {}
+    results = [None] * len(handles)
+    try:
+        for job_index, handle in enumerate(handles):
+            task = dict(func=f, input_data=(handle,) + tuple(args),
+                        job_index=job_index, unpack=True)
+            requests, arrays, nbytes = _send(task, handle.worker, 10,
+                                             _TAG_TASK_BUFFER, block=False)
+            sends[job_index] = (requests, arrays)
+            stats.sent(job_index, handle.worker, nbytes)
+            _g_in_flight[handle.worker] += 1
+
+        while sends:
+            status = MPI.Status()
+            ret, nbytes = _recv(MPI.ANY_SOURCE, 2, _TAG_RESULT_BUFFER, status)
+            _g_in_flight[status.source] -= 1
+            MPI.Request.Waitall(sends.pop(ret['job_index'])[0])
+            stats.received(ret['job_index'], status.source, ret['seconds'],
+                           nbytes)
+            results[ret['job_index']] = ret['output_data']
+    finally:
+        stats.finish()
+    return results
+
+class _Iterate(object):
+    """Hands out the workloads of an iterable in order"""
+    def __init__(self, workloads):
+        self.workloads = iter(workloads)
 
+    def next(self, rank):
+        return next(self.workloads, _END)
+
+    def done(self, rank, job_index, seconds):
+        pass
+
+class _Chunks(object):
+    """Hands out chunks of arrays, sized for the worker they are sent to"""
+    def __init__(self, arrays, args, chunker):
+        self.arrays = arrays
+        self.args = tuple(args)
+        self.chunker = chunker
+        self.sizes = {}
+        self.job_index = 0
+
+    def next(self, rank):
+        sl = self.chunker.next(rank)
+        if sl is None:
+            return _END
+        self.sizes[self.job_index] = sl.stop - sl.start
+        self.job_index += 1
+        return chunking.chunk(self.arrays, sl) + self.args
+
+    def done(self, rank, job_index, seconds):
+        self.chunker.record(rank, self.sizes.pop(job_index), seconds)
+
+def _free_worker():
+    """Returns the least busy worker that can take another task, or None"""
+    rank = min(_g_in_flight, key=_g_in_flight.get)
+    if _g_in_flight[rank] < _g_prefetch:
+        return rank
+    else:
+        return None
+
+def _schedule(f, source, star, ordered, window):
+    """
+    Sends the workloads of `source` off to the workers, keeping up to
+    `_g_prefetch` tasks queued per worker, and yields the results. If
+    `ordered`, at most `window` jobs, counted from the oldest result not yet
+    yielded, are sent off or waiting to be yielded at a time.
+    """
     from mpi4py import MPI
-    N = MPI.COMM_WORLD.Get_size() - 1
-    if N == 0 or not _g_initialized:
+
+    stats = telemetry.MapStats('mpi', len(_g_in_flight))
+    # Results that arrived before the ones preceding them, by job index
+    waiting = {}
+    # Send requests of the tasks that have not returned, by job index
+    sends = {}
+    next_index = 0
+    job_index = 0
+    exhausted = False
+
+    try:
+        while True:
+            while not exhausted and (not ordered or
+                                     job_index - next_index < window):
+                dest_rank = _free_worker()
+                if dest_rank is None:
+                    break
+                workload = source.next(dest_rank)
+                if workload is _END:
+                    exhausted = True
+                    break
+
+                # Send off job. The sends do not block, since the worker may
+                # be busy with a task whose result we need to receive first.
+                task = dict(func=f, input_data=workload, job_index=job_index,
+                            unpack=star)
+                requests, arrays, nbytes = _send(task, dest_rank, 10,
+                                                 _TAG_TASK_BUFFER, block=False)
+                sends[job_index] = (requests, arrays)
+                stats.sent(job_index, dest_rank, nbytes)
+                _g_in_flight[dest_rank] += 1
+                job_index += 1
+
+            if not sends:
+                # Nothing in flight, so everything sent off has been yielded
+                break
+
+            # Wait to receive results
+            status = MPI.Status()
+            ret, nbytes = _recv(MPI.ANY_SOURCE, 2, _TAG_RESULT_BUFFER, status)
+            _g_in_flight[status.source] -= 1
+            # The worker received the task, so the sends are complete
+            MPI.Request.Waitall(sends.pop(ret['job_index'])[0])
+            stats.received(ret['job_index'], status.source, ret['seconds'],
+                           nbytes)
+            source.done(status.source, ret['job_index'], ret['seconds'])
+
+            if ordered:
+                waiting[ret['job_index']] = ret['output_data']
+                while next_index in waiting:
+                    yield waiting.pop(next_index)
+                    next_index += 1
+            else:
+                yield ret['output_data']
+    finally:
+        # If the consumer stops early, the outstanding results are received
+        # and dropped, so that they are not mistaken for those of the next map
+        while sends:
+            status = MPI.Status()
+            ret, nbytes = _recv(MPI.ANY_SOURCE, 2, _TAG_RESULT_BUFFER, status)
+            _g_in_flight[status.source] -= 1
+            MPI.Request.Waitall(sends.pop(ret['job_index'])[0])
+            stats.received(ret['job_index'], status.source, ret['seconds'],
+                           nbytes)
+        stats.finish()
+
+def _n_workers():
+    if not _g_initialized:
+        return 0
+    from mpi4py import MPI
+    return MPI.COMM_WORLD.Get_size() - 1
+
+def imap_unordered(f, workloads, star=False):
+    if _n_workers() == 0:
         mapf = [map, itr.starmap][star]
         for res in mapf(f, workloads):
             yield res
         return
-     
-    for job_index, workload in enumerate(itr.chain(workloads, itr.repeat(None))):
-        if workload is None and len(_g_available_workers) == N:
-            break
 
-        while not _g_available_workers or workload is None:
-            # Wait to receive results
-            status = MPI.Status()
-            ret = MPI.COMM_WORLD.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
-            if status.tag == 2:
-                yield ret['output_data']
-                _g_available_workers.add(status.source)
-                if len(_g_available_workers) == N:
-                    break
+    for res in _schedule(f, _Iterate(workloads), star, False, None):
+        yield res
 
-        if _g_available_workers and workload is not None:
-            dest_rank = _g_available_workers.pop()
+def imap(f, workloads, star=False, window=None):
+    """
+    Ordered map over the workers. Each result is yielded as soon as it and
+    all results before it have arrived.
 
-            # Send off job
-            task = dict(func=f, input_data=workload, job_index=job_index, unpack=star)
-            MPI.COMM_WORLD.send(task, dest=dest_rank, tag=10)
+    Parameters
+    ----------
+    window : int
+        Maximum number of jobs, counted from the oldest result not yet
+        yielded, that can be sent off or waiting to be yielded. This bounds
+        the memory held by results that arrive out of order. Defaults to
+        twice the number of tasks that can be queued on the workers.
 
-def imap(f, workloads, star=False):
-    global _g_available_workers, _g_initialized
-    from mpi4py import MPI
-    N = MPI.COMM_WORLD.Get_size() - 1
-    if N == 0 or not _g_initialized:
+    `workloads` is consumed lazily, as workers become available. While the
+    consumer is busy with a result, no new jobs are sent off.
+    """
+    N = _n_workers()
+    if N == 0:
         mapf = [map, itr.starmap][star]
         for res in mapf(f, workloads):
             yield res
         return
 
-    results = []
-    indices = []
+    if window is None:
+        window = 2 * _g_prefetch * N
 
-    for job_index, workload in enumerate(itr.chain(workloads, itr.repeat(None))):
-        if workload is None and len(_g_available_workers) == N:
-            break
+    for res in _schedule(f, _Iterate(workloads), star, True, window):
+        yield res
 
-        while not _g_available_workers or workload is None:
-            # Wait to receive results
-            status = MPI.Status()
-            ret = MPI.COMM_WORLD.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
-            if status.tag == 2:
-                results.append(ret['output_data'])
-                indices.append(ret['job_index'])
-                _g_available_workers.add(status.source)
-                if len(_g_available_workers) == N:
-                    break
+def imap_chunks(f, arrays, args=(), target_seconds=0.5, max_size=None,
+                window=None):
+    """
+    Splits `arrays` into chunks along axis 0, calls ``f(*chunks + args)``
+    on each and yields the results in order.
+
+    The chunk sizes adapt to the time each worker takes per sample (see
+    `pnet.chunking.Chunker`), so tiny tasks are merged and slow workers get
+    smaller pieces.
 
-        if _g_available_workers and workload is not None:
-            dest_rank = _g_available_workers.pop()
+    Parameters
+    ----------
+    arrays : ndarray or tuple of ndarray
+        Arrays of the same length, chunked together.
+    args : tuple
+        Further arguments, passed to each call as they are.
+    target_seconds : float
+        Desired time per chunk.
+    max_size : int or None
+        Upper limit of the chunk size, for instance from a memory budget.
+    """
+    arrays = chunking.as_arrays(arrays)
+    N = _n_workers()
+    if N == 0:
+        for res in chunking.serial_chunks(f, arrays, args, max_size=max_size):
+            yield res
+        return
 
-            # Send off job
-            task = dict(func=f, input_data=workload, job_index=job_index, unpack=star)
-            MPI.COMM_WORLD.send(task, dest=dest_rank, tag=10)
+    if window is None:
+        window = 2 * _g_prefetch * N
 
-    #print results, indices
-    #return results[indices]
-    II = np.argsort(indices)  
-    for i in II:
-        yield results[i]
+    chunker = chunking.Chunker(len(arrays[0]), N,
+                               target_seconds=target_seconds,
+                               max_size=max_size)
+    source = _Chunks(arrays, args, chunker)
+    for res in _schedule(f, source, True, True, window):
+        yield res
 
 def starmap(f, workloads):
     return imap(f, workloads, star=True)
@@ -103,18 +444,29 @@ def worker():
     from mpi4py import MPI
     while True:
         status = MPI.Status()
-        ret = MPI.COMM_WORLD.recv(source=0, tag=MPI.ANY_TAG, status=status) 
+        ret, _ = _recv(0, MPI.ANY_TAG, _TAG_TASK_BUFFER, status)
 
         if status.tag == 10:
             # Workload received
             func = ret['func']
+            t0 = time.time()
             if ret.get('unpack'):
                 res = func(*ret['input_data'])
             else:
                 res = func(ret['input_data'])
+            seconds = time.time() - t0
 
             # Done, let's send it back
-            MPI.COMM_WORLD.send(dict(job_index=ret['job_index'], output_data=res), dest=0, tag=2)
+            _send(dict(job_index=ret['job_index'], output_data=res,
+                       seconds=seconds), 0, 2, _TAG_RESULT_BUFFER)
+
+        elif status.tag == 20:
+            # Shared object received
+            obj = pickle.loads(ret['data'].tobytes())
+            shared_objects.register(ret['key'], obj)
+
+        elif status.tag == 21:
+            shared_objects.release(ret)
 
         elif status.tag == 666:
             # Kill code
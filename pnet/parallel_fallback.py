@@ -1,11 +1,39 @@
 import sys
 import itertools as itr
 import numpy as np
+from pnet import shared_objects
+from pnet import chunking
+from pnet.telemetry import last_stats, set_trace
 
-imap_unordered = itr.imap
-imap = itr.imap
+try:
+    from itertools import imap as _imap
+except ImportError:
+    _imap = map
+
+def imap(f, workloads, window=None):
+    return _imap(f, workloads)
+
+imap_unordered = _imap
 starmap_unordered = itr.starmap
 starmap = itr.starmap
 
+def imap_chunks(f, arrays, args=(), target_seconds=0.5, max_size=None,
+                window=None):
+    return chunking.serial_chunks(f, arrays, args, max_size=max_size)
+
 def main(name=None):
     return name == '__main__'
+
+def share(obj):
+    key = shared_objects.new_key()
+    shared_objects.register(key, obj)
+    return shared_objects.Handle(key)
+
+def unshare(handle):
+    shared_objects.release(handle.key)
+
+def scatter(X):
+    return [share(X)]
+
+def map_shards(f, handles, args=()):
+    return [f(handle, *args) for handle in handles]
@@ -0,0 +1,576 @@
+"""
+Process pool backend for `pnet.parallel`, for running on the cores of a
+single machine without MPI. Select it with the environment variable
+``PNET_PARALLEL=local`` or `pnet.use_parallel_backend('local')`.
+
+Large arrays in the arguments and results are passed through shared memory
+instead of being pickled. As with MPI, the mapped function and its
+arguments must otherwise be picklable.
+"""
+from __future__ import division, print_function, absolute_import
+
+import os
+import sys
+import time
+import atexit
+import collections
+import multiprocessing
+import itertools as itr
+import numpy as np
+from pnet import shared_objects
+from pnet import chunking
+from pnet import telemetry
+from pnet.telemetry import last_stats, set_trace
+from pnet.feature_cache import _nbytes
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+_g_settings = dict(n_workers=None,
+                   prefetch=2,
+                   shared_min_bytes=1024**2,
+                   )
+_g_pool = None
+# Shared memory blocks of the objects shared with `share`, by key
+_g_shared_blocks = {}
+# Shared memory blocks that shared objects and shards were loaded from (in
+# the workers), with the array mapped from the block (None for pickles) and
+# the keys of the objects
+_g_attached = {}
+
+
+def configure(**settings):
+    """
+    Changes the settings of the backend:
+
+    n_workers : int or None
+        Number of worker processes. Defaults to the environment variable
+        ``PNET_WORKERS``, or else the number of CPUs. With one worker, tasks
+        run serially in this process.
+    prefetch : int
+        Number of tasks per worker submitted to the pool ahead of time.
+    shared_min_bytes : int
+        Arrays of at least this size are passed through shared memory.
+    """
+    for k, v in settings.items():
+        if k not in _g_settings:
+            raise ValueError("Unknown settings: {}".format(k))
+        else:
+            _g_settings[k] = v
+
+    # The pool is recreated with the new settings when it is next needed
+    _shutdown()
+
+
+def n_workers():
+    n = _g_settings['n_workers']
+    if n is None:
+        n = int(os.environ.get('PNET_WORKERS', multiprocessing.cpu_count()))
+    return n
+
+
+def _get_pool():
+    global _g_pool
+    if _g_pool is None and n_workers() > 1:
+        # The workers share the resource tracker of this process only if it
+        # is running when they start. Otherwise each starts its own, which
+        # would unlink the blocks of this process when the worker exits.
+        _start_resource_tracker()
+        _g_pool = multiprocessing.Pool(n_workers(), initializer=_init_worker)
+    return _g_pool
+
+
+def _init_worker():
+    # Forked workers inherit the objects shared so far. They are dropped, so
+    # that the workers load them from their blocks like the objects shared
+    # later, and drop them again after `unshare` (see `_detach_unshared`).
+    shared_objects.clear()
+    _g_attached.clear()
+
+
+def _shutdown():
+    global _g_pool
+    if _g_pool is not None:
+        _g_pool.terminate()
+        _g_pool.join()
+        _g_pool = None
+
+
+def _unlink_shared_objects():
+    for key in list(_g_shared_blocks):
+        shm = _g_shared_blocks.pop(key)
+        shm.close()
+        shm.unlink()
+
+atexit.register(_shutdown)
+atexit.register(_unlink_shared_objects)
+
+
+class _SharedArray(object):
+    """Picklable reference to an array in shared memory"""
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    @classmethod
+    def create(cls, X):
+        shm = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+        Y = np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)
+        Y[...] = X
+        del Y
+        return cls(shm.name, X.shape, X.dtype.str), shm
+
+    def attach(self):
+        shm = shared_memory.SharedMemory(name=self.name)
+        X = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+        return X, shm
+
+
+def _start_resource_tracker():
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+    except (ImportError, AttributeError):
+        pass
+
+
+def _untrack(shm):
+    """
+    Stops the resource tracker from unlinking `shm` at exit. Used in the
+    workers for the blocks of their results, which the main process unlinks
+    once it has copied them.
+    """
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except (ImportError, AttributeError):
+        pass
+
+
+class _SharedPickle(object):
+    """Pickled object in shared memory, loaded by the workers on first use"""
+    def __init__(self, name, size, key):
+        self.name = name
+        self.size = size
+        self.key = key
+
+    def load(self):
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            obj = pickle.loads(bytes(shm.buf[:self.size]))
+        finally:
+            shm.close()
+        # Only the key is kept, so that the object is dropped once the block
+        # is unshared (see `_detach_unshared`)
+        _g_attached.setdefault(self.name, (None, None, set()))[2].add(self.key)
+        return obj
+
+
+class _SharedShard(object):
+    """Rows of an array in shared memory, loaded by the workers on first use"""
+    def __init__(self, ref, start, stop, key):
+        self.ref = ref
+        self.start = start
+        self.stop = stop
+        self.key = key
+
+    def load(self):
+        # The block is mapped once per process and stays mapped until it is
+        # unshared (see `_detach_unshared`), since the shards are views into it
+        if self.ref.name not in _g_attached:
+            X, shm = self.ref.attach()
+            _g_attached[self.ref.name] = (X, shm, set())
+        X, shm, keys = _g_attached[self.ref.name]
+        keys.add(self.key)
+        return X[self.start:self.stop]
+
+
+def _detach_unshared(live):
+    """
+    Drops the objects and shards loaded from blocks that are no longer
+    shared, given the names of the `live` blocks of the main process, and
+    unmaps the blocks.
+    """
+    for name in list(_g_attached):
+        if name not in live:
+            X, shm, keys = _g_attached.pop(name)
+            for key in keys:
+                shared_objects.release(key)
+            del X
+            if shm is not None:
+                _close([shm])
+
+
+class _Pickle(object):
+    """Used in place of `_SharedPickle` without shared memory"""
+    def __init__(self, data):
+        self.data = data
+
+    def load(self):
+        return pickle.loads(self.data)
+
+
+class _Failure(object):
+    """An exception raised in a worker"""
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class _Result(object):
+    """Encoded result of a task, with the time it took and where it ran"""
+    def __init__(self, data, seconds, worker):
+        self.data = data
+        self.seconds = seconds
+        self.worker = worker
+
+
+def _encode(x, shms):
+    """
+    Replaces large arrays in `x` (or in the tuples and lists in it) with
+    shared memory references. The shared memory blocks are added to `shms`.
+    """
+    if (isinstance(x, np.ndarray) and shared_memory is not None and
+            x.dtype.hasobject is False and
+            x.nbytes >= _g_settings['shared_min_bytes']):
+        ref, shm = _SharedArray.create(x)
+        shms.append(shm)
+        return ref
+    elif isinstance(x, tuple):
+        return tuple(_encode(child, shms) for child in x)
+    elif isinstance(x, list):
+        return [_encode(child, shms) for child in x]
+    else:
+        return x
+
+
+def _decode(x, shms):
+    """
+    Inverse of `_encode`. The arrays are views into the shared memory
+    blocks, which are added to `shms`.
+    """
+    if isinstance(x, _SharedArray):
+        X, shm = x.attach()
+        shms.append(shm)
+        return X
+    elif isinstance(x, tuple):
+        return tuple(_decode(child, shms) for child in x)
+    elif isinstance(x, list):
+        return [_decode(child, shms) for child in x]
+    else:
+        return x
+
+
+def _close(shms, unlink=False):
+    for shm in shms:
+        try:
+            shm.close()
+        except BufferError:
+            # Something still holds a view. The block is unmapped once that
+            # is garbage collected.
+            pass
+        if unlink:
+            shm.unlink()
+
+
+def _copy_arrays(x):
+    if isinstance(x, np.ndarray):
+        return x.copy()
+    elif isinstance(x, tuple):
+        return tuple(_copy_arrays(child) for child in x)
+    elif isinstance(x, list):
+        return [_copy_arrays(child) for child in x]
+    else:
+        return x
+
+
+def _run_task(f, encoded_input, star, live):
+    # Runs in the worker
+    input_shms = []
+    try:
+        _detach_unshared(live)
+        input_data = _decode(encoded_input, input_shms)
+        t0 = time.time()
+        if star:
+            res = f(*input_data)
+        else:
+            res = f(input_data)
+        seconds = time.time() - t0
+        del input_data
+
+        output_shms = []
+        # Small results may be views into the inputs, which are unmapped
+        # below, so they are copied before being pickled
+        ret = _copy_arrays(_encode(res, output_shms))
+        del res
+        # The main process unlinks these once it has copied the results
+        for shm in output_shms:
+            _untrack(shm)
+        _close(output_shms)
+        return _Result(ret, seconds, os.getpid())
+    except Exception:
+        return _Failure(sys.exc_info()[1])
+    finally:
+        _close(input_shms)
+
+
+def _receive(ret, stats, job_index):
+    if isinstance(ret, _Failure):
+        raise ret.exc
+    shms = []
+    try:
+        res = _copy_arrays(_decode(ret.data, shms))
+    finally:
+        _close(shms, unlink=True)
+    stats.received(job_index, ret.worker, ret.seconds, _nbytes(res))
+    return res
+
+
+def _discard(ret):
+    """Frees the shared memory of a result that will not be used"""
+    if not isinstance(ret, _Failure):
+        shms = []
+        _decode(ret.data, shms)
+        _close(shms, unlink=True)
+
+
+def _submit(pool, f, workload, star, stats, job_index, callback=None):
+    stats.sent(job_index, None, _nbytes(workload))
+    shms = []
+    encoded = _encode(workload, shms)
+    kwargs = {}
+    if callback is not None:
+        kwargs['callback'] = callback
+        if sys.version_info >= (3,):
+            # Failures to pickle the task or its result end up here
+            kwargs['error_callback'] = lambda exc: callback(_Failure(exc))
+    # The workers unmap the blocks of unshared shards when they see that they
+    # are no longer in this list
+    live = frozenset(shm.name for shm in _g_shared_blocks.values())
+    async_result = pool.apply_async(_run_task, (f, encoded, star, live),
+                                    **kwargs)
+    return async_result, shms
+
+
+def imap(f, workloads, star=False, window=None):
+    """
+    Ordered map over the pool. At most `window` jobs (by default `prefetch`
+    per worker) are sent off or waiting to be yielded at a time.
+    """
+    pool = _get_pool()
+    if pool is None:
+        mapf = [map, itr.starmap][star]
+        for res in mapf(f, workloads):
+            yield res
+        return
+
+    # Tasks are submitted as results are consumed, so that only a bounded
+    # number of inputs (and their shared memory) are alive at a time.
+    max_pending = window or _g_settings['prefetch'] * n_workers()
+    stats = telemetry.MapStats('local', n_workers())
+    pending = collections.deque()
+
+    def receive_one():
+        job_index, (async_result, shms) = pending.popleft()
+        try:
+            ret = async_result.get()
+        finally:
+            _close(shms, unlink=True)
+        return _receive(ret, stats, job_index)
+
+    try:
+        for job_index, workload in enumerate(workloads):
+            pending.append((job_index, _submit(pool, f, workload, star, stats,
+                                               job_index)))
+            if len(pending) >= max_pending:
+                yield receive_one()
+
+        while pending:
+            yield receive_one()
+    finally:
+        # Reached with tasks pending if the consumer stops early or a task
+        # fails
+        for job_index, (async_result, shms) in pending:
+            async_result.wait()
+            _close(shms, unlink=True)
+            if async_result.successful():
+                _discard(async_result.get())
+        stats.finish()
+
+
+def imap_unordered(f, workloads, star=False):
+    pool = _get_pool()
+    if pool is None:
+        mapf = [map, itr.starmap][star]
+        for res in mapf(f, workloads):
+            yield res
+        return
+
+    max_pending = _g_settings['prefetch'] * n_workers()
+    stats = telemetry.MapStats('local', n_workers())
+    done = queue.Queue()
+    pending = {}
+
+    def receive_one():
+        job_index, ret = done.get()
+        _close(pending.pop(job_index), unlink=True)
+        return _receive(ret, stats, job_index)
+
+    try:
+        for job_index, workload in enumerate(workloads):
+            callback = (lambda ret, job_index=job_index:
+                        done.put((job_index, ret)))
+            _, shms = _submit(pool, f, workload, star, stats, job_index,
+                              callback=callback)
+            pending[job_index] = shms
+            if len(pending) >= max_pending:
+                yield receive_one()
+
+        while pending:
+            yield receive_one()
+    finally:
+        while pending:
+            job_index, ret = done.get()
+            _close(pending.pop(job_index), unlink=True)
+            _discard(ret)
+        stats.finish()
+
+
+def imap_chunks(f, arrays, args=(), target_seconds=0.5, max_size=None,
+                window=None):
+    """
+    Splits `arrays` into chunks along axis 0, calls ``f(*chunks + args)``
+    on each and yields the results in order. See `pnet.parallel.imap_chunks`.
+
+    The pool does not tell which worker ran a task, so the chunk sizes adapt
+    to the average time per sample over all workers.
+    """
+    arrays = chunking.as_arrays(arrays)
+    if _get_pool() is None:
+        for res in chunking.serial_chunks(f, arrays, args, max_size=max_size):
+            yield res
+        return
+
+    chunker = chunking.Chunker(len(arrays[0]), n_workers(),
+                               target_seconds=target_seconds,
+                               max_size=max_size)
+    sizes = collections.deque()
+
+    def workloads():
+        while True:
+            sl = chunker.next()
+            if sl is None:
+                return
+            sizes.append(sl.stop - sl.start)
+            yield (f,) + chunking.chunk(arrays, sl) + tuple(args)
+
+    for seconds, res in imap(chunking.timed_call, workloads(), star=True,
+                             window=window):
+        chunker.record(None, sizes.popleft(), seconds)
+        yield res
+
+
+def share(obj):
+    """
+    Makes `obj` available to the workers without sending it with every task.
+    Returns a handle that can be passed to tasks in place of `obj`; the task
+    gets the object back with ``handle.get()``.
+
+    The object is pickled once into shared memory, and each worker loads it
+    the first time it uses the handle. Arrays are copied into shared memory
+    as they are instead, and the workers map them without a copy, as with
+    `scatter`. After `unshare`, each worker drops its copy, or unmaps the
+    array, at its next task.
+    """
+    key = shared_objects.new_key()
+    shared_objects.register(key, obj)
+    if (shared_memory is not None and isinstance(obj, np.ndarray) and
+            obj.ndim > 0 and not obj.dtype.hasobject):
+        X = np.ascontiguousarray(obj)
+        ref, shm = _SharedArray.create(X)
+        _g_shared_blocks[key] = shm
+        return shared_objects.Handle(key,
+                                     source=_SharedShard(ref, 0, len(X), key))
+
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    if shared_memory is not None:
+        shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        shm.buf[:len(data)] = data
+        _g_shared_blocks[key] = shm
+        source = _SharedPickle(shm.name, len(data), key)
+    else:
+        source = _Pickle(data)
+    return shared_objects.Handle(key, source=source)
+
+
+def scatter(X):
+    """
+    Makes `X` available to the workers in shards along axis 0, one per
+    worker, to be used with `map_shards` and freed with `unshare`.
+
+    `X` is copied once into shared memory, where any worker can read any
+    shard without a copy. After `unshare`, each worker unmaps it at its next
+    task.
+    """
+    if _get_pool() is None or shared_memory is None:
+        return [share(X)]
+
+    X = np.ascontiguousarray(X)
+    ref, shm = _SharedArray.create(X)
+    key = shared_objects.new_key()
+    _g_shared_blocks[key] = shm
+
+    handles = []
+    bounds = np.linspace(0, len(X), n_workers() + 1).astype(np.int64)
+    for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        shard_key = '{}/{}'.format(key, i)
+        source = _SharedShard(ref, start, stop, shard_key)
+        handles.append(shared_objects.Handle(shard_key, source=source))
+    return handles
+
+
+def map_shards(f, handles, args=()):
+    """
+    Calls ``f(handle, *args)`` for each handle from `scatter` and returns
+    the results in the same order.
+    """
+    return list(imap(f, [(handle,) + tuple(args) for handle in handles],
+                     star=True))
+
+
+def unshare(handle):
+    """Frees an object shared with `share` or a shard from `scatter`"""
+    shared_objects.release(handle.key)
+    # The shards of `scatter` share a block, which goes with the first one
+    shm = _g_shared_blocks.pop(handle.key.split('/')[0], None)
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+
+def starmap(f, workloads):
+    return imap(f, workloads, star=True)
+
+
+def starmap_unordered(f, workloads):
+    return imap_unordered(f, workloads, star=True)
+
+
+def main(name=None):
+    """
+    Returns True in the main script. The worker processes are started by
+    the pool, so unlike the MPI backend, this does not block.
+    """
+    return name == '__main__'
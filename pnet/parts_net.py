@@ -1,9 +1,19 @@
 from __future__ import division, print_function, absolute_import
 
+import itertools as itr
 import numpy as np
 import amitgroup as ag
-from pnet.layer import Layer
+from pnet.layer import Layer, FeatureSpec
+from pnet.feature_cache import FeatureCache, _nbytes, digest, fingerprint
+from pnet.feature_store import FeatureStore
+from pnet.profiler import Profiler
+from pnet.bitpack import PackedBits, unpack
 import pnet
+import pnet.pipeline
+
+
+_DEFAULT_MEM_GB = 4
+_DEFAULT_EMPIRICAL_FACTOR = 2.0
 
 
 class ExtractionFunction:
@@ -14,37 +24,183 @@ class ExtractionFunction:
     one another, this class acts as an extraction function
     instead.
     """
-    def __init__(self, layer=None, phi=None, pos_matrix=None, name='Identity'):
+    def __init__(self, layer=None, phi=None, pos_matrix=None, name='Identity',
+                 net=None):
         self.layer = layer
         self.phi = phi
         self.pos_matrix = pos_matrix
         self.name = name
-        self._cache = {}
+        self.net = net
+        self.last_nbytes = 0
+        # The layer that this function extracts the input of (None for the
+        # output of the net)
+        self.consumer = None
 
     def __call__(self, X):
+        self.last_nbytes = _nbytes(X)
+        return X
+
+    def _deliver(self, X):
+        if not getattr(self.consumer, 'accepts_packed', False):
+            return unpack(X)
         return X
 
     def __repr__(self):
         return 'ExtractionFunction<{}>'.format(self.name)
 
 
-def smart_hash(x):
-    if isinstance(x, np.ndarray):
-        return hash(x.tostring())
-    elif isinstance(x, tuple):
-        return hash(tuple([smart_hash(child) for child in x]))
+def _concatenate_outputs(outputs):
+    """
+    Concatenates batched layer outputs along the sample axis. Parts layers
+    return tuples such as ``(feature_map, num_parts)``, in which case only the
+    first element is concatenated.
+    """
+    if isinstance(outputs[0], tuple):
+        feats = np.concatenate([output[0] for output in outputs])
+        return (feats,) + outputs[0][1:]
+    elif isinstance(outputs[0], PackedBits):
+        return PackedBits.concatenate(outputs)
     else:
-        return hash(x)
+        return np.concatenate(outputs)
+
+
+def memory_budget(phi=None):
+    """
+    Returns the memory budget in bytes and the empirical factor (ratio
+    between actual and projected memory use) of the net that the extraction
+    function `phi` belongs to. If `phi` is not part of a `PartsNet` (for
+    instance a plain ``lambda x: x``), the defaults are returned.
+    """
+    net = getattr(phi, 'net', None)
+    if net is None:
+        return _DEFAULT_MEM_GB * 1024**3, _DEFAULT_EMPIRICAL_FACTOR
+    else:
+        return (net.settings['mem_gb'] * 1024**3,
+                net.settings['empirical_factor'])
 
 
 @Layer.register('parts-net')
 class PartsNet(Layer):
-    def __init__(self, layers):
+    """
+    A chain of layers.
+
+    Parameters
+    ----------
+    layers : list of Layer
+        The layers, from input to output.
+
+    settings : dict, optional
+        Net-wide settings:
+
+        mem_gb : float
+            Memory budget (in GB) for extraction. Inputs are cut into batches
+            so that the features of one batch fit in this budget.
+        empirical_factor : float
+            Adjusts the projected memory use of a batch with an empirically
+            measured size.
+        batch_size : int or None
+            Fixed extraction batch size. If None, it is derived from `mem_gb`
+            using `plan`, or, if some layer can not report its output shape,
+            after extracting a small probe batch.
+        probe_size : int
+            Number of samples in the probe batch.
+        cache_mb : float
+            Size limit (in MB) of the feature cache used when `caching` is
+            enabled. Layer outputs are evicted least recently used first.
+        feature_store : str or None
+            Directory of an on-disk feature store. If set, the output of each
+            layer for the data passed to `train` and `extract` is written to
+            memory-mapped files, keyed by the layer configuration and a
+            fingerprint of the data. Later calls with the same data and layers
+            read them back instead of recomputing, so for instance retraining
+            only the classifier does not rerun the layers below it. Layers
+            whose configuration holds objects other than arrays, scalars and
+            strings (such as fitted mixture models), and the layers above
+            them, are not stored.
+        pipeline : bool
+            Extract with one thread per layer, passing batches from layer to
+            layer through bounded queues (see `pnet.pipeline`), so that
+            several layers work on different batches at the same time. The
+            feature cache, feature store and profiler are not used for
+            pipelined batches.
+        pipeline_queue_size : int
+            Maximum number of batches waiting between two pipeline stages.
+        fuse_pooling : bool
+            If a parts layer that supports it (such as `OrientedPartsLayer`)
+            is directly followed by a `PoolingLayer`, code and pool in one
+            pass instead of first building the index map of the parts layer.
+    """
+    def __init__(self, layers, settings={}):
         self._layers = layers
         self._train_info = {}
         self._trained = False
         self.caching = False
+        self._settings = dict(mem_gb=_DEFAULT_MEM_GB,
+                              empirical_factor=_DEFAULT_EMPIRICAL_FACTOR,
+                              batch_size=None,
+                              probe_size=8,
+                              cache_mb=1024,
+                              feature_store=None,
+                              pipeline=False,
+                              pipeline_queue_size=2,
+                              fuse_pooling=True,
+                              )
+
+        for k, v in settings.items():
+            if k not in self._settings:
+                raise ValueError("Unknown settings: {}".format(k))
+            else:
+                self._settings[k] = v
+
+        self._init_process_state()
+
+    # Attributes that only hold state of this process, set by
+    # `_init_process_state`
+    _PROCESS_STATE = ('_extract_funcs', 'cache', 'store', '_store_roots',
+                      '_fingerprints', '_root_digest', '_capture',
+                      '_captured', 'profiler')
+
+    def _init_process_state(self):
+        # The extraction functions are built on first use
         self._extract_funcs = []
+        self.cache = FeatureCache(int(self._settings['cache_mb'] * 1024**2))
+
+        if self._settings['feature_store'] is not None:
+            self.store = FeatureStore(self._settings['feature_store'])
+        else:
+            self.store = None
+        # Only the data passed to train/extract (or its batches) is stored,
+        # not the subsets and transformations that layers extract internally.
+        self._store_roots = []
+        self._fingerprints = {}
+        # Digest of the batch being run, computed once for all layers
+        self._root_digest = None
+        # Layer indices whose outputs should be kept during a pass
+        self._capture = set()
+        self._captured = {}
+        self.profiler = None
+
+    def __getstate__(self):
+        # The extraction functions are instances of a local class, and the
+        # cached features, store and profiler need not go to the workers
+        # (see `pnet.parallel.share`), so they are rebuilt after unpickling
+        state = self.__dict__.copy()
+        for name in self._PROCESS_STATE:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_process_state()
+
+    @property
+    def settings(self):
+        return self._settings
+
+    @property
+    def cache_stats(self):
+        """Hit/miss/eviction counters and current size of the feature cache"""
+        return self.cache.stats()
 
     @property
     def layers(self):
@@ -66,7 +222,7 @@ class PartsNet(Layer):
         if len(self._extract_funcs) == 1 + len(self._layers):
             return
 
-        fs = [ExtractionFunction()]
+        fs = [ExtractionFunction(net=self)]
         As = [pnet.matrix.identity()]
         for i, layer in enumerate(self._layers):
             parent_self = self
@@ -75,21 +231,45 @@ class PartsNet(Layer):
 
             class F(ExtractionFunction):
                 def __call__(self, x):
-                    if parent_self.caching:
-                        h = smart_hash(x)
-                        if h in self._cache:
-                            return self._cache[h]
-
-                    v = self.layer._extract(self.phi, x)
-
-                    if parent_self.caching:
-                        self._cache[h] = v
-                    return v
+                    cache = parent_self.cache if parent_self.caching else None
+                    if cache is not None:
+                        key = cache.key(self.index, x,
+                                        parent_self._batch_digest(x))
+                        v = cache.get(key)
+                        if v is not None:
+                            self.last_nbytes = _nbytes(v)
+                            return self._deliver(v)
+
+                    store = parent_self._store_for(x, self.index)
+                    if store is not None:
+                        store_key = store.key(
+                            parent_self._fingerprint(self.index), x,
+                            parent_self._batch_digest(x))
+                        v = store.load(store_key)
+                    else:
+                        v = None
+
+                    if v is None:
+                        v = parent_self._profiled_extract(self, x)
+                        if store is not None:
+                            store.save(store_key, v)
+
+                    self.last_nbytes = _nbytes(v)
+
+                    if self.index in parent_self._capture:
+                        parent_self._captured[self.index] = unpack(v)
+
+                    if cache is not None:
+                        cache.put(key, v)
+                    return self._deliver(v)
 
             f = F(layer=layer,
                   phi=fs[-1],
                   pos_matrix=A,
-                  name='{}:{}'.format(i, layer.name))
+                  name='{}:{}'.format(i, layer.name),
+                  net=self)
+            f.index = i
+            fs[-1].consumer = layer
 
             fs.append(f)
             As.append(A)
@@ -98,6 +278,97 @@ class PartsNet(Layer):
         # before storing it
         self._extract_funcs = fs
 
+    def _store_for(self, x, index):
+        """
+        The feature store, if `x` is data whose features of layer `index`
+        should be stored
+        """
+        if (self.store is not None and
+                any(x is r for r in self._store_roots) and
+                self._fingerprint(index) is not None):
+            return self.store
+        else:
+            return None
+
+    def _batch_digest(self, x):
+        """
+        The digest of `x` if it is the batch being run, which every layer
+        function of the net receives, or None.
+        """
+        if not any(x is r for r in self._store_roots):
+            return None
+        if self._root_digest is None:
+            self._root_digest = digest(x)
+        return self._root_digest
+
+    def _fingerprint(self, index):
+        """
+        Fingerprint of the configuration of layers 0 through `index`, or None
+        if it holds objects that cannot be fingerprinted by value (such as
+        fitted mixture models), in which case their outputs are not stored.
+        """
+        if index not in self._fingerprints:
+            try:
+                fp = fingerprint([
+                    layer.save_to_dict() for layer in self._layers[:index + 1]
+                ])
+            except TypeError as e:
+                ag.info('Not storing the features of layer {}: {}'.format(
+                    index, e))
+                fp = None
+            self._fingerprints[index] = fp
+        return self._fingerprints[index]
+
+    def start_profiling(self, trace_memory=False):
+        """
+        Starts recording per-layer timings, throughput and memory of `train`
+        and `extract`, and the EM iterations of the mixture models trained
+        meanwhile. See `pnet.profiler.Profiler`.
+        """
+        if self.profiler is None:
+            self.profiler = Profiler(trace_memory=trace_memory)
+        self.profiler.start()
+        return self.profiler
+
+    def stop_profiling(self):
+        """Stops profiling and returns the report (see `profile_report`)"""
+        if self.profiler is None:
+            return None
+        self.profiler.stop()
+        report = self.profiler.report()
+        self.profiler = None
+        return report
+
+    def profile_report(self):
+        """
+        The report of the running profiler as a JSON-serializable dictionary,
+        or None if profiling is not enabled. ``layers`` holds the ``train``
+        and ``extract`` statistics of each layer and ``em_iterations`` the
+        duration and log-likelihood of each EM iteration.
+        """
+        if self.profiler is None:
+            return None
+        return self.profiler.report()
+
+    def _profiled_extract(self, f, x):
+        if self.profiler is None:
+            return self._layer_extract(f, x)
+        with self.profiler.measure(f.index, f.layer.name, 'extract',
+                                   x) as frame:
+            frame.output = self._layer_extract(f, x)
+        return frame.output
+
+    def _layer_extract(self, f, x):
+        below = f.phi
+        if (self._settings['fuse_pooling'] and
+                getattr(f.layer, 'fusable', False) and
+                hasattr(getattr(below, 'layer', None), '_extract_pooled') and
+                below.index not in self._capture):
+            # Parts coding directly followed by pooling
+            return f.layer._extract_fused(below.layer, below.phi, x)
+        else:
+            return f.layer._extract(f.phi, x)
+
     def train(self, data, y=None):
         return self._train(lambda x: x, data, y=y)
 
@@ -105,6 +376,15 @@ class PartsNet(Layer):
         X = phi(data)
         self._prepare_extract_funcs()
 
+        if not isinstance(X, np.ndarray) and iter(X) is X:
+            # Every layer that is trained reads all of the data
+            raise TypeError('Training needs the data as an array, not as '
+                            'an iterator of batches')
+
+        self._fingerprints = {}
+        self._root_digest = None
+        self._store_roots = [X] if isinstance(X, np.ndarray) else []
+
         old_caching = self.caching
         self.caching = False  # TODO: Until this can be better managed
 
@@ -132,11 +412,20 @@ class PartsNet(Layer):
 
             if not layer.trained:
                 ag.info('Training layer {}...'.format(l))
-                layer._train(self._extract_funcs[l], X, y=y)
+                if self.profiler is None:
+                    layer._train(self._extract_funcs[l], X, y=y)
+                else:
+                    with self.profiler.measure(l, layer.name, 'train', X):
+                        layer._train(self._extract_funcs[l], X, y=y)
+                self._fingerprints = {}
                 ag.info('Done.')
 
         # Here There
 
+        # Cached features may come from layers that have now been retrained
+        self.cache.clear()
+        self._store_roots = []
+        self._root_digest = None
         self.caching = old_caching
 
         self._trained = True
@@ -145,8 +434,8 @@ class PartsNet(Layer):
         yhat = self.classify(X)
         return yhat == y
 
-    def classify(self, X):
-        return self.extract(X, classify=True)
+    def classify(self, X, out=None):
+        return self.extract(X, classify=True, out=out)
 
     def first_classifier_index(self):
         is_classifier = [layer.classifier for layer in self.layers]
@@ -155,18 +444,303 @@ class PartsNet(Layer):
         except ValueError:
             return len(self.layers)
 
-    def extract(self, data, classify=False, layer=None):
-        return self._extract(lambda x: x, data, classify=classify, layer=layer)
-
-    def _extract(self, phi, data, classify=False, layer=None):
-        X = phi(data)
+    def _output_index(self, classify=False, layer=None):
         if layer is None:
-            index = len(self.layers)-1 if classify \
+            return len(self.layers)-1 if classify \
                 else self.first_classifier_index() - 1
         else:
-            index = layer
+            return layer
+
+    def extract(self, data, classify=False, layer=None, out=None):
+        """
+        Extract features (or class predictions if `classify` is True).
+
+        Parameters
+        ----------
+        data : ndarray or iterable of ndarrays
+            Input samples, either as one array or as a generator of batches.
+        classify : bool
+            Run all layers, including the classifier.
+        layer : int or None
+            Extract the output of this layer index instead.
+        out : ndarray or None
+            If specified, the results are written into this preallocated
+            array, batch by batch, and it is returned. Otherwise, the batches
+            are concatenated.
+        """
+        return self._extract(lambda x: x, data, classify=classify, layer=layer,
+                             out=out)
+
+    def _extract(self, phi, data, classify=False, layer=None, out=None):
+        X = phi(data)
+        batches = self.extract_batches(X, classify=classify, layer=layer)
+        if out is None:
+            return _concatenate_outputs(list(batches))
+
+        start = 0
+        rest = ()
+        for batch in batches:
+            if isinstance(batch, tuple):
+                batch, rest = batch[0], batch[1:]
+            out[start:start + len(batch)] = batch
+            start += len(batch)
+
+        if rest:
+            return (out,) + rest
+        else:
+            return out
+
+    def extract_batches(self, data, classify=False, layer=None):
+        """
+        Streaming version of `extract`. The input is cut into batches sized
+        to the memory budget (see the `mem_gb` setting) and the output of each
+        batch is yielded as soon as it has been run through the layers, so
+        peak memory does not grow with the number of samples.
+
+        Parameters
+        ----------
+        data : ndarray or iterable of ndarrays
+            Input samples, either as one array or as a generator of batches.
+            Batches larger than the batch size are split further.
+        classify, layer :
+            See `extract`.
+        """
+        index = self._output_index(classify=classify, layer=layer)
+        for output, _ in self._run_batches(data, index):
+            yield output
+
+    def extract_layers(self, data, layers):
+        """
+        Extract the outputs of several layers with a single pass through the
+        net. Layer outputs that are not requested are released as soon as the
+        layer above has used them.
+
+        Parameters
+        ----------
+        data : ndarray or iterable of ndarrays
+            Input samples, either as one array or as a generator of batches.
+        layers : list of int
+            Indices of the layers whose outputs are requested.
+
+        Returns
+        -------
+        outputs : list
+            The output of each requested layer, in the order of `layers`.
+        """
+        layers = list(layers)
+        outputs = dict((l, []) for l in layers)
+        for _, captured in self._run_batches(data, max(layers), capture=layers):
+            for l in layers:
+                outputs[l].append(captured[l])
+
+        return [_concatenate_outputs(outputs[l]) for l in layers]
+
+    def _run_batches(self, data, index, capture=()):
+        """
+        Runs batches of `data` through layers 0 through `index`. Yields the
+        output of each batch together with a dictionary of the outputs of the
+        layers listed in `capture`.
+        """
         self._prepare_extract_funcs()
-        return self._extract_funcs[index + 1](X)
+        self._fingerprints = {}
+        batches = self._batches(data, index)
+
+        if not self._settings['pipeline']:
+            for batch, _ in batches:
+                yield self._run_batch(batch, index, capture)
+            return
+
+        for batch, probe in batches:
+            if probe:
+                # The batch size is derived from the probe batch, so it needs
+                # to finish before the pipeline can be fed.
+                yield self._run_batch(batch, index, capture)
+            else:
+                rest = itr.chain([batch], (b for b, _ in batches))
+                for output in self._run_pipeline(rest, index, capture):
+                    yield output
+                break
+
+    def _batches(self, data, index):
+        """
+        Cuts `data` into batches for extracting layers 0 through `index`.
+        Yields each batch and whether it is a probe batch, in which case the
+        batch size is derived from it once it has been run.
+        """
+        if isinstance(data, np.ndarray):
+            data = [data]
+
+        batch_size = self._settings['batch_size']
+        empty = None
+        n_batches = 0
+        for chunk in data:
+            if len(chunk) == 0:
+                # Kept in case there are no samples at all, in which case it
+                # is run to get an empty output of the right shape
+                empty = chunk
+                continue
+
+            if batch_size is None:
+                batch_size = self.plan(chunk.shape[1:], chunk.dtype,
+                                       layer=index)['batch_size']
+            start = 0
+            while True:
+                probe = batch_size is None
+                size = batch_size or self._settings['probe_size']
+                batch = chunk[start:start + size]
+                n_batches += 1
+                yield batch, probe
+
+                if probe:
+                    batch_size = self._batch_size_from_probe(index, len(batch))
+                start += len(batch)
+                if start >= len(chunk):
+                    break
+
+        if n_batches == 0:
+            if empty is None:
+                raise ValueError('The data has no batches, so the shape of '
+                                 'the features is unknown. Pass an empty '
+                                 'array instead.')
+            yield empty, False
+
+    def _run_batch(self, batch, index, capture=()):
+        self._store_roots = [batch]
+        self._root_digest = None
+        self._capture = set(capture)
+        self._captured = {}
+        # The function hands its output to the layer above it, which may take
+        # it packed, but callers of the net always get it unpacked
+        output = unpack(self._extract_funcs[index + 1](batch))
+        captured = self._captured
+        self._capture = set()
+        self._captured = {}
+
+        # Layers skipped due to a cache or feature store hit further up have
+        # not reported their outputs
+        for l in capture:
+            if l not in captured:
+                captured[l] = unpack(self._extract_funcs[l + 1](batch))
+        self._store_roots = []
+        self._root_digest = None
+        return output, captured
+
+    def _run_pipeline(self, batches, index, capture=()):
+        """
+        Runs batches through layers 0 through `index` with `pnet.pipeline`,
+        one stage per layer. Each stage is handed the output of the stage
+        below, so the feature cache, feature store and profiler are bypassed.
+        """
+        phi = self._extract_funcs[0]
+
+        def make_stage(l, layer, consumer):
+            def stage(item):
+                X, captured = item
+                output = layer._extract(phi, X)
+                if l in capture:
+                    captured[l] = unpack(output)
+                if not getattr(consumer, 'accepts_packed', False):
+                    output = unpack(output)
+                return output, captured
+            return stage
+
+        layers = self._layers[:index + 1]
+        stages = [make_stage(l, layer, (layers + [None])[l + 1])
+                  for l, layer in enumerate(layers)]
+        items = ((batch, {}) for batch in batches)
+        return pnet.pipeline.pipeline(
+            stages, items, queue_size=self._settings['pipeline_queue_size'])
+
+    def output_spec(self, input_spec, classify=False, layer=None):
+        index = self._output_index(classify=classify, layer=layer)
+        spec = input_spec
+        for l in self._layers[:index + 1]:
+            if spec is None:
+                break
+            spec = l.output_spec(spec)
+        return spec
+
+    def plan(self, input_shape, dtype=np.float64, classify=False, layer=None,
+             mem_gb=None):
+        """
+        Plans the memory use of extraction, without running any data.
+
+        Parameters
+        ----------
+        input_shape : tuple
+            Shape of one input sample.
+        dtype : dtype
+            Input dtype.
+        classify, layer :
+            See `extract`.
+        mem_gb : float
+            Memory budget in GB. Defaults to the `mem_gb` setting.
+
+        Returns
+        -------
+        plan : dict
+            ``layers`` has the output shape, dtype and bytes per sample of
+            each layer. ``peak_bytes_per_sample`` is the largest working set
+            per sample while extracting (input, the output of the layer below,
+            the output of the current layer and its temporaries), and
+            ``batch_size`` is the number of samples that fit in the budget,
+            including the `empirical_factor` setting. If a layer can not
+            report its output, the plan stops there and ``batch_size`` is None.
+        """
+        index = self._output_index(classify=classify, layer=layer)
+        if mem_gb is None:
+            mem_gb = self._settings['mem_gb']
+
+        input_spec = FeatureSpec(input_shape, dtype)
+        plan = dict(input_shape=input_spec.shape,
+                    input_dtype=input_spec.dtype,
+                    input_bytes_per_sample=input_spec.nbytes,
+                    layers=[],
+                    complete=True,
+                    peak_bytes_per_sample=None,
+                    batch_size=None,
+                    mem_gb=mem_gb)
+
+        spec = input_spec
+        peak = input_spec.nbytes
+        for i, layer in enumerate(self._layers[:index + 1]):
+            output_spec = layer.output_spec(spec)
+            if output_spec is None:
+                plan['complete'] = False
+                break
+
+            working = layer.working_nbytes(spec)
+            below = spec.nbytes if i > 0 else 0
+            peak = max(peak, input_spec.nbytes + below + output_spec.nbytes +
+                       working)
+            plan['layers'].append(dict(index=i,
+                                       name=layer.name,
+                                       shape=output_spec.shape,
+                                       dtype=output_spec.dtype,
+                                       n_features=output_spec.n_features,
+                                       bytes_per_sample=output_spec.nbytes,
+                                       working_bytes_per_sample=working))
+            spec = output_spec
+
+        if plan['complete']:
+            factor = self._settings['empirical_factor']
+            plan['peak_bytes_per_sample'] = peak
+            plan['batch_size'] = max(1, int(mem_gb * 1024**3 //
+                                            max(peak * factor, 1)))
+
+        return plan
+
+    def _batch_size_from_probe(self, index, n_samples):
+        """
+        Derives the batch size from the bytes produced by each layer on the
+        most recent (probe) batch of `n_samples` samples.
+        """
+        memory, empirical_factor = memory_budget(self._extract_funcs[0])
+        bytesize = sum(f.last_nbytes for f in self._extract_funcs[:index + 2])
+        per_sample = bytesize * empirical_factor / max(n_samples, 1)
+        batch_size = max(1, int(memory // max(per_sample, 1)))
+        ag.info('Extraction batch size: {}'.format(batch_size))
+        return batch_size
 
     def _vzlog_output_(self, vz):
         vz.title('Layers')
@@ -184,6 +758,7 @@ class PartsNet(Layer):
 
     def save_to_dict(self):
         d = {}
+        d['settings'] = self._settings
         d['layers'] = []
         for layer in self._layers:
             layer_dict = layer.save_to_dict()
@@ -199,7 +774,7 @@ class PartsNet(Layer):
             Layer.getclass(layer_dict['name']).load_from_dict(layer_dict)
             for layer_dict in d['layers']
         ]
-        obj = cls(layers)
+        obj = cls(layers, settings=d.get('settings', {}))
         return obj
 
     def __repr__(self):
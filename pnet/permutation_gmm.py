@@ -3,6 +3,11 @@ import itertools as itr
 import amitgroup as ag
 from scipy.misc import logsumexp
 from sklearn.base import BaseEstimator
+from pnet.profiler import record_em_iteration
+from pnet.permutation_mm import _sum_statistics
+from pnet.restarts import derive_seeds, fit_restarts, best_restart
+from pnet import cyclic
+import pnet
 import time
 
 _COV_TYPES = ['ones', 'tied', 'diag', 'diag-perm',
@@ -11,11 +16,34 @@ _COV_TYPES = ['ones', 'tied', 'diag', 'diag-perm',
 
 class PermutationGMM(BaseEstimator):
     """
-
+    A Gaussian mixture model with a latent permutation (see
+    `PermutationMM`).
+
+    With ``distributed=True``, the samples are split into shards across the
+    workers of `pnet.parallel`. Each worker computes the responsibilities,
+    weighted sums and scatter matrices of its shard, and only these
+    statistics are sent back and summed. The shards (and their
+    responsibilities) stay on the workers for the whole fit.
+
+    With ``parallel_restarts=True`` (and not `distributed`), the `n_init`
+    initializations run concurrently on the workers instead, each seeded
+    from `random_state`.
+
+    With cyclic permutations (see `PermutationMM`, `use_fft`), the weighted
+    sums of the M-step are taken with FFTs, as is the scoring for the
+    covariance types that are the same for all permutations ('ones', 'tied'
+    and 'full'). The log density is then split into a quadratic term of the
+    sample, the same for all permutations, and its dot product with the
+    precision-weighted means, which is a cross-correlation.
+
+    The scatter matrices of the covariance M-step are taken with matrix
+    products over blocks of samples of at most `block_bytes`.
     """
     def __init__(self, n_components=1, permutations=1, covariance_type='tied',
                  min_covar=1e-3, n_iter=20, n_init=1, params='wmc',
-                 random_state=0, thresh=1e-2, covar_limit=None, target_entropy=None):
+                 random_state=0, thresh=1e-2, covar_limit=None, target_entropy=None,
+                 distributed=False, parallel_restarts=False, use_fft='auto',
+                 block_bytes=2**21):
 
         assert covariance_type in _COV_TYPES, "Covariance type not supported"
         if not isinstance(random_state, np.random.RandomState):
@@ -41,6 +69,10 @@ class PermutationGMM(BaseEstimator):
         self._covar_limit = covar_limit
         self._params = params
         self._target_entropy = target_entropy
+        self.distributed = distributed
+        self.parallel_restarts = parallel_restarts
+        self.use_fft = use_fft
+        self.block_bytes = block_bytes
 
         self.weights_ = None
         self.means_ = None
@@ -69,37 +101,41 @@ class PermutationGMM(BaseEstimator):
             permutation for each observation.
 
         """
-        from scipy.stats import multivariate_normal
-        N = X.shape[0]
+        N, P, D = X.shape
         K = self.n_components
-        P = len(self.permutations)
 
         unorm_log_resp = np.empty((N, K, P))
         unorm_log_resp[:] = np.log(self.weights_[np.newaxis])
 
-        for p in range(P):
-            for shift in range(P):
-                p0 = self.permutations[shift, p]
-                for k in range(K):
-                    if self._covtype == 'ones':
-                        cov = np.diag(self.covars_)
-                    elif self._covtype == 'tied':
-                        cov = self.covars_
-                    elif self._covtype == 'diag-perm':
-                        cov = np.diag(self.covars_[p])
-                    elif self._covtype == 'diag':
-                        cov = np.diag(self.covars_[k, p])
-                    elif self._covtype == 'full':
-                        cov = self.covars_[k]
-                    elif self._covtype == 'full-perm':
-                        cov = self.covars_[p]
-                    elif self._covtype == 'full-full':
-                        cov = self.covars_[k, p]
-
-                    unorm_log_resp[:, k, p] += multivariate_normal.logpdf(
-                        X[:, p0],
-                        mean=self.means_[k, shift],
-                        cov=cov)
+        shape = None
+        if self._covtype in ('ones', 'tied', 'full'):
+            shape = cyclic.fft_shape(self.permutations, self.use_fft)
+
+        if shape is not None:
+            unorm_log_resp += self._cyclic_logpdf(X, shape)
+        else:
+            once = _maps_each_block_once(self.permutations)
+            for ks, ps, factor, logdet in self._covar_factors():
+                # Samples and means whitened by this covariance, where the
+                # log density is a squared distance
+                white = _whiten(X, factor)
+                if once:
+                    # Every p tests all the sample blocks once, so their
+                    # quadratic term is the same
+                    sq = (white ** 2).sum(2).sum(1)
+                white_means = _whiten(self.means_[ks], factor)
+                white_means = white_means.reshape((len(ks), -1))
+                const = (-0.5 * (white_means ** 2).sum(1) -
+                         0.5 * P * (D * np.log(2 * np.pi) + logdet))
+                for p in ps:
+                    # The sample blocks that the parameter blocks are tested
+                    # against for p, in the order of the shifts
+                    WP = white[:, self.permutations[:, p]].reshape((N, -1))
+                    if not once:
+                        sq = (WP ** 2).sum(1)
+                    unorm_log_resp[:, ks, p] += (np.dot(WP, white_means.T) -
+                                                 0.5 * sq[:, np.newaxis] +
+                                                 const)
 
         unorm_reshaped = unorm_log_resp.reshape((unorm_log_resp.shape[0], -1))
         logprob = logsumexp(unorm_reshaped.clip(min=-500), axis=-1)
@@ -108,6 +144,72 @@ class PermutationGMM(BaseEstimator):
 
         return logprob, log_resp
 
+    def _cyclic_logpdf(self, X, shape):
+        """
+        Log density of each sample for each component and permutation, for
+        cyclic permutations over a grid of `shape` and a covariance per
+        component at most.
+        """
+        N, P, D = X.shape
+        K = self.n_components
+
+        quad_x = np.empty((N, K))
+        prec_means = np.empty(self.means_.shape)
+        const = np.empty(K)
+        for ks, ps, factor, logdet in self._covar_factors():
+            # Quadratic term of the samples, summed over their blocks
+            white = _whiten(X, factor)
+            quad_x[:, ks] = (white ** 2).sum(2).sum(1)[:, np.newaxis]
+            white_means = _whiten(self.means_[ks], factor)
+            prec_means[ks] = _whiten(white_means, factor, transpose=True)
+            const[ks] = (-0.5 * (white_means ** 2).sum(2).sum(1) -
+                         0.5 * P * (D * np.log(2 * np.pi) + logdet))
+
+        cross = cyclic.correlate(X, cyclic.spectrum(prec_means, shape), shape)
+        return (cross - 0.5 * quad_x[:, :, np.newaxis] +
+                const[np.newaxis, :, np.newaxis])
+
+    def _covar_factors(self):
+        """
+        The distinct covariance matrices, each as ``(ks, ps, factor,
+        logdet)``: the components and permutations that use it, its lower
+        Cholesky factor (its standard deviations for the diagonal types) and
+        its log-determinant.
+
+        They are factored once, and again only after `covars_` has changed,
+        which is once per M-step.
+        """
+        cached = getattr(self, '_factors', None)
+        if cached is not None and np.array_equal(cached[0], self.covars_):
+            return cached[1]
+
+        K = self.n_components
+        P = len(self.permutations)
+        all_k = np.arange(K)
+        all_p = np.arange(P)
+        if self._covtype in ('ones', 'tied'):
+            covs = [(all_k, all_p, self.covars_)]
+        elif self._covtype == 'full':
+            covs = [([k], all_p, self.covars_[k]) for k in range(K)]
+        elif self._covtype in ('diag-perm', 'full-perm'):
+            covs = [(all_k, [p], self.covars_[p]) for p in range(P)]
+        else:
+            covs = [([k], [p], self.covars_[k, p])
+                    for k, p in itr.product(range(K), range(P))]
+
+        factors = []
+        for ks, ps, cov in covs:
+            if cov.ndim == 1:
+                factor = np.sqrt(cov)
+                logdet = np.log(cov).sum()
+            else:
+                factor = np.linalg.cholesky(cov)
+                logdet = 2 * np.log(np.diag(factor)).sum()
+            factors.append((ks, ps, factor, logdet))
+
+        self._factors = (self.covars_.copy(), factors)
+        return factors
+
     def fit(self, X):
         """
         Estimate model parameters with the expectation-maximization algorithm.
@@ -121,32 +223,6 @@ class PermutationGMM(BaseEstimator):
             `n_permutations` times.
 
         """
-        def diff_entropy(cov):
-            sign, logdet = np.linalg.slogdet(cov)
-            return 0.5 * cov.shape[0] * np.log(2 * np.pi * np.e) + logdet
-
-        def reg_covar(cov0, mcov, target_entropy):
-            def regularize_cov(reg_val):
-                return cov0 * (1 - reg_val) + np.eye(cov0.shape[0]) * reg_val
-
-            lo, hi = self.min_covar * (1 + np.array([-0.95, 2.95]))
-            ent = None
-            for d in range(15):
-                mi = np.mean([lo, hi])
-
-                c = regularize_cov(mi)
-                ent = diff_entropy(c)
-                print('ent', ent)
-                if ent > target_entropy:
-                    hi = mi
-                else:
-                    lo = mi
-
-            mcov1 = np.mean([lo, hi])
-            print('mcov multiple', mcov1 / mcov)
-            return regularize_cov(mcov1)
-
-
         assert X.ndim == 3
         N, P, F = X.shape
 
@@ -207,7 +283,7 @@ class PermutationGMM(BaseEstimator):
             self.converged_ = True
             if self._target_entropy is None:
                 c = regularize_cov(self.min_covar)
-                ent = diff_entropy(c)
+                ent = _diff_entropy(c)
                 self.covars_ = c
                 self._entropy = ent
             else:
@@ -217,7 +293,7 @@ class PermutationGMM(BaseEstimator):
                     mi = np.mean([lo, hi])
 
                     c = regularize_cov(mi)
-                    ent = diff_entropy(c)
+                    ent = _diff_entropy(c)
                     print('ent', ent)
                     if ent > self._target_entropy:
                         hi = mi
@@ -234,7 +310,7 @@ class PermutationGMM(BaseEstimator):
 
                 #print('diff entropy', diff_entropy(self.covars_))
 
-                self._entropy = diff_entropy(self.covars_)
+                self._entropy = _diff_entropy(self.covars_)
             return
 
         #N34 = 3 * N // 4
@@ -245,220 +321,416 @@ class PermutationGMM(BaseEstimator):
         #N = N34
         print('HERE')
 
-        XX = X.reshape((-1, X.shape[-1]))
+        seeds = derive_seeds(self.random_state, self.n_init)
+
+        shards = resp_shards = None
+        if self.distributed:
+            shards = pnet.parallel.scatter(X)
+            # Work space for the responsibilities, kept next to the shards
+            # for the covariance update
+            resp_shards = dict(zip([shard.key for shard in shards],
+                                   pnet.parallel.scatter(np.empty((N, K, P)))))
+
+        try:
+            if shards is None:
+                results = fit_restarts(self, X, seeds,
+                                       parallel=self.parallel_restarts)
+            else:
+                # The workers are busy with the shards, so the restarts run
+                # one after another
+                results = [self._fit_restart(X, trial, seed, shards=shards,
+                                             resp_shards=resp_shards)
+                           for trial, seed in enumerate(seeds)]
+        finally:
+            if shards is not None:
+                for shard in shards + list(resp_shards.values()):
+                    pnet.parallel.unshare(shard)
+
+        max_log_prob, best_params = best_restart(results)
+        ag.info("Best log likelihood {}".format(max_log_prob))
+
+        self.weights_ = best_params['weights']
+        self.means_ = best_params['means']
+        self.covars_ = best_params['covars']
+        self.converged_ = best_params['converged']
+
+    def _fit_restart(self, X, trial, seed, shards=None, resp_shards=None):
+        """
+        Runs EM from the random initialization given by `seed`. Returns the
+        final log-likelihood and the parameters.
+        """
+        N, P, F = X.shape
+        K = self.n_components
+        rs = np.random.RandomState(seed)
+        # Responsibilities, if not kept next to the shards
+        resp = np.empty((N, K, P)) if shards is None else None
+
+        loglikelihoods = []
+        self.weights_ = np.ones((K, P)) / (K * P)
+
+        flatX = X.reshape((-1, F))
+
+        # Initialize to covariance matrix of all samples
+        if self._covtype == 'diag':
+            pass
+        elif 0:
+            cv = np.eye(F)
+        elif 1:
+            print('cov')
+            cv = (1 - self.min_covar) * np.cov(flatX.T) + self.min_covar * np.eye(F)
+            print('cov done')
+        else:
+            cv = ag.io.load('/var/tmp/cov.h5')
 
-        max_log_prob = -np.inf
+        # Initialize by picking K components at random.
+        if self._covtype == 'diag':
+            repr_samples = X[rs.choice(N, K, replace=False)]
+            self.means_ = repr_samples
+        elif 0:
+            # Initialize by running kmeans
+            assert P == 1
+            from sklearn.cluster import KMeans
+            clf = KMeans(n_clusters=K)
+            XX2 = np.dot(cv, flatX.T).T
 
-        for trial in range(self.n_init):
-            loglikelihoods = []
-            self.weights_ = np.ones((K, P)) / (K * P)
+            clf.fit(XX2)
 
-            flatX = X.reshape((-1, F))
+            means = clf.means_
 
-            # Initialize to covariance matrix of all samples
-            if self._covtype == 'diag':
-                pass
-            elif 0:
-                cv = np.eye(F)
-            elif 1:
-                print('cov')
-                cv = (1 - self.min_covar) * np.cov(flatX.T) + self.min_covar * np.eye(F)
-                print('cov done')
+            self.means_ = clf.means_.reshape((K,) + X.shape[1:])
+        else:
+            # TODO: Does not initialize permutations in a coherent way, but
+            # this might not be needed anyway
+            mm = rs.multivariate_normal(np.zeros(F), cv, size=K * P)
+            self.means_ = mm.reshape((K,) + X.shape[1:])
+
+        if self._covtype == 'ones':
+            self.covars_ = np.ones(cv.shape[0])
+        elif self._covtype == 'tied':
+            self.covars_ = cv
+        elif self._covtype == 'diag':
+            self.covars_ = np.tile(np.ones(F), (K, P, 1))
+        elif self._covtype == 'diag-perm':
+            self.covars_ = np.tile(np.diag(cv).copy(), (P, 1))
+        elif self._covtype == 'full':
+            self.covars_ = np.tile(cv, (K, 1, 1))
+        elif self._covtype == 'full-perm':
+            self.covars_ = np.tile(cv, (P, 1, 1))
+        elif self._covtype == 'full-full':
+            self.covars_ = np.tile(cv, (K, P, 1, 1))
+
+        self.converged_ = False
+        for loop in range(self.n_iter):
+            start = time.time()
+
+            # E-step
+            if shards is None:
+                stats = self._em_statistics(X, resp)
             else:
-                cv = ag.io.load('/var/tmp/cov.h5')
+                shard_stats = pnet.parallel.map_shards(
+                    _shard_em_statistics, shards,
+                    args=(self, resp_shards))
+                stats = _sum_statistics(shard_stats)
+
+            # M-step
+
+            if 'm' in self._params:
+                dens = stats['resp_sum'].sum(1)
+                self.means_[:] = stats['weighted_sum']
+                self.means_ /= dens[:, np.newaxis, np.newaxis]
+
+            if 'w' in self._params:
+                ww = stats['resp_sum'] / N
+                self.weights_[:] = ww.clip(0.0001, 1 - 0.0001)
+
+            if 'c' in self._params and self._covtype != 'ones':
+                if shards is None:
+                    limit = self._covar_limit
+                    cstats = self._covar_statistics(X[:limit],
+                                                    resp[:limit])
+                else:
+                    # Samples of each shard that are within the limit
+                    limits = {}
+                    offset = 0
+                    for shard, st in zip(shards, shard_stats):
+                        limit = st['n_samples']
+                        if self._covar_limit is not None:
+                            limit = min(max(self._covar_limit - offset, 0),
+                                        limit)
+                        limits[shard.key] = limit
+                        offset += st['n_samples']
 
-            # Initialize by picking K components at random.
-            if self._covtype == 'diag':
-                repr_samples = X[self.random_state.choice(N, K, replace=False)]
-                self.means_ = repr_samples
-            elif 0:
-                # Initialize by running kmeans
-                assert P == 1
-                from sklearn.cluster import KMeans
-                clf = KMeans(n_clusters=K)
-                XX2 = np.dot(cv, flatX.T).T
+                    cstats = _sum_statistics(pnet.parallel.map_shards(
+                        _shard_covar_statistics, shards,
+                        args=(self, resp_shards, limits)))
+                covars = cstats['scatter'] / cstats['total']
 
-                clf.fit(XX2)
+                if self._covtype == 'tied':
+                    self.covars_[:] = covars
 
-                means = clf.means_
+                    # Now make sure the diagonal is not overfit
+                    dd = np.diag(self.covars_)
+                    D = self.covars_.shape[0]
+                    self.covars_ = (self.covars_ * (1 - self.min_covar) +
+                                    np.eye(D) * self.min_covar)
+
+                elif self._covtype == 'diag':
+                    self.covars_[:] = covars
+
+                    self.covars_[:] += self.min_covar
+
+                elif self._covtype == 'diag-perm':
+                    self.covars_[:] = covars
+
+                    self.covars_[:] = self.covars_.clip(min=self.min_covar)
+
+                elif self._covtype == 'full':
+                    self.covars_[:] = covars
+
+                    for k in range(K):
+                        #dd = np.diag(self.covars_[k])
+                        #clipped_dd = dd.clip(min=self.min_covar)
+                        #self.covars_[k] += np.diag(clipped_dd - dd)
+
+                        self.covars_[k] = self._reg_covar(self.covars_[k],
+                                                          self.min_covar,
+                                                          -9000.0)
+
+                        #c = self.covars_[k]
+                        #c = (1 - mcov) * c + mcov * np.eye(c.shape[0])
+                        #self.covars_[k] = c
+
+                elif self._covtype == 'full-perm':
+                    self.covars_[:] = covars
 
-                self.means_ = clf.means_.reshape((K,) + X.shape[1:])
-            else:
-                # TODO: Does not initialize permutations in a coherent way, but
-                # this might not be needed anyway
-                rs = np.random.RandomState(trial)  # TODO: Insert seed
-                mm = rs.multivariate_normal(np.zeros(F), cv, size=K * P)
-                self.means_ = mm.reshape((K,) + X.shape[1:])
-
-            if self._covtype == 'ones':
-                self.covars_ = np.ones(cv.shape[0])
-            elif self._covtype == 'tied':
-                self.covars_ = cv
-            elif self._covtype == 'diag':
-                self.covars_ = np.tile(np.ones(F), (K, P, 1))
-            elif self._covtype == 'diag-perm':
-                self.covars_ = np.tile(np.diag(cv).copy(), (P, 1))
-            elif self._covtype == 'full':
-                self.covars_ = np.tile(cv, (K, 1, 1))
-            elif self._covtype == 'full-perm':
-                self.covars_ = np.tile(cv, (P, 1, 1))
-            elif self._covtype == 'full-full':
-                self.covars_ = np.tile(cv, (K, P, 1, 1))
-
-            self.converged_ = False
-            for loop in range(self.n_iter):
-                start = time.clock()
-
-                # E-step
-                logprob, log_resp = self.score_block_samples(X)
-
-                #test_logprob, _ = self.score_block_samples(HX)
-                #test_loglikelihood = test_logprob.sum()
-
-                # TODO
-                hh = np.histogram(np.exp(log_resp.max(-1).max(-1)),
-                                  bins=np.linspace(0, 1, 11))
-
-                sh = (-1, log_resp.shape[1])
-                resp = np.exp(log_resp)
-                lresp = log_resp.transpose((0, 2, 1)).reshape(sh)
-                log_dens = logsumexp(lresp, axis=0)[np.newaxis, :, np.newaxis]
-                dens = np.exp(log_dens)
-
-                # M-step
-
-                if 'm' in self._params:
                     for p in range(P):
-                        v = 0.0
-                        for shift in range(P):
-                            p0 = self.permutations[shift, p]
-                            v += np.dot(resp[:, :, shift].T, X[:, p0])
-
-                        self.means_[:, p, :] = v
-                    self.means_ /= dens.ravel()[:, np.newaxis, np.newaxis]
-
-                if 'w' in self._params:
-                    ww = (ag.apply_once(np.sum, resp, [0], keepdims=False) / N)
-                    self.weights_[:] = ww.clip(0.0001, 1 - 0.0001)
-
-                if 'c' in self._params:
-                    if self._covtype == 'ones':
-                        # Do not update
-                        pass
-                    elif self._covtype == 'tied':
-                        from pnet.cyfuncs import calc_new_covar
-                        self.covars_[:] = calc_new_covar(X[:self._covar_limit],
-                                                         self.means_,
-                                                         resp,
-                                                         self.permutations)
-
-                        # Now make sure the diagonal is not overfit
-                        dd = np.diag(self.covars_)
-                        D = self.covars_.shape[0]
-                        self.covars_ = (self.covars_ * (1 - self.min_covar) +
-                                        np.eye(D) * self.min_covar)
-
-                    elif self._covtype == 'diag':
-                        from pnet.cyfuncs import calc_new_covar_diag as calc
-                        self.covars_[:] = calc(X[:self._covar_limit],
-                                               self.means_,
-                                               resp,
-                                               self.permutations)
-
-                        self.covars_[:] += self.min_covar
-
-                    elif self._covtype == 'diag-perm':
-                        from pnet.cyfuncs import calc_new_covar_diagperm as calc
-                        self.covars_[:] = calc(X[:self._covar_limit],
-                                               self.means_,
-                                               resp,
-                                               self.permutations)
-
-                        self.covars_[:] = self.covars_.clip(min=self.min_covar)
-
-                    elif self._covtype == 'full':
-                        from pnet.cyfuncs import calc_new_covar_full as calc
-                        self.covars_[:] = calc(X[:self._covar_limit],
-                                               self.means_,
-                                               resp,
-                                               self.permutations)
-
-                        for k in range(K):
-                            #dd = np.diag(self.covars_[k])
-                            #clipped_dd = dd.clip(min=self.min_covar)
-                            #self.covars_[k] += np.diag(clipped_dd - dd)
-
-                            self.covars_[k] = reg_covar(self.covars_[k],
-                                                        self.min_covar,
-                                                        -9000.0)
-
-                            #c = self.covars_[k]
-                            #c = (1 - mcov) * c + mcov * np.eye(c.shape[0])
-                            #self.covars_[k] = c
-
-                    elif self._covtype == 'full-perm':
-                        from pnet.cyfuncs import calc_new_covar_fullperm as calc
-                        self.covars_[:] = calc(X[:self._covar_limit],
-                                               self.means_,
-                                               resp,
-                                               self.permutations)
-
-                        for p in range(P):
-                            dd = np.diag(self.covars_[p])
-                            clipped_dd = dd.clip(min=self.min_covar)
-                            self.covars_[p] += np.diag(clipped_dd - dd)
-
-                    elif self._covtype == 'full-full':
-                        from pnet.cyfuncs import calc_new_covar_fullfull as calc
-                        self.covars_[:] = calc(X[:self._covar_limit],
-                                               self.means_,
-                                               resp,
-                                               self.permutations)
-
-                        D = self.covars_.shape[2]
-                        for k, p in itr.product(range(K), range(P)):
-                            dd = np.diag(self.covars_[k, p])
-                            clipped_dd = dd.clip(min=self.min_covar)
-                            #self.covars_[k, p] += np.diag(clipped_dd - dd)
-                            #self.covars_[k, p] += np.diag(clipped_dd - dd)
-                            self.covars_[k, p] += np.eye(D) * self.min_covar
-
-                # Calculate log likelihood
-                loglikelihoods.append(logprob.sum())
-
-                ag.info("Trial {trial}/{n_trials}  Iteration {iter}  "
-                        "Time {time:.2f}s  Log-likelihood {llh:.2f} "
-                        #"Test log-likelihood {tllh:.2f}"
-                        "".format(
-                            trial=trial+1,
-                            n_trials=self.n_init,
-                            iter=loop+1,
-                            time=time.clock() - start,
-                            llh=loglikelihoods[-1] / N,
-                            #tllh=test_loglikelihood / HN,
-                            ))
-
-                if loop > 0:
-                    absdiff = abs(loglikelihoods[-1] - loglikelihoods[-2])
-                    if absdiff/abs(loglikelihoods[-2]) < self.thresh:
-                        self.converged_ = True
-                        break
-
-            if loglikelihoods[-1] > max_log_prob:
-                ag.info("Updated best log likelihood to {}"
-                        .format(loglikelihoods[-1]))
-                max_log_prob = loglikelihoods[-1]
-                best_params = {'weights': self.weights_,
-                               'means': self.means_,
-                               'covars': self.covars_,
-                               'converged': self.converged_}
+                        dd = np.diag(self.covars_[p])
+                        clipped_dd = dd.clip(min=self.min_covar)
+                        self.covars_[p] += np.diag(clipped_dd - dd)
+
+                elif self._covtype == 'full-full':
+                    self.covars_[:] = covars
+
+                    D = self.covars_.shape[2]
+                    for k, p in itr.product(range(K), range(P)):
+                        dd = np.diag(self.covars_[k, p])
+                        clipped_dd = dd.clip(min=self.min_covar)
+                        #self.covars_[k, p] += np.diag(clipped_dd - dd)
+                        #self.covars_[k, p] += np.diag(clipped_dd - dd)
+                        self.covars_[k, p] += np.eye(D) * self.min_covar
+
+            # Calculate log likelihood
+            loglikelihoods.append(stats['loglikelihood'])
+            elapsed = time.time() - start
+            record_em_iteration('PermutationGMM', trial, loop, elapsed,
+                                loglikelihoods[-1])
+
+            ag.info("Trial {trial}/{n_trials}  Iteration {iter}  "
+                    "Time {time:.2f}s  Log-likelihood {llh:.2f} "
+                    #"Test log-likelihood {tllh:.2f}"
+                    "".format(
+                        trial=trial+1,
+                        n_trials=self.n_init,
+                        iter=loop+1,
+                        time=elapsed,
+                        llh=loglikelihoods[-1] / N,
+                        #tllh=test_loglikelihood / HN,
+                        ))
+
+            if loop > 0:
+                absdiff = abs(loglikelihoods[-1] - loglikelihoods[-2])
+                if absdiff/abs(loglikelihoods[-2]) < self.thresh:
+                    self.converged_ = True
+                    break
+
+        return loglikelihoods[-1], {'weights': self.weights_,
+                                    'means': self.means_,
+                                    'covars': self.covars_,
+                                    'converged': self.converged_}
+
+    def _reg_covar(self, cov0, mcov, target_entropy):
+        def regularize_cov(reg_val):
+            return cov0 * (1 - reg_val) + np.eye(cov0.shape[0]) * reg_val
+
+        lo, hi = self.min_covar * (1 + np.array([-0.95, 2.95]))
+        ent = None
+        for d in range(15):
+            mi = np.mean([lo, hi])
+
+            c = regularize_cov(mi)
+            ent = _diff_entropy(c)
+            print('ent', ent)
+            if ent > target_entropy:
+                hi = mi
             else:
-                ag.info("Did not updated best")
+                lo = mi
 
-        self.weights_ = best_params['weights']
-        self.means_ = best_params['means']
-        self.covars_ = best_params['covars']
-        self.converged_ = best_params['converged']
+        mcov1 = np.mean([lo, hi])
+        print('mcov multiple', mcov1 / mcov)
+        return regularize_cov(mcov1)
+
+    def _em_statistics(self, X, resp):
+        """
+        E-step on `X`. Writes the responsibilities to `resp` and returns the
+        statistics that the M-step of the weights and means needs, which can
+        be summed over disjoint sets of samples (see
+        `PermutationMM._sufficient_statistics`).
+        """
+        logprob, log_resp = self.score_block_samples(X)
+        np.exp(log_resp, out=resp)
+
+        weighted_sum = None
+        if 'm' in self._params:
+            weighted_sum = self._weighted_sum(X, resp)
+
+        return dict(loglikelihood=logprob.sum(),
+                    resp_sum=resp.sum(0),
+                    weighted_sum=weighted_sum,
+                    n_samples=X.shape[0])
+
+    def _covar_statistics(self, X, resp):
+        """
+        Returns the scatter of `X` around the current means, weighted by the
+        responsibilities `resp`, and the total weight it is to be divided by.
+        Both can be summed over disjoint sets of samples.
+        """
+        N, P, D = X.shape
+        r = resp.sum(0).sum(1)
+
+        # The total weight of each covariance matrix, shaped to divide it
+        if self._covtype == 'tied':
+            total = N * P
+        elif self._covtype == 'full':
+            total = P * r[:, np.newaxis, np.newaxis]
+        elif self._covtype == 'full-full':
+            total = np.tile(r[:, np.newaxis], (1, P))[..., np.newaxis,
+                                                      np.newaxis]
+        elif self._covtype == 'full-perm':
+            total = np.tile(r.sum(), P)[:, np.newaxis, np.newaxis]
+        elif self._covtype == 'diag':
+            total = np.tile(r[:, np.newaxis], (1, P))[..., np.newaxis]
+        elif self._covtype == 'diag-perm':
+            total = np.tile(r.sum(), P)[:, np.newaxis]
+
+        if N == 0:
+            return dict(scatter=np.zeros(self.covars_.shape), total=total)
+
+        # The scatter of the sample blocks mapped to parameter block (k, p),
+        # around its mean m, expands to
+        #
+        #   sum_n sum_shift resp[n, k, shift] x x^T - m w^T - w m^T + r m m^T
+        #
+        # with x = X[n, permutations[shift, p]], w the weighted sum of these
+        # blocks and r the total weight. Everything is first centered on the
+        # mean of the means, which leaves the scatter the same, so that the
+        # terms do not cancel out.
+        center = self.means_.reshape((-1, D)).mean(0)
+        means = self.means_ - center
+
+        scatter = 0
+        for sl in self._sample_blocks(X):
+            Xc = X[sl].astype(np.float64) - center
+            scatter = scatter + self._second_moments(Xc, resp[sl])
+
+        weighted_sum = self._weighted_sum(X.astype(np.float64) - center, resp)
+        scatter = (scatter -
+                   self._outer_sum(means, weighted_sum) -
+                   self._outer_sum(weighted_sum, means) +
+                   self._outer_sum(r[:, np.newaxis, np.newaxis] * means,
+                                   means))
+
+        return dict(scatter=scatter, total=total)
+
+    def _weighted_sum(self, X, resp):
+        """
+        For each component and parameter block, the sum of the sample blocks
+        mapped to it, weighted by the responsibilities `resp` (see
+        `PermutationMM._weighted_sum`).
+        """
+        K = self.n_components
+        P = len(self.permutations)
+        shape = cyclic.fft_shape(self.permutations, self.use_fft)
+        if shape is not None:
+            return cyclic.inverse_spectrum(
+                cyclic.weighted_spectrum(resp, X, shape), shape)
+
+        weighted_sum = np.zeros((K,) + X.shape[1:])
+        for p in range(P):
+            for shift in range(P):
+                p0 = self.permutations[shift, p]
+                weighted_sum[:, p] += np.dot(resp[:, :, shift].T, X[:, p0])
+        return weighted_sum
+
+    def _second_moments(self, X, resp):
+        """
+        The sums of ``resp[n, k, shift] x x^T`` over the samples and shifts,
+        where ``x = X[n, permutations[shift, p]]``, summed over the
+        components and parameter blocks that share a covariance matrix (only
+        the diagonals for the diagonal types).
+        """
+        N, P, D = X.shape
+        K = self.n_components
+
+        if self._covtype in ('diag', 'diag-perm'):
+            moments = self._weighted_sum(X ** 2, resp)
+            return moments if self._covtype == 'diag' else moments.sum(0)
+
+        rows = X.reshape((-1, D))
+        if self._covtype == 'tied':
+            # For each shift, row ``permutations[shift]`` maps every sample
+            # block to exactly one parameter block. Summed over the parameter
+            # blocks, all blocks of a sample are then weighted alike. This
+            # holds for any permutations, since only the rows need to be
+            # permutations, not the columns (unlike the shared quadratic
+            # term of `score_block_samples`).
+            weights = np.repeat(resp.sum(2).sum(1), P)
+            return np.dot(rows.T * weights, rows)
+        elif self._covtype == 'full':
+            weights = np.repeat(resp.sum(2), P, axis=0)
+            return np.asarray([np.dot(rows.T * weights[:, k], rows)
+                               for k in range(K)])
+
+        moments = np.empty(self.covars_.shape)
+        resp_k = resp.sum(1)
+        for p in range(P):
+            # The sample blocks mapped to parameter block p, by shift
+            rows = X[:, self.permutations[:, p]].reshape((-1, D))
+            if self._covtype == 'full-perm':
+                moments[p] = np.dot(rows.T * resp_k.ravel(), rows)
+            else:
+                for k in range(K):
+                    moments[k, p] = np.dot(rows.T * resp[:, k].ravel(), rows)
+        return moments
+
+    def _outer_sum(self, A, B):
+        """
+        The sums of the outer products of blocks ``A[k, p]`` and ``B[k, p]``
+        over the components and parameter blocks that share a covariance
+        matrix. For the diagonal types, the products are elementwise.
+        """
+        D = A.shape[-1]
+        if self._covtype == 'diag':
+            return A * B
+        elif self._covtype == 'diag-perm':
+            return (A * B).sum(0)
+        elif self._covtype == 'tied':
+            return np.dot(A.reshape((-1, D)).T, B.reshape((-1, D)))
+        elif self._covtype == 'full':
+            return np.matmul(A.transpose((0, 2, 1)), B)
+        elif self._covtype == 'full-perm':
+            return np.matmul(A.transpose((1, 2, 0)), B.transpose((1, 0, 2)))
+        elif self._covtype == 'full-full':
+            return A[..., :, np.newaxis] * B[..., np.newaxis, :]
+
+    def _sample_blocks(self, X):
+        """
+        Slices of the blocks of samples that the scatter matrices are
+        summed over, so that each takes at most `block_bytes`.
+        """
+        N, P, D = X.shape
+        size = max(1, self.block_bytes // (P * D * 8))
+        for start in range(0, N, size):
+            yield slice(start, start + size)
 
     def predict_flat(self, X):
         """
@@ -506,3 +778,43 @@ class PermutationGMM(BaseEstimator):
         ii = self.predict_flat(X)
         sh = (self.n_components, len(self.permutations))
         return np.vstack(np.unravel_index(ii, sh)).T
+
+
+def _diff_entropy(cov):
+    sign, logdet = np.linalg.slogdet(cov)
+    return 0.5 * cov.shape[0] * np.log(2 * np.pi * np.e) + logdet
+
+
+def _maps_each_block_once(permutations):
+    """
+    Whether each sample block is mapped to each parameter block by exactly
+    one shift, that is, whether the columns of `permutations` are
+    permutations too (a Latin square), as for cyclic shifts.
+    """
+    P = len(permutations)
+    return np.array_equal(np.sort(permutations, axis=0),
+                          np.tile(np.arange(P)[:, np.newaxis], (1, P)))
+
+
+def _whiten(A, factor, transpose=False):
+    # Solves factor y = a (or factor^T y = a) for the vectors a along the
+    # last axis of A, where factor is a lower Cholesky factor or the standard
+    # deviations of a diagonal covariance
+    if factor.ndim == 1:
+        return A / factor
+    from scipy.linalg import solve_triangular
+    flat = A.reshape((-1, A.shape[-1])).T
+    white = solve_triangular(factor, flat, lower=True,
+                             trans='T' if transpose else 'N')
+    return white.T.reshape(A.shape)
+
+
+def _shard_em_statistics(shard, gmm, resp_shards):
+    # Runs on the worker that holds the shard
+    return gmm._em_statistics(shard.get(), resp_shards[shard.key].get())
+
+
+def _shard_covar_statistics(shard, gmm, resp_shards, limits):
+    n = limits[shard.key]
+    return gmm._covar_statistics(shard.get()[:n],
+                                 resp_shards[shard.key].get()[:n])
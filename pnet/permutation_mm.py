@@ -1,9 +1,13 @@
 import numpy as np
 import itertools as itr
 import amitgroup as ag
+import pnet
 from scipy.special import logit
 from scipy.misc import logsumexp
 from sklearn.base import BaseEstimator
+from pnet.profiler import record_em_iteration
+from pnet.restarts import derive_seeds, fit_restarts, best_restart
+from pnet import cyclic
 import time
 
 
@@ -39,6 +43,39 @@ class PermutationMM(BaseEstimator):
         Number of random initializations to perform with
         the best kept.
 
+    distributed : bool, optional
+        Fit with the samples split into shards across the workers of
+        `pnet.parallel`. Each worker computes the sufficient statistics of
+        its shard, and only these are sent back and summed. The shards stay
+        on the workers for all iterations and initializations.
+
+    parallel_restarts : bool, optional
+        Run the `n_init` initializations concurrently on the workers of
+        `pnet.parallel`, each seeded from `random_state`. The result does
+        not depend on the backend. Ignored when `distributed` is set.
+
+    block_bytes : int, optional
+        The E-step scores all permutations of a block of samples with one
+        matrix product, against a copy of the sample blocks gathered in the
+        order of each permutation. This is the size of that copy, which is
+        `n_permutations` times that of the samples. It is fastest when it
+        stays in the CPU cache.
+
+    use_fft : bool or 'auto', optional
+        If the permutations are the cyclic shifts of a grid of blocks (see
+        `pnet.cyclic.cyclic_shape`), as the integer permutations and those
+        of the oriented parts layers are, the E-step can score them with
+        FFTs over the grid instead, in ``O(P log P D)`` per sample instead of
+        ``O(P^2 D)``. See `pnet.cyclic.fft_shape` for 'auto'.
+
+    learning_decay : float, optional
+        Exponent of the decay of the step size of `partial_fit`, in (0.5, 1].
+        Smaller values forget older batches faster.
+
+    learning_offset : float, optional
+        Delays the decay of the step size of `partial_fit`, so that the
+        first batches do not weigh too much.
+
     Attributes
     ----------
     `weights_` : array, shape (`n_components`,)
@@ -50,9 +87,15 @@ class PermutationMM(BaseEstimator):
     `converged_` : bool
         True when convergence was reached in fit(), False otherwise.
 
+    `n_steps_` : int
+        Number of batches seen by `partial_fit`.
+
     """
     def __init__(self, n_components=1, permutations=1, n_iter=20, n_init=1,
-                 random_state=0, min_probability=0.05, thresh=1e-8):
+                 random_state=0, min_probability=0.05, thresh=1e-8,
+                 distributed=False, parallel_restarts=False,
+                 block_bytes=2**21, use_fft='auto', learning_decay=0.7,
+                 learning_offset=10.0):
         if not isinstance(random_state, np.random.RandomState):
             random_state = np.random.RandomState(random_state)
 
@@ -62,7 +105,7 @@ class PermutationMM(BaseEstimator):
         if isinstance(permutations, int):
             # Cycle through them
             P = permutations
-            self.permutations = np.zeros((P, P))
+            self.permutations = np.zeros((P, P), dtype=np.int64)
             for p1, p2 in itr.product(range(P), range(P)):
                 self.permutations[p1, p2] = (p1 + p2) % P
         else:
@@ -72,9 +115,17 @@ class PermutationMM(BaseEstimator):
         self.n_init = n_init
         self.min_probability = min_probability
         self.thresh = thresh
+        self.distributed = distributed
+        self.parallel_restarts = parallel_restarts
+        self.block_bytes = block_bytes
+        self.use_fft = use_fft
+        self.learning_decay = learning_decay
+        self.learning_offset = learning_offset
 
         self.weights_ = None
         self.means_ = None
+        self.n_steps_ = 0
+        self._running_stats = None
 
     def score_block_samples(self, X):
         """
@@ -103,15 +154,26 @@ class PermutationMM(BaseEstimator):
         K = self.n_components
         P = len(self.permutations)
 
-        unorm_log_resp = np.empty((N, K, P))
-        unorm_log_resp[:] = np.log(self.weights_[np.newaxis])
-        for p in range(P):
-            for shift in range(P):
-                p0 = self.permutations[shift, p]
-                LT = logit(self.means_[:, shift]).T
-                unorm_log_resp[:, :, p] += np.dot(X[:, p0], LT)
-
+        # Logits of all parameter blocks, in the order of the shifts
+        logits = logit(self.means_).reshape((K, -1))
         log_minus = np.log(1 - self.means_[:, self.permutations])
+
+        unorm_log_resp = np.empty((N, K, P))
+        shape = cyclic.fft_shape(self.permutations, self.use_fft)
+        if shape is not None:
+            logits_f = cyclic.spectrum(logits.reshape(self.means_.shape), shape)
+            for sl in self._sample_blocks(X, gathered=False):
+                unorm_log_resp[sl] = cyclic.correlate(X[sl], logits_f, shape)
+        else:
+            for sl in self._sample_blocks(X):
+                # For each p, the sample blocks that the parameter blocks are
+                # tested against: X[n, permutations[shift, p]] for each shift
+                XP = X[sl][:, self.permutations.T].astype(np.float64)
+                llh = np.dot(XP.reshape((-1, logits.shape[1])), logits.T)
+                llh = llh.reshape((-1, P, K))
+                unorm_log_resp[sl] = llh.transpose((0, 2, 1))
+
+        unorm_log_resp += np.log(self.weights_[np.newaxis])
         unorm_log_resp += log_minus.sum(2).sum(2)
 
         sh = (unorm_log_resp.shape[0], -1)
@@ -138,73 +200,217 @@ class PermutationMM(BaseEstimator):
         N, P, F = X.shape
 
         assert P == len(self.permutations)
-        K = self.n_components
-        eps = self.min_probability
 
-        max_log_prob = -np.inf
-
-        for trial in range(self.n_init):
-            self.weights_ = np.ones((K, P)) / (K * P)
-
-            # Initialize by picking K components at random.
-            repr_samples = X[self.random_state.choice(N, K, replace=False)]
-            self.means_ = repr_samples.clip(0.2, 0.8)
-
-            loglikelihoods = []
-            self.converged_ = False
-            for loop in range(self.n_iter):
-                start = time.clock()
-
-                # E-step
-                logprob, log_resp = self.score_block_samples(X)
-
-                resp = np.exp(log_resp)
-                sh = (-1, log_resp.shape[1])
-                _ldens = log_resp.transpose((0, 2, 1)).reshape(sh)
-                log_dens = logsumexp(_ldens, axis=0)[np.newaxis, :, np.newaxis]
-                dens = np.exp(log_dens)
-
-                # M-step
-                for p in range(P):
-                    v = 0.0
-                    for shift in range(P):
-                        p0 = self.permutations[shift, p]
-                        v += np.dot(resp[:, :, shift].T, X[:, p0])
-
-                    self.means_[:, p, :] = v
-                self.means_ /= dens.ravel()[:, np.newaxis, np.newaxis]
-                self.means_[:] = self.means_.clip(eps, 1 - eps)
-                wprime = np.apply_over_axes(np.sum, resp, [0])[0, :, :]
-                self.weights_[:] = (wprime / N).clip(0.0001, 1 - 0.0001)
-
-                # Calculate log likelihood
-                loglikelihoods.append(logprob.sum())
-
-                ag.info("Trial {trial}/{n_trials}  Iteration {iter}  "
-                        "Time {time:.2f}s  Log-likelihood {llh}".format(
-                            trial=trial+1,
-                            n_trials=self.n_init,
-                            iter=loop+1,
-                            time=time.clock() - start,
-                            llh=loglikelihoods[-1]))
-
-                if trial > 0:
-                    diff = loglikelihoods[-1] - loglikelihoods[-2]
-                    if abs(diff)/abs(loglikelihoods[-2]) < self.thresh:
-                        self.converged_ = True
-                        break
-
-            if loglikelihoods[-1] > max_log_prob:
-                ag.info("Updated best log likelihood to {0}".format(
-                    loglikelihoods[-1]))
-                max_log_prob = loglikelihoods[-1]
-                best_params = {'weights': self.weights_,
-                               'means': self.means_,
-                               'converged': self.converged_}
+        seeds = derive_seeds(self.random_state, self.n_init)
+
+        shards = None
+        if self.distributed:
+            shards = pnet.parallel.scatter(X)
+
+        try:
+            if shards is None:
+                results = fit_restarts(self, X, seeds,
+                                       parallel=self.parallel_restarts)
+            else:
+                # The workers are busy with the shards, so the restarts run
+                # one after another
+                results = [self._fit_restart(X, trial, seed, shards=shards)
+                           for trial, seed in enumerate(seeds)]
+        finally:
+            if shards is not None:
+                for shard in shards:
+                    pnet.parallel.unshare(shard)
+
+        max_log_prob, best_params = best_restart(results)
+        ag.info("Best log likelihood {0}".format(max_log_prob))
 
         self.weights_ = best_params['weights']
         self.means_ = best_params['means']
         self.converged_ = best_params['converged']
+        self.n_steps_ = 0
+        self._running_stats = None
+
+    def _fit_restart(self, X, trial, seed, shards=None):
+        """
+        Runs EM from the random initialization given by `seed`. Returns the
+        final log-likelihood and the parameters.
+        """
+        N, P, F = X.shape
+        self._init_params(X, np.random.RandomState(seed))
+
+        loglikelihoods = []
+        self.converged_ = False
+        for loop in range(self.n_iter):
+            start = time.time()
+
+            # E-step
+            if shards is None:
+                stats = self._sufficient_statistics(X)
+            else:
+                stats = _sum_statistics(pnet.parallel.map_shards(
+                    _shard_statistics, shards, args=(self,)))
+
+            self._m_step(stats, N)
+
+            # Calculate log likelihood
+            loglikelihoods.append(stats['loglikelihood'])
+            elapsed = time.time() - start
+            record_em_iteration('PermutationMM', trial, loop, elapsed,
+                                loglikelihoods[-1])
+
+            ag.info("Trial {trial}/{n_trials}  Iteration {iter}  "
+                    "Time {time:.2f}s  Log-likelihood {llh}".format(
+                        trial=trial+1,
+                        n_trials=self.n_init,
+                        iter=loop+1,
+                        time=elapsed,
+                        llh=loglikelihoods[-1]))
+
+            if loop > 0:
+                diff = loglikelihoods[-1] - loglikelihoods[-2]
+                if abs(diff)/abs(loglikelihoods[-2]) < self.thresh:
+                    self.converged_ = True
+                    break
+
+        return loglikelihoods[-1], {'weights': self.weights_,
+                                    'means': self.means_,
+                                    'converged': self.converged_}
+
+    def partial_fit(self, X):
+        """
+        One step of stepwise (online) EM on the batch `X`, of shape
+        `(n, n_permutations, n_features)`.
+
+        The first call initializes the parameters from `X` (at least
+        `n_components` samples), unless they are already set, for instance
+        by `fit`, in which case the running statistics start from the ones
+        that the parameters imply. Each call then does an E-step on `X` and
+        blends its sufficient statistics, averaged over the batch, into the
+        running ones with the step size ``(n_steps_ + learning_offset) **
+        -learning_decay`` (1 for the first batch of a new model), followed
+        by an M-step on these. Only the running statistics are kept, so that
+        the model can be learned from any number of batches, streamed from
+        disk or from a patch sampler, in constant memory.
+        """
+        assert X.ndim == 3
+        N, P, F = X.shape
+        assert P == len(self.permutations)
+
+        start = time.time()
+        if self.means_ is None:
+            self._init_params(X, self.random_state)
+        elif self._running_stats is None:
+            self._running_stats = self._model_statistics()
+
+        stats = self._sufficient_statistics(X)
+        stats = {k: v / N for k, v in stats.items()}
+        if self._running_stats is None:
+            self._running_stats = stats
+        else:
+            step = ((self.n_steps_ + self.learning_offset) **
+                    -self.learning_decay)
+            self._running_stats = {k: (1 - step) * v + step * stats[k]
+                                   for k, v in self._running_stats.items()}
+        self._m_step(self._running_stats, 1)
+
+        elapsed = time.time() - start
+        record_em_iteration('PermutationMM', 0, self.n_steps_, elapsed,
+                            stats['loglikelihood'])
+        ag.info("Step {step}  Time {time:.2f}s  Log-likelihood per sample "
+                "{llh}".format(step=self.n_steps_ + 1,
+                               time=elapsed,
+                               llh=stats['loglikelihood']))
+        self.n_steps_ += 1
+        return self
+
+    def _init_params(self, X, rs):
+        """
+        Initializes the parameters from `K` samples of `X` picked at random
+        with `rs`.
+        """
+        N, P, F = X.shape
+        K = self.n_components
+        self.weights_ = np.ones((K, P)) / (K * P)
+        repr_samples = X[rs.choice(N, K, replace=False)]
+        self.means_ = repr_samples.clip(0.2, 0.8)
+
+    def _model_statistics(self):
+        """
+        Sufficient statistics per sample that the M-step maps to the current
+        parameters (up to their clipping).
+        """
+        return dict(resp_sum=self.weights_.copy(),
+                    weighted_sum=(self.means_ *
+                                  self.weights_.sum(1)[:, np.newaxis,
+                                                       np.newaxis]))
+
+    def _m_step(self, stats, n_samples):
+        """
+        Sets the parameters from sufficient statistics summed over
+        `n_samples` samples (see `_sufficient_statistics`).
+        """
+        eps = self.min_probability
+        dens = stats['resp_sum'].sum(1)
+        self.means_[:] = stats['weighted_sum']
+        self.means_ /= dens[:, np.newaxis, np.newaxis]
+        self.means_[:] = self.means_.clip(eps, 1 - eps)
+        wprime = stats['resp_sum']
+        self.weights_[:] = (wprime / n_samples).clip(0.0001, 1 - 0.0001)
+
+    def _sufficient_statistics(self, X):
+        """
+        E-step on `X`. Returns the statistics that the M-step needs, which
+        can be summed over disjoint sets of samples:
+
+        * ``loglikelihood``: sum of the log probabilities of the samples.
+        * ``resp_sum``: responsibilities summed over samples, shape `(K, P)`.
+        * ``weighted_sum``: for each component and parameter block, the sum
+          of the sample blocks mapped to it, weighted by the
+          responsibilities, shape `(K, P, D)`.
+        """
+        logprob, log_resp = self.score_block_samples(X)
+        resp = np.exp(log_resp)
+
+        return dict(loglikelihood=logprob.sum(),
+                    resp_sum=resp.sum(0),
+                    weighted_sum=self._weighted_sum(X, resp))
+
+    def _weighted_sum(self, X, resp):
+        """
+        For each component and parameter block, the sum of the sample blocks
+        mapped to it, weighted by the responsibilities `resp`.
+        """
+        K = self.n_components
+        shape = cyclic.fft_shape(self.permutations, self.use_fft)
+        if shape is not None:
+            weighted_f = 0
+            for sl in self._sample_blocks(X, gathered=False):
+                weighted_f = weighted_f + cyclic.weighted_spectrum(resp[sl],
+                                                                   X[sl],
+                                                                   shape)
+            return cyclic.inverse_spectrum(weighted_f, shape)
+
+        # Responsibilities with rows by sample and shift
+        resp_rows = np.ascontiguousarray(resp.transpose((0, 2, 1)))
+        weighted_sum = np.zeros((K, X[0].size))
+        for sl in self._sample_blocks(X):
+            # X[n, permutations[shift, p]], with rows by sample and shift
+            XS = X[sl][:, self.permutations].astype(np.float64)
+            XS = XS.reshape((-1, weighted_sum.shape[1]))
+            weighted_sum += np.dot(resp_rows[sl].reshape((-1, K)).T, XS)
+        return weighted_sum.reshape((K,) + X.shape[1:])
+
+    def _sample_blocks(self, X, gathered=True):
+        """
+        Slices of the blocks of samples that the E-step is done in, so that
+        the gathered sample blocks of each take at most `block_bytes`, or
+        the samples themselves if not `gathered` (for the FFTs).
+        """
+        N, P, D = X.shape
+        copies = P if gathered else 1
+        size = max(1, self.block_bytes // (copies * P * D * 8))
+        for start in range(0, N, size):
+            yield slice(start, start + size)
 
     def predict_flat(self, X):
         """
@@ -249,3 +455,13 @@ class PermutationMM(BaseEstimator):
         ii = self.predict_flat(X)
         sh = (self.n_components, len(self.permutations))
         return np.vstack(np.unravel_index(ii, sh)).T
+
+
+def _shard_statistics(shard, mm):
+    # Runs on the worker that holds the shard
+    return mm._sufficient_statistics(shard.get())
+
+
+def _sum_statistics(stats):
+    return {k: None if stats[0][k] is None else sum(st[k] for st in stats)
+            for k in stats[0]}
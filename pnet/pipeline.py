@@ -0,0 +1,114 @@
+from __future__ import division, print_function, absolute_import
+
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Marks the end of the stream
+_DONE = object()
+# Seconds between checks of the stop flag while blocked on a queue
+_POLL = 0.1
+
+
+class _Failure(object):
+    """An exception raised in a stage, passed on to the consumer"""
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def pipeline(stages, items, queue_size=2):
+    """
+    Runs each item through a chain of functions, with each function (stage)
+    in its own thread. Consecutive stages are connected by queues holding at
+    most `queue_size` items, so that a slow stage blocks the ones before it
+    instead of piling up their outputs.
+
+    While one stage works on an item, the stages before it can start on the
+    next ones. This only pays off if the stages release the GIL for most of
+    their work, such as NumPy, BLAS and the ``nogil`` Cython kernels.
+
+    Parameters
+    ----------
+    stages : list of callables
+        Each stage is called with the output of the previous one.
+    items : iterable
+        Inputs to the first stage. It is consumed from a separate thread.
+    queue_size : int
+        Maximum number of items waiting between two stages.
+
+    Yields
+    ------
+    output :
+        Output of the last stage for each item, in the same order as `items`.
+        An exception raised by a stage (or by `items`) is raised here.
+    """
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=_POLL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=_POLL)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def feed():
+        try:
+            for item in items:
+                if not put(queues[0], item):
+                    return
+        except Exception:
+            put(queues[0], _Failure(sys.exc_info()[1]))
+            return
+        put(queues[0], _DONE)
+
+    def work(stage, q_in, q_out):
+        while True:
+            item = get(q_in)
+            if item is _DONE or isinstance(item, _Failure):
+                put(q_out, item)
+                return
+            try:
+                output = stage(item)
+            except Exception:
+                put(q_out, _Failure(sys.exc_info()[1]))
+                return
+            if not put(q_out, output):
+                return
+
+    threads = [threading.Thread(target=feed)]
+    for i, stage in enumerate(stages):
+        threads.append(threading.Thread(target=work,
+                                        args=(stage, queues[i],
+                                              queues[i + 1])))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                break
+            elif isinstance(item, _Failure):
+                raise item.exc
+            yield item
+    finally:
+        # Also reached if the consumer stops early
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -1,6 +1,7 @@
 from __future__ import division, print_function, absolute_import
 
-from pnet.layer import Layer
+from pnet.layer import Layer, FeatureSpec
+from pnet.bitpack import PackedBits
 import pnet
 import numpy as np
 import itertools as itr
@@ -8,6 +9,9 @@ import amitgroup as ag
 
 @Layer.register('pooling-layer')
 class PoolingLayer(Layer):
+    # Max pooling of packed binary maps ORs the packed bytes (see
+    # `_pool_packed`)
+    accepts_packed = True
 
     def __init__(self, shape=None, strides=None, final_shape=None,
                  operation='max', settings={}):
@@ -32,39 +36,92 @@ class PoolingLayer(Layer):
         else:
             return self._strides
 
-    def _extract(self, phi, data):
-        X_F = phi(data)
-        output_dtype = self._settings.get('output_dtype')
-        if isinstance(X_F, tuple):
-            X = X_F[0]
-            F = X_F[1]
+    @property
+    def fusable(self):
+        """
+        Whether this layer can be fused with the parts layer below it (see
+        `_extract_fused`).
+        """
+        return self._shape is not None and self._operation in ('max', 'sum')
 
-            #if X.ndim == 3:
-                #from pnet.cyfuncs import index_map_pooling as poolf
-            #else:
+    def _pool_index_map(self, X_F):
+        X = X_F[0]
+        F = X_F[1]
 
-            shape = self.calc_shape(X.shape[1:3])
-            strides = self.calc_strides(X.shape[1:3])
+        #if X.ndim == 3:
+            #from pnet.cyfuncs import index_map_pooling as poolf
+        #else:
 
-            if self._operation == 'max':
-                from pnet.cyfuncs import index_map_pooling_multi as poolf
-                feature_map = poolf(X, F, shape, strides)
+        shape = self.calc_shape(X.shape[1:3])
+        strides = self.calc_strides(X.shape[1:3])
 
-            elif self._operation == 'sum':
-                from pnet.cyfuncs import index_map_sum_pooling_multi as poolf
-                feature_map = poolf(X, F, shape, strides)
+        if self._operation == 'max':
+            from pnet.cyfuncs import index_map_pooling_multi as poolf
+            feature_map = poolf(X, F, shape, strides)
 
-            else:
-                raise ValueError('Unknown pooling operation: {}'.format(
-                                 self._operation))
+        elif self._operation == 'sum':
+            from pnet.cyfuncs import index_map_sum_pooling_multi as poolf
+            feature_map = poolf(X, F, shape, strides)
 
-            c = ag.apply_once(np.mean, feature_map, [0, 1, 2], keepdims=False)
-            self._extract_info['concentration'] = c
+        else:
+            raise ValueError('Unknown pooling operation: {}'.format(
+                             self._operation))
 
-            if output_dtype is not None:
-                return feature_map.astype(output_dtype)
-            else:
-                return feature_map
+        return feature_map
+
+    def _finish_index_map_pooling(self, feature_map):
+        c = ag.apply_once(np.mean, feature_map, [0, 1, 2], keepdims=False)
+        self._extract_info['concentration'] = c
+
+        output_dtype = self._settings.get('output_dtype')
+        if output_dtype is not None:
+            return feature_map.astype(output_dtype)
+        else:
+            return feature_map
+
+    def _extract_fused(self, parts_layer, phi, data):
+        """
+        Extracts the output of this layer applied to `parts_layer`, where
+        `phi` extracts the input of `parts_layer`. The parts layer codes and
+        pools in one pass (see its `_extract_pooled`), so its index map is
+        never materialized.
+        """
+        feature_map = parts_layer._extract_pooled(phi, data, self)
+        return self._finish_index_map_pooling(feature_map)
+
+    def _pool_packed(self, X):
+        """
+        Max pools the `PackedBits` map `X` over the regions of `final_shape`.
+        The maximum of binary channels is their OR, so the bytes are pooled
+        as they are and the result stays packed.
+        """
+        fs = self._final_shape
+        bits = X.bits
+        x_bounds = np.round(np.arange(fs[0]+1) * bits.shape[1] / fs[0]).astype(np.int_)
+        y_bounds = np.round(np.arange(fs[1]+1) * bits.shape[2] / fs[1]).astype(np.int_)
+
+        pooled = np.zeros((bits.shape[0],) + tuple(fs) + bits.shape[3:],
+                          dtype=np.uint8)
+        for i, j in itr.product(range(fs[0]), range(fs[1])):
+            patch = bits[:, x_bounds[i]:x_bounds[i+1], y_bounds[j]:y_bounds[j+1]]
+            pooled[:, i, j] = np.bitwise_or.reduce(
+                patch.reshape((patch.shape[0], -1, patch.shape[-1])), axis=1)
+
+        # Same dtype as the unpacked path
+        output_dtype = self._settings.get('output_dtype')
+        return PackedBits(pooled, X.n_channels, dtype=np.dtype(output_dtype))
+
+    def _extract(self, phi, data):
+        X_F = phi(data)
+        output_dtype = self._settings.get('output_dtype')
+        if isinstance(X_F, PackedBits):
+            if self._operation == 'max' and self._final_shape is not None:
+                return self._pool_packed(X_F)
+            X_F = X_F.unpack()
+
+        if isinstance(X_F, tuple):
+            feature_map = self._pool_index_map(X_F)
+            return self._finish_index_map_pooling(feature_map)
 
         else:
             X = X_F
@@ -105,6 +162,30 @@ class PoolingLayer(Layer):
                 raise NotImplementedError('Not yet')
 
 
+    def output_spec(self, input_spec):
+        output_dtype = self._settings.get('output_dtype')
+        if input_spec.n_features is not None:
+            if self._operation not in ('max', 'sum'):
+                return None
+            strides = self.calc_strides(input_spec.shape[:2])
+            shape = (input_spec.shape[0] // strides[0],
+                     input_spec.shape[1] // strides[1],
+                     input_spec.n_features)
+            if output_dtype is not None:
+                dtype = output_dtype
+            elif self._operation == 'max':
+                dtype = np.uint8
+            else:
+                dtype = np.int64
+            return FeatureSpec(shape, dtype)
+
+        elif self._final_shape is not None:
+            shape = tuple(self._final_shape) + input_spec.shape[-1:]
+            return FeatureSpec(shape, np.dtype(output_dtype))
+
+        else:
+            return None
+
     @property
     def pos_matrix(self):
         if self._final_shape is not None:
@@ -0,0 +1,189 @@
+from __future__ import division, print_function, absolute_import
+
+import time
+import json
+from contextlib import contextmanager
+from collections import OrderedDict
+import numpy as np
+from pnet.feature_cache import _nbytes
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    _cpu_time = time.process_time
+except AttributeError:
+    _cpu_time = time.clock
+
+# Profiler that EM iterations are reported to (see `record_em_iteration`)
+_g_active = None
+
+
+def active():
+    """Returns the profiler that is currently recording, or None"""
+    return _g_active
+
+
+def record_em_iteration(model, trial, iteration, seconds, loglikelihood):
+    """
+    Called by the mixture models after each EM iteration. Does nothing unless
+    a profiler is recording.
+    """
+    if _g_active is not None:
+        _g_active.em_iterations.append(dict(model=model,
+                                            trial=trial,
+                                            iteration=iteration,
+                                            wall=seconds,
+                                            loglikelihood=float(loglikelihood)))
+
+
+class _Frame(object):
+    def __init__(self, key, n_samples, in_bytes):
+        self.key = key
+        self.n_samples = n_samples
+        self.in_bytes = in_bytes
+        self.output = None
+        self.child_wall = 0.0
+        self.child_cpu = 0.0
+        self.child_out_bytes = None
+        self.mem_start = 0
+        self.peak = 0
+
+
+class Profiler(object):
+    """
+    Records wall time, CPU time, throughput, input/output bytes and
+    (optionally) peak allocation of each layer's `_train` and `_extract`, as
+    well as the EM iterations of the mixture models.
+
+    Since a layer pulls its input from the layers below it, the times are
+    exclusive: the time spent in the layers below is subtracted. Peak
+    allocation is inclusive and relative to the allocation at entry.
+
+    Parameters
+    ----------
+    trace_memory : bool
+        Track peak allocation with `tracemalloc`. This slows down extraction.
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory and tracemalloc is not None
+        self.reset()
+
+    def reset(self):
+        self.stats = OrderedDict()
+        self.em_iterations = []
+        self._stack = []
+        self._wall = 0.0
+        self._started = None
+
+    def start(self):
+        global _g_active
+        _g_active = self
+        self._started = time.time()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop(self):
+        global _g_active
+        if _g_active is self:
+            _g_active = None
+        if self._started is not None:
+            self._wall += time.time() - self._started
+            self._started = None
+
+    @contextmanager
+    def measure(self, index, name, kind, X):
+        """
+        Measures one call. The caller should set ``frame.output`` to the
+        output, so that its size can be recorded.
+        """
+        n_samples = len(X) if isinstance(X, np.ndarray) else None
+        frame = _Frame((index, name, kind), n_samples, _nbytes(X))
+
+        if self.trace_memory:
+            frame.mem_start = frame.peak = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+
+        self._stack.append(frame)
+        wall0 = time.time()
+        cpu0 = _cpu_time()
+        try:
+            yield frame
+        finally:
+            wall = time.time() - wall0
+            cpu = _cpu_time() - cpu0
+            self._stack.pop()
+
+            peak = None
+            if self.trace_memory:
+                peak = max(frame.peak, tracemalloc.get_traced_memory()[1])
+
+            out_bytes = _nbytes(frame.output)
+            if self._stack:
+                parent = self._stack[-1]
+                parent.child_wall += wall
+                parent.child_cpu += cpu
+                parent.child_out_bytes = out_bytes
+                if peak is not None:
+                    parent.peak = max(parent.peak, peak)
+                    if hasattr(tracemalloc, 'reset_peak'):
+                        tracemalloc.reset_peak()
+
+            # The input of a layer is the output of the layer below
+            if frame.child_out_bytes is not None:
+                in_bytes = frame.child_out_bytes
+            else:
+                in_bytes = frame.in_bytes
+
+            self._add(frame.key,
+                      wall=wall - frame.child_wall,
+                      cpu=cpu - frame.child_cpu,
+                      samples=frame.n_samples or 0,
+                      in_bytes=in_bytes,
+                      out_bytes=out_bytes,
+                      peak=None if peak is None else peak - frame.mem_start)
+
+    def _add(self, key, wall, cpu, samples, in_bytes, out_bytes, peak):
+        if key not in self.stats:
+            self.stats[key] = dict(calls=0, wall=0.0, cpu=0.0, samples=0,
+                                   in_bytes=0, out_bytes=0, peak_bytes=None)
+        st = self.stats[key]
+        st['calls'] += 1
+        st['wall'] += wall
+        st['cpu'] += cpu
+        st['samples'] += samples
+        st['in_bytes'] += in_bytes
+        st['out_bytes'] += out_bytes
+        if peak is not None:
+            st['peak_bytes'] = max(st['peak_bytes'] or 0, peak)
+
+    def report(self):
+        """
+        Returns the recorded statistics as a JSON-serializable dictionary.
+        """
+        layers = OrderedDict()
+        for (index, name, kind), st in self.stats.items():
+            entry = layers.setdefault(index, OrderedDict(index=index,
+                                                         name=name))
+            st = dict(st)
+            if st['wall'] > 0:
+                st['samples_per_sec'] = st['samples'] / st['wall']
+            else:
+                st['samples_per_sec'] = None
+            entry[kind] = st
+
+        wall = self._wall
+        if self._started is not None:
+            wall += time.time() - self._started
+
+        return dict(wall=wall,
+                    layers=[layers[i] for i in sorted(layers)],
+                    em_iterations=list(self.em_iterations))
+
+    def save(self, path):
+        """Writes the report to a JSON file"""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, default=str)
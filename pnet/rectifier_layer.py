@@ -15,6 +15,9 @@ class RectifierLayer(Layer):
         else:
             raise ValueError("Unknown recitifer")
 
+    def output_spec(self, input_spec):
+        return input_spec
+
     def save_to_dict(self):
         d = {}
         d['rectifier'] = self._rectifier
@@ -0,0 +1,57 @@
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+from sklearn.utils import check_random_state
+import pnet
+from pnet.shared_objects import resolve
+
+
+def derive_seeds(random_state, n_init):
+    """
+    Draws one seed per restart from `random_state`. Each restart seeds its
+    own generator, so that its result does not depend on where, or in which
+    order, the restarts are run.
+    """
+    rs = check_random_state(random_state)
+    return [int(seed) for seed in rs.randint(np.iinfo(np.int32).max,
+                                             size=n_init)]
+
+
+def fit_restarts(model, X, seeds, parallel=False):
+    """
+    Calls ``model._fit_restart(X, trial, seed)`` for each seed and returns
+    the results in order.
+
+    With `parallel`, the restarts run concurrently on the workers of
+    `pnet.parallel`, with `X` shared once. Each worker fits its own copy of
+    `model`, so the restarts must not rely on state left by the previous
+    one.
+    """
+    if not parallel or len(seeds) <= 1:
+        return [model._fit_restart(X, trial, seed)
+                for trial, seed in enumerate(seeds)]
+
+    X_handle = pnet.parallel.share(X)
+    try:
+        return list(pnet.parallel.starmap(
+            _fit_restart,
+            [(model, X_handle, trial, seed)
+             for trial, seed in enumerate(seeds)]))
+    finally:
+        pnet.parallel.unshare(X_handle)
+
+
+def _fit_restart(model, X, trial, seed):
+    return model._fit_restart(resolve(X), trial, seed)
+
+
+def best_restart(results):
+    """
+    Returns the ``(loglikelihood, params)`` result with the highest
+    log-likelihood, the first one among ties.
+    """
+    best = None
+    for res in results:
+        if best is None or res[0] > best[0]:
+            best = res
+    return best
@@ -115,6 +115,7 @@ class RotationMixtureClassificationLayer(SupervisedLayer):
             n_init = self._settings.get('n_init', 1)
             n_iter = self._settings.get('n_iter', 10)
             seed = self._settings.get('seed', 0)
+            parallel_restarts = self._settings.get('parallel_restarts', False)
 
             ORI = self._n_orientations
             POL = 1
@@ -140,7 +141,8 @@ class RotationMixtureClassificationLayer(SupervisedLayer):
                                    n_iter=n_iter,
                                    n_init=n_init,
                                    random_state=seed,
-                                   min_probability=self._min_prob)
+                                   min_probability=self._min_prob,
+                                   parallel_restarts=parallel_restarts)
                 mm.fit(blocks)
                 comps = mm.predict(blocks)
                 mu_shape = (self._n_components * self._n_orientations,) + shape
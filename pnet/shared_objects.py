@@ -0,0 +1,75 @@
+from __future__ import division, print_function, absolute_import
+
+import os
+import itertools as itr
+
+# Objects resident in this process, by key
+_g_objects = {}
+_g_counter = itr.count()
+
+
+class Handle(object):
+    """
+    Reference to an object that was shared with the workers once (see
+    ``pnet.parallel.share``). Tasks take the handle instead of the object, so
+    that only the handle is sent with each task.
+
+    Parameters
+    ----------
+    key : str
+        Key of the object in each process.
+    source : object or None
+        Where a worker can load the object from the first time it is used,
+        for backends that do not push it to the workers. Needs a ``load()``
+        method.
+    worker : int or None
+        The worker that holds the object, if only one does (see
+        ``pnet.parallel.scatter``).
+    """
+    def __init__(self, key, source=None, worker=None):
+        self.key = key
+        self.source = source
+        self.worker = worker
+
+    def get(self):
+        """Returns the object"""
+        if self.key not in _g_objects:
+            obj = None
+            if self.source is not None:
+                try:
+                    obj = self.source.load()
+                except (IOError, OSError):
+                    pass
+            if obj is None:
+                raise KeyError('Shared object {} is not available in this '
+                               'process. It may have been unshared.'
+                               .format(self.key))
+            _g_objects[self.key] = obj
+        return _g_objects[self.key]
+
+    def __repr__(self):
+        return 'Handle({!r})'.format(self.key)
+
+
+def new_key():
+    return '{}-{}'.format(os.getpid(), next(_g_counter))
+
+
+def register(key, obj):
+    _g_objects[key] = obj
+
+
+def release(key):
+    _g_objects.pop(key, None)
+
+
+def clear():
+    _g_objects.clear()
+
+
+def resolve(x):
+    """Returns the object behind `x` if it is a `Handle`, otherwise `x`"""
+    if isinstance(x, Handle):
+        return x.get()
+    else:
+        return x
@@ -19,6 +19,9 @@ class SpreadingLayer(Layer):
                                           radius=self._radius)
         return feature_map
 
+    def output_spec(self, input_spec):
+        return input_spec
+
     def _vzlog_output_(self, vz):
         pass
 
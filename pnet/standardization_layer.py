@@ -1,5 +1,5 @@
 from __future__ import division, print_function, absolute_import
-from pnet.layer import Layer
+from pnet.layer import Layer, FeatureSpec
 import numpy as np
 
 
@@ -29,6 +29,9 @@ class StandardizationLayer(Layer):
 
         return Xflat.reshape(X.shape) + self._bias
 
+    def output_spec(self, input_spec):
+        return FeatureSpec(input_spec.shape, np.float64)
+
     def save_to_dict(self):
         d = {}
         d['means'] = self._means
@@ -0,0 +1,191 @@
+from __future__ import division, print_function, absolute_import
+
+import os
+import json
+import time
+import itertools as itr
+import numpy as np
+
+# Statistics of the last map call (see `last_stats`)
+_g_last = None
+# File that task records are appended to, or None
+_g_trace_path = os.environ.get('PNET_TRACE')
+_g_map_counter = itr.count()
+
+
+def last_stats():
+    """
+    Returns the `MapStats` of the last map call of the parallel backend, or
+    None if there has been none (the serial fallback records nothing).
+    """
+    return _g_last
+
+
+def set_trace(path):
+    """
+    Appends a JSON line for every task of every following map call to
+    `path`, or stops tracing if `path` is None. Can also be set with the
+    environment variable ``PNET_TRACE``.
+    """
+    global _g_trace_path
+    _g_trace_path = path
+
+
+class MapStats(object):
+    """
+    Timings of one map call, recorded by the master as the tasks are sent
+    off and their results come back.
+
+    For each task, the master records when it was sent and received and the
+    bytes in each direction, and the worker reports its compute time.
+    Whatever is left of the round trip is time spent in transfer or in the
+    worker's queue.
+
+    Parameters
+    ----------
+    backend : str
+        Name of the backend.
+    n_workers : int
+        Number of workers.
+    """
+    def __init__(self, backend, n_workers):
+        self.backend = backend
+        self.n_workers = n_workers
+        self.map_id = next(_g_map_counter)
+        self.tasks = {}
+        self.start = time.time()
+        self.end = None
+        # Number of tasks in flight, and since when (for the time average)
+        self._depth = 0
+        self._depth_since = self.start
+        self._depth_area = 0.0
+        self.max_queue_depth = 0
+
+    def _set_depth(self, depth):
+        now = time.time()
+        self._depth_area += self._depth * (now - self._depth_since)
+        self._depth = depth
+        self._depth_since = now
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def sent(self, job_index, worker, nbytes):
+        self.tasks[job_index] = dict(job=job_index,
+                                     worker=worker,
+                                     sent=time.time(),
+                                     received=None,
+                                     compute=None,
+                                     bytes_sent=nbytes,
+                                     bytes_received=None)
+        self._set_depth(self._depth + 1)
+
+    def received(self, job_index, worker, compute, nbytes):
+        task = self.tasks[job_index]
+        task['received'] = time.time()
+        task['compute'] = compute
+        task['bytes_received'] = nbytes
+        # For the local pool, the worker is only known once it has run the
+        # task
+        task['worker'] = worker
+        self._set_depth(self._depth - 1)
+
+    def finish(self):
+        if self.end is not None:
+            return
+        self._set_depth(self._depth)
+        self.end = time.time()
+
+        global _g_last
+        _g_last = self
+        if _g_trace_path is not None:
+            self.write_trace(_g_trace_path)
+
+    def write_trace(self, path):
+        with open(path, 'a') as f:
+            for job_index in sorted(self.tasks):
+                task = dict(self.tasks[job_index])
+                task['map'] = self.map_id
+                task['backend'] = self.backend
+                task['sent'] -= self.start
+                if task['received'] is not None:
+                    task['received'] -= self.start
+                f.write(json.dumps(task, default=str) + '\n')
+
+    def summary(self):
+        """
+        Returns a JSON-serializable dictionary with:
+
+        * ``wall``: duration of the map call.
+        * ``tasks``, ``bytes_sent``, ``bytes_received``: totals over tasks.
+        * ``compute``, ``round_trip``, ``overhead``: mean, median and max
+          seconds per task, where overhead is round trip minus compute.
+        * ``queue_depth``: time-averaged and max number of tasks in flight.
+        * ``workers``: for each worker, its tasks, compute seconds and busy
+          fraction (compute over wall).
+        * ``straggler``: the task with the longest compute time, and how many
+          times the median that is.
+        """
+        end = self.end if self.end is not None else time.time()
+        wall = end - self.start
+        done = [t for t in self.tasks.values() if t['received'] is not None]
+
+        def dist(values):
+            if not values:
+                return None
+            return dict(mean=float(np.mean(values)),
+                        median=float(np.median(values)),
+                        max=float(np.max(values)))
+
+        compute = [t['compute'] for t in done]
+        round_trip = [t['received'] - t['sent'] for t in done]
+
+        workers = {}
+        for t in done:
+            w = workers.setdefault(t['worker'], dict(tasks=0, compute=0.0))
+            w['tasks'] += 1
+            w['compute'] += t['compute']
+        for w in workers.values():
+            w['busy_fraction'] = w['compute'] / wall if wall > 0 else None
+
+        straggler = None
+        if done:
+            slowest = max(done, key=lambda t: t['compute'])
+            median = np.median(compute)
+            straggler = dict(job=slowest['job'],
+                             worker=slowest['worker'],
+                             compute=slowest['compute'],
+                             vs_median=(slowest['compute'] / median
+                                        if median > 0 else None))
+
+        depth_area = self._depth_area
+        if self.end is None:
+            depth_area += self._depth * (end - self._depth_since)
+
+        return dict(backend=self.backend,
+                    n_workers=self.n_workers,
+                    wall=wall,
+                    tasks=len(done),
+                    bytes_sent=sum(t['bytes_sent'] for t in done),
+                    bytes_received=sum(t['bytes_received'] for t in done),
+                    compute=dist(compute),
+                    round_trip=dist(round_trip),
+                    overhead=dist([r - c for r, c in zip(round_trip,
+                                                         compute)]),
+                    queue_depth=dict(mean=depth_area / wall if wall > 0
+                                     else 0.0,
+                                     max=self.max_queue_depth),
+                    workers={str(k): v for k, v in sorted(workers.items())},
+                    straggler=straggler)
+
+    def __repr__(self):
+        s = self.summary()
+        return ('MapStats(backend={}, tasks={}, wall={:.3f}s, '
+                'mean busy={})'.format(
+                    s['backend'], s['tasks'], s['wall'],
+                    _mean_busy(s['workers'], self.n_workers)))
+
+
+def _mean_busy(workers, n_workers):
+    if not workers or not n_workers:
+        return None
+    total = sum(w['busy_fraction'] or 0 for w in workers.values())
+    return '{:.0%}'.format(total / n_workers)
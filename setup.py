@@ -1,15 +1,30 @@
+import os
 from distutils.core import setup
+from distutils.extension import Extension
 from Cython.Build import cythonize
-from Cython.Distutils import extension
 import numpy as np
 
+# The kernels in pnet/cyfuncs.pyx run their loops over samples on several
+# threads with OpenMP (see `pnet.cyfuncs.set_num_threads`). Set PNET_OPENMP=0
+# to build without it (for instance with Apple's clang), in which case they
+# run on one thread.
+if os.environ.get('PNET_OPENMP', '1') != '0':
+    openmp_args = ['-fopenmp']
+else:
+    openmp_args = []
+
+extensions = [
+    Extension('pnet.*', ['pnet/*.pyx'],
+              extra_compile_args=openmp_args,
+              extra_link_args=openmp_args),
+]
+
 setup(
     name = "pnet",
-    ext_modules = cythonize('pnet/*.pyx'), # accepts a glob pattern
+    ext_modules = cythonize(extensions), # accepts a glob pattern
     include_dirs = [np.get_include()],
 
     # Uncomment for debugging
     #extra_compile_args=["-g"],
     #extra_link_args=["-g"],
 )
-